@@ -1,20 +1,21 @@
 import itertools
-import json
 
 import chainclient
-from chainclient import HALDoc
-from websocket import create_connection
 import coloredlogs
 import logging
 import numpy
 
-from interpolate import Interpolator
-from kbhit import KBHit
+from ingest import StreamIngest
+from snapshot import SNAPSHOT_DIR, load_description, revalidate
+from stats import RunningStats
 
 logger = logging.getLogger(__name__)
 coloredlogs.install(level=logging.INFO)
 
 SITE_URL = 'http://chain-api.media.mit.edu/sites/7'
+# Name of the virtual device holding the aggregate sensors, whose own
+# sensors are left out of the statistics
+AGGREGATE_DEVICE_NAME = 'aggregate'
 
 METRIC_WHITELIST = []
 
@@ -24,9 +25,13 @@ def get_site(site_url=SITE_URL):
 
 
 class Metric(object):
-    def __init__(self, metric, sensors, sw, width, height):
+    def __init__(self, metric, sensors):
         self.metric = metric
         self.sensors = sensors
+        self.stats = RunningStats(values=self.get_array)
+        for sensor in sensors:
+            sensor.stats = self.stats
+        self.stats.reset(self.get_array())
 
     def get_sensor_hash(self):
         return {s.url: s for s in self.sensors}
@@ -35,16 +40,17 @@ class Metric(object):
         return numpy.array(filter(lambda x: x != None, [s.value for s in self.sensors]))
 
     def get_mean(self):
-        return numpy.mean(self.get_array())
+        return self.stats.mean
 
     def get_std(self):
-        return numpy.std(self.get_array())
+        return self.stats.std
 
 
 class Sensor(object):
     def __init__(self, url, metric):
         self.url = url
         self.metric = metric
+        self.stats = None
         self._value = None
 
     def __hash__(self):
@@ -55,13 +61,13 @@ class Sensor(object):
 
     @property
     def value(self):
-        if self._value:
-            return self._value
-        else:
-            return None
+        return self._value
     @value.setter
     def value(self, value):
+        old = self.value
         self._value = value
+        if self.stats is not None:
+            self.stats.replace(old, self.value)
     
     def __repr__(self):
         return "Sensor %s, (metric=%s)" % \
@@ -72,25 +78,22 @@ def get_devices(site):
     return devices
 
 
-def get_metrics(site):
-    devices = get_devices(site)
+def get_metrics(description):
+    aggregate_devices = set(d['index'] for d in description['devices'] if d['name'] == AGGREGATE_DEVICE_NAME)
 
     sensors_by_metric = {}
 
-    for device in devices:
-        if device.name == AGGREGATE_DEVICE_NAME:
+    for sensor_doc in description['sensors']:
+        if sensor_doc['device'] in aggregate_devices:
             continue
-        for chain_sensor in device.rels['ch:sensors'].rels['items']:
-            url = chain_sensor.links.self.href
-            sensor = Sensor(url=url, metric=chain_sensor.metric)
-            if sensor.metric not in sensors_by_metric:
-                sensors_by_metric[sensor.metric] = []
-            sensors_by_metric[sensor.metric].append(sensor)
+        sensor = Sensor(url=sensor_doc['url'], metric=sensor_doc['metric'])
+        if sensor.metric not in sensors_by_metric:
+            sensors_by_metric[sensor.metric] = []
+        sensors_by_metric[sensor.metric].append(sensor)
 
     metrics = {}
     for metric in sensors_by_metric:
-        metric = Metric(metric, sensors_by_metric[metric])
-        metrics[metric] = metric
+        metrics[metric] = Metric(metric, sensors_by_metric[metric])
 
     return metrics
 
@@ -122,35 +125,44 @@ def update_aggregate_virtual_devices(site, metrics, aggregate_statistics):
 
     for metric in metrics:
         for statistic in aggregate_statistics:
-            sensor_metric = '%_%' % metric, statistic
-            if not in sensor_metric in sensor_metrics:
+            sensor_metric = '%s_%s' % (metric, statistic)
+            if sensor_metric not in sensor_metrics:
                 #{'sensor-type': 'scalar', 'metric': sensor_metric, 'unit': unit}
-
-def main():
-    site = get_site()
-    metrics = get_metrics(site)
+                pass
+
+def stats_subscriber(description):
+    """(sensor_hash, update_stats) keeping the statistics of a site's
+    metrics. update_stats is a StreamIngest subscriber matching sensors by
+    url, so it can also subscribe to the ingest of another service, such as
+    osc_server --aggregate, sharing its connection to the stream."""
+    metrics = get_metrics(description)
     sensor_hash = get_sensor_hash(metrics)
 
-    sensor_hash = get_sensor_hash(metrics)
-    stream_url = site.links['ch:websocketStream'].href
-    logger.info('Connecting to %s' % stream_url)
-    ws = create_connection(stream_url)
-    logger.info('Connected!')
-    while True:
-        resource_data = ws.recv()
-        logger.debug(resource_data)
-        in_data = HALDoc(json.loads(resource_data))
-        try:
-            sensor = sensor_hash[in_data.links['ch:sensor'].href]
-        except KeyError:
-            logger.warning('Hash miss: %s' % in_data.links['ch:sensor'].href)
-            continue
+    def update_stats(updates):
+        changed = set()
+        for sensor, value, _ in updates:
+            sensor = sensor_hash.get(sensor.url)
+            if sensor is None:
+                continue
+            sensor.value = value
+            changed.add(sensor.metric)
+        # One stats update per metric per batch rather than per message
+        for metric_name in changed:
+            send_metric_stats(metrics[metric_name])
+
+    return sensor_hash, update_stats
 
-        logger.info('Received value of %f from sensor %s' % (in_data.value, sensor))
 
-        sensor.value = in_data.value
-        metric = metrics[sensor.metric]
-        send_metric_stats(metric)
+def main():
+    description, from_snapshot = load_description(SITE_URL, SNAPSHOT_DIR)
+    if from_snapshot:
+        revalidate(SITE_URL, SNAPSHOT_DIR, description,
+                   lambda _: logger.warning('Site changed since the snapshot, restart to pick up new sensors'))
+    sensor_hash, update_stats = stats_subscriber(description)
+
+    ingest = StreamIngest(description['stream_url'], sensor_hash)
+    ingest.subscribe(update_stats)
+    ingest.start().join()
 
 
 if __name__ == "__main__":
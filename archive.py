@@ -0,0 +1,154 @@
+"""Columnar on-disk archive of sensor history.
+
+Each sensor is stored as two .npy files, int64 epoch milliseconds and
+float32 values, sorted by time. index.json maps sensor urls to their files
+and time range. Reads memory-map the files and binary-search the timestamps,
+so a seek is O(log n) and slices are views, not copies.
+
+Usage: python archive.py ARCHIVE_DIR START END
+where START and END are unix timestamps of the period to ingest.
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy
+
+from history_loader import sensor_id
+from util import MILLISECONDS, atomic_write, ensure_dir
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_VERSION = 1
+
+
+class Archive(object):
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, 'index.json')
+        self._columns = {}
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except IOError:
+            self.index = {'version': ARCHIVE_VERSION, 'sensors': {}}
+        if self.index.get('version') != ARCHIVE_VERSION:
+            raise ValueError('Unsupported archive version %s in %s' % (self.index.get('version'), root))
+
+    def _paths(self, url):
+        name = self.index['sensors'][url]['id']
+        return (os.path.join(self.root, '%s.time.npy' % name),
+                os.path.join(self.root, '%s.value.npy' % name))
+
+    def columns(self, url):
+        if url not in self.index['sensors']:
+            return None
+        if url not in self._columns:
+            time_path, value_path = self._paths(url)
+            self._columns[url] = (numpy.load(time_path, mmap_mode='r'),
+                                  numpy.load(value_path, mmap_mode='r'))
+        return self._columns[url]
+
+    def slice(self, url, start_ms, end_ms):
+        """Views of the samples of a sensor with start_ms <= time < end_ms."""
+        columns = self.columns(url)
+        if columns is None:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.float32)
+        times, values = columns
+        lo, hi = numpy.searchsorted(times, [start_ms, end_ms])
+        return times[lo:hi], values[lo:hi]
+
+    def append(self, url, sensor_name, times, values):
+        """Merge new samples into the archive of a sensor."""
+        times = numpy.asarray(times, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=numpy.float32)
+        existing = self.columns(url)
+        if existing is not None:
+            times = numpy.concatenate((existing[0], times))
+            values = numpy.concatenate((existing[1], values))
+
+        # Sort by time, keeping the last value written for a timestamp
+        order = numpy.argsort(times, kind='mergesort')
+        times, values = times[order], values[order]
+        keep = numpy.ones(len(times), dtype=bool)
+        keep[:-1] = times[1:] != times[:-1]
+        times, values = times[keep], values[keep]
+
+        self._columns.pop(url, None)
+        self.index['sensors'][url] = {
+            'id': sensor_name,
+            'start': int(times[0]) if len(times) else None,
+            'end': int(times[-1]) if len(times) else None,
+            'count': len(times),
+        }
+        time_path, value_path = self._paths(url)
+        self._write(time_path, times)
+        self._write(value_path, values)
+
+    def _write(self, path, array):
+        atomic_write(path, lambda f: numpy.save(f, array), mode='wb')
+
+    def save_index(self):
+        atomic_write(self.index_path, lambda f: json.dump(self.index, f))
+
+
+class ArchiveSource(object):
+    """Replay source reading from an Archive, with the same fetch_series
+    interface as HistoryLoader."""
+    def __init__(self, archive):
+        self.archive = archive
+
+    def fetch_series(self, sensors, start_stamp, end_stamp):
+        start_ms, end_ms = start_stamp * MILLISECONDS, end_stamp * MILLISECONDS
+        return [(sensor,) + self.archive.slice(sensor.url, start_ms, end_ms) for sensor in sensors]
+
+
+def ingest(archive, loader, sensors, start_stamp, end_stamp, chunk_length=86400, flush_chunks=30):
+    # Chunks are buffered and merged every flush_chunks, since every append
+    # rewrites the files of a sensor
+    pending = {}
+
+    def flush():
+        for sensor, (times, values) in pending.items():
+            archive.append(sensor.url, sensor_id(sensor), numpy.concatenate(times), numpy.concatenate(values))
+        archive.save_index()
+        pending.clear()
+
+    # Keep what was fetched when a chunk fails; appending merges, so the
+    # ingest can be run again over the same period
+    try:
+        for count, chunk_start in enumerate(range(start_stamp, end_stamp, chunk_length)):
+            chunk_end = min(chunk_start + chunk_length, end_stamp)
+            logger.info('Ingesting %s to %s' % (chunk_start, chunk_end))
+            for sensor, times, values in loader.fetch_series(sensors, chunk_start, chunk_end):
+                if len(times):
+                    columns = pending.setdefault(sensor, ([], []))
+                    columns[0].append(times)
+                    columns[1].append(values)
+            if (count + 1) % flush_chunks == 0:
+                flush()
+    finally:
+        flush()
+
+
+def main():
+    import chainclient
+    from history_loader import HistoryLoader
+    from models import get_models
+
+    parser = argparse.ArgumentParser(description='Ingest sensor history into a columnar archive')
+    parser.add_argument('root')
+    parser.add_argument('start', type=int)
+    parser.add_argument('end', type=int)
+    parser.add_argument('--site', default='http://chain-api.media.mit.edu/sites/7')
+    parser.add_argument('--cache-dir', default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    _, _, sensor_hash = get_models(chainclient.get(args.site))
+    ingest(Archive(args.root), HistoryLoader(cache_dir=args.cache_dir), sensor_hash.values(), args.start, args.end)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""Benchmarks of the hot paths on synthetic sites.
+
+Usage: python bench.py [--devices N] [--metrics M] [--output FILE]
+                           [--baseline FILE] [--save-baseline]
+
+Results are written as JSON. With --baseline, every result is compared with
+the stored one and the run fails if any is more than --tolerance worse.
+"""
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+import urlparse
+
+import numpy
+
+from history_loader import HistoryLoader
+from models import get_models
+from replay import ReplaySession
+
+# Results where larger is better; everything else is a cost
+HIGHER_IS_BETTER = ('events_per_second', 'queries_per_second', 'samples_per_second')
+
+
+# Synthetic site, shaped like the chainclient HALDoc documents get_models reads
+class FakeDoc(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeLink(object):
+    def __init__(self, href):
+        self.href = href
+
+
+def make_site(n_devices, n_metrics, seed=0):
+    random = numpy.random.RandomState(seed)
+    metrics = ['metric_%d' % i for i in range(n_metrics)]
+    devices = []
+    for index in range(n_devices):
+        devices.append(FakeDoc(
+            name='device %d' % index,
+            geoLocation={
+                'latitude': 41.90 + random.rand() * 0.01,
+                'longitude': -70.60 + random.rand() * 0.01,
+                'elevation': random.rand() * 10,
+            },
+            sensors=[FakeDoc(href='http://localhost/sensors/%d' % (index * n_metrics + i), metric=metric)
+                     for i, metric in enumerate(metrics)]))
+    return FakeDoc(rels={'ch:siteSummary': FakeDoc(devices=devices)},
+                   links={'ch:websocketStream': FakeLink('ws://localhost/')})
+
+
+def fill_values(sensor_hash, seed=0):
+    random = numpy.random.RandomState(seed)
+    for sensor in sensor_hash.values():
+        sensor.value = 1 + random.rand() * 100
+
+
+def percentiles(samples):
+    samples = numpy.array(samples) * 1e6
+    return {
+        'p50_us': float(numpy.percentile(samples, 50)),
+        'p90_us': float(numpy.percentile(samples, 90)),
+        'p99_us': float(numpy.percentile(samples, 99)),
+    }
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+# Benchmarks
+def bench_models(site, precision):
+    start = time.time()
+    models = get_models(site, precision)
+    return models, {'seconds': time.time() - start}
+
+
+def bench_cache(metric, precision):
+    rss = max_rss_mb()
+    start = time.time()
+    metric.generate_interpolator(metric.store, precision)
+    seconds = time.time() - start
+    raster = metric.interpolator.simplex_lookup
+    return {
+        'seconds': seconds,
+        'raster_mb': raster.nbytes / 1e6,
+        'max_rss_growth_mb': max_rss_mb() - rss,
+    }
+
+
+def bench_get_value(metric, queries, seed=0):
+    random = numpy.random.RandomState(seed)
+    origin_x, origin_y, width, length = metric.norm_bounds
+    xs = origin_x + random.rand(queries) * width
+    ys = origin_y + random.rand(queries) * length
+
+    samples = []
+    for x, y in zip(xs, ys):
+        start = time.time()
+        metric.get_value(x, y)
+        samples.append(time.time() - start)
+    result = percentiles(samples)
+
+    start = time.time()
+    metric.get_value_many(xs, ys)
+    result['batch_queries_per_second'] = queries / (time.time() - start)
+    return result
+
+
+def bench_aggregates(metric, repeats):
+    result = {}
+    for name, function in (('mean', metric.get_mean), ('std', metric.get_std)):
+        samples = []
+        for _ in range(repeats):
+            start = time.time()
+            function()
+            samples.append(time.time() - start)
+        result[name] = percentiles(samples)
+
+    sensors = metric.sensors
+    random = numpy.random.RandomState(0)
+    start = time.time()
+    for i in range(repeats):
+        sensors[i % len(sensors)].value = 1 + random.rand()
+    result['update'] = {'mean_us': (time.time() - start) * 1e6 / repeats}
+    return result
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Local stand-in for chain-api scalar_data, one reading every 10s."""
+    page_size = 100
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        start, end = int(query['timestamp__gte']), int(query['timestamp__lt'])
+        page = int(query.get('page', 0))
+        stamps = range(start, end, 10)[page * self.page_size:(page + 1) * self.page_size]
+        doc = {
+            'data': [{'timestamp': '%sZ' % time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)), 'value': t % 97}
+                     for t in stamps],
+            '_links': {},
+        }
+        if (page + 1) * self.page_size < len(range(start, end, 10)):
+            doc['_links']['next'] = {'href': 'http://%s:%d%s&page=%d' % (
+                self.server.server_address + (self.path.split('&page=')[0], page + 1))}
+        body = json.dumps(doc)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+class SyntheticSource(object):
+    """In-memory history source with one reading per sensor every
+    `interval` milliseconds, so replay is measured without fetch latency."""
+    def __init__(self, interval=1000):
+        self.interval = interval
+
+    def fetch_series(self, sensors, start_stamp, end_stamp):
+        start = -(-start_stamp * 1000 // self.interval) * self.interval
+        times = numpy.arange(start, end_stamp * 1000, self.interval, dtype=numpy.int64)
+        values = (times % 97).astype(numpy.float32)
+        return [(sensor, times, values) for sensor in sensors]
+
+
+def start_stub_server():
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def bench_history(sensors, start_time=1415491200, chunk_length=2000):
+    server = start_stub_server()
+    loader = HistoryLoader('http://%s:%d' % server.server_address)
+    start = time.time()
+    series = loader.fetch_series(sensors, start_time, start_time + chunk_length)
+    seconds = time.time() - start
+    server.shutdown()
+    return {
+        'fetch_chunk_seconds': seconds,
+        'samples_per_second': sum(len(s[1]) for s in series) / seconds,
+    }
+
+
+def bench_replay(sensors, seconds, time_scale=1e4, start_time=1415491200):
+    # Fast enough that the scheduler, not the clock, is the limit
+    session = ReplaySession(SyntheticSource(), sensors, start_time, time_scale=time_scale, buffer_time=1)
+    fetcher = threading.Thread(target=session.fetch_loop)
+    fetcher.daemon = True
+    fetcher.start()
+    events = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        events += len(session.scheduler.wait_due(0.1))
+    elapsed = time.time() - start
+    session.close()
+    fetcher.join()
+    return {'events_per_second': events / elapsed}
+
+
+def run(args):
+    site = make_site(args.devices, args.metrics)
+    results = {'config': {'devices': args.devices, 'metrics': args.metrics, 'precision': args.precision}}
+
+    (metric_hash, _, sensor_hash), results['get_models'] = bench_models(site, args.precision)
+    fill_values(sensor_hash)
+    metric = metric_hash[sorted(metric_hash)[0]]
+    results['generate_cache'] = bench_cache(metric, args.precision)
+    results['get_value'] = bench_get_value(metric, args.queries)
+    results['aggregates'] = bench_aggregates(metric, args.queries)
+    results['history'] = bench_history(metric.sensors[:args.history_sensors])
+    results['replay'] = bench_replay(metric.sensors, args.replay_seconds)
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """Names of the results more than `tolerance` worse than the baseline."""
+    current = flatten(results)
+    regressions = []
+    for name, previous in flatten(baseline).items():
+        if name.startswith('config.') or name not in current or not previous:
+            continue
+        ratio = current[name] / float(previous)
+        if name.split('.')[-1] in HIGHER_IS_BETTER or name.endswith('_per_second'):
+            ratio = 1. / ratio if ratio else float('inf')
+        if ratio > 1 + tolerance:
+            regressions.append((name, previous, current[name]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark interpolation, model build and replay')
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--metrics', type=int, default=4)
+    parser.add_argument('--precision', type=int, default=1)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--history-sensors', type=int, default=20)
+    parser.add_argument('--replay-seconds', type=float, default=2.)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(output)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, previous, current in regressions:
+            sys.stderr.write('Regression in %s: %s -> %s\n' % (name, previous, current))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
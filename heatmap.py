@@ -0,0 +1,94 @@
+import numpy
+from matplotlib import image
+
+
+class HeatField(object):
+    """Live interpolated raster of a metric over normalized coordinates.
+
+    The simplex vertices and barycentric weights of every pixel are computed
+    once, along with an index from each sensor to the pixels whose simplex
+    uses it. A sensor update then only re-evaluates those pixels. Pixels
+    outside the hull, or whose simplex has a sensor without data, are inf in
+    `raster`; the images served fill them with `fill(points)`, given the
+    normalized points of those pixels, when there is one.
+    """
+    def __init__(self, interpolator, minX=0, maxX=100, minY=0, maxY=100, step=1., fill=None):
+        self.interpolator = interpolator
+        self.fill = fill
+        self.store = interpolator.store
+        self.extent = (minX, maxX, minY, maxY)
+        self.shape = (int(round((maxX - minX) / step)) + 1,
+                      int(round((maxY - minY) / step)) + 1)
+
+        xs = minX + step * numpy.arange(self.shape[0])
+        ys = minY + step * numpy.arange(self.shape[1])
+        grid_x, grid_y = numpy.meshgrid(xs, ys, indexing='ij')
+        self.points = numpy.column_stack((grid_x.ravel(), grid_y.ravel()))
+        simplices, self.weights = interpolator.locate(self.points)
+        inside = simplices >= 0
+        self.pixels = numpy.flatnonzero(inside)
+        self.vertices = interpolator.tri.simplices[simplices[inside]]
+
+        # rows_by_sensor[offsets[i]:offsets[i + 1]] are the rows of
+        # pixels/vertices/weights that depend on sensor i
+        rows = numpy.repeat(numpy.arange(len(self.pixels)), 3)
+        owners = self.vertices.ravel()
+        order = numpy.argsort(owners, kind='mergesort')
+        self.rows_by_sensor = rows[order]
+        self.offsets = numpy.searchsorted(owners[order], numpy.arange(len(self.store) + 1))
+
+        self.raster = numpy.empty(self.shape[0] * self.shape[1])
+        self.raster.fill(float('inf'))
+        self.refresh()
+
+    def evaluate(self, rows=None):
+        if rows is None:
+            rows = slice(None)
+        values = self.store.value[self.vertices[rows]]
+        with numpy.errstate(invalid='ignore'):
+            result = (self.weights[rows] * values).sum(axis=1)
+        result[~numpy.isfinite(result)] = float('inf')
+        self.raster[self.pixels[rows]] = result
+
+    def refresh(self):
+        self.evaluate()
+
+    def update_sensor(self, index):
+        self.evaluate(self.rows_by_sensor[self.offsets[index]:self.offsets[index + 1]])
+
+    def filled(self):
+        # The raster with the pixels lacking a value filled, if possible
+        missing = ~numpy.isfinite(self.raster)
+        if self.fill is None or not missing.any():
+            return self.raster
+        raster = self.raster.copy()
+        raster[missing] = self.fill(self.points[missing])
+        return raster
+
+    @property
+    def image(self):
+        # Indexed [x, y]; transpose for imshow
+        return self.filled().reshape(self.shape)
+
+    def value_range(self, raster=None):
+        if raster is None:
+            raster = self.filled()
+        finite = raster[numpy.isfinite(raster)]
+        if not len(finite):
+            return 0., 0.
+        return float(finite.min()), float(finite.max())
+
+    def to_bytes(self, raster=None):
+        """Raster quantized to uint8 rows of y, with 0 for no data and
+        1-255 spanning value_range()."""
+        if raster is None:
+            raster = self.filled()
+        low, high = self.value_range(raster)
+        scale = 254. / (high - low) if high > low else 0.
+        quantized = numpy.zeros(raster.shape, dtype=numpy.uint8)
+        finite = numpy.isfinite(raster)
+        quantized[finite] = 1 + numpy.rint((raster[finite] - low) * scale).astype(numpy.uint8)
+        return quantized.reshape(self.shape).T.tobytes()
+
+    def to_png(self, fname, cmap='jet'):
+        image.imsave(fname, numpy.ma.masked_invalid(self.image.T), cmap=cmap, origin='lower')
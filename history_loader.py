@@ -0,0 +1,134 @@
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import json
+import logging
+import os
+import time
+
+import numpy
+import requests
+
+from util import atomic_write, parse_timestamp_ms
+
+logger = logging.getLogger(__name__)
+
+CHAIN_API_URL = 'http://chain-api.media.mit.edu'
+
+
+class FetchError(Exception):
+    """Some sensors of a chunk could not be fetched; nothing of the chunk
+    should be taken as known."""
+
+
+def to_series(data):
+    times = numpy.array([parse_timestamp_ms(d['timestamp']) for d in data], dtype=numpy.int64)
+    values = numpy.array([d['value'] for d in data], dtype=numpy.float32)
+    order = numpy.argsort(times, kind='mergesort')
+    return times[order], values[order]
+
+
+def sensor_id(sensor):
+    return sensor.url.rstrip('/').split('/')[-1]
+
+
+class ChunkCache(object):
+    """On-disk cache of fetched history, one JSON file per (sensor, window).
+
+    Files are written atomically so several processes can share the cache.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, sensor, start_stamp, end_stamp):
+        return os.path.join(self.cache_dir, sensor_id(sensor), '%d_%d.json' % (start_stamp, end_stamp))
+
+    def get(self, sensor, start_stamp, end_stamp):
+        try:
+            with open(self.path(sensor, start_stamp, end_stamp)) as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def put(self, sensor, start_stamp, end_stamp, data):
+        atomic_write(self.path(sensor, start_stamp, end_stamp), lambda f: json.dump(data, f))
+
+
+class HistoryLoader(object):
+    """Fetches sensor history from chain-api.
+
+    The sensors of a chunk are fetched concurrently over pooled keep-alive
+    connections, every page of a response is followed, and chunks that are
+    entirely in the past are kept in a ChunkCache shared by all clients.
+    Sensors are fetched on a ThreadPool of `workers` threads, or on `pool`,
+    e.g. a gevent Pool.
+    """
+    def __init__(self, base_url=CHAIN_API_URL, cache_dir=None, workers=8, timeout=30, pool=None):
+        self.base_url = base_url.rstrip('/')
+        self.cache = ChunkCache(cache_dir) if cache_dir else None
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = pool if pool is not None else ThreadPool(workers)
+
+        self._lock = Lock()
+        self._key_locks = {}
+
+    def data_url(self, sensor, start_stamp, end_stamp):
+        return '%s/scalar_data/?sensor_id=%s&timestamp__gte=%d&timestamp__lt=%d' % (
+            self.base_url, sensor_id(sensor), start_stamp, end_stamp)
+
+    def fetch_pages(self, url):
+        data = []
+        while url:
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            doc = response.json()
+            data.extend(doc.get('data', []))
+            url = doc.get('_links', {}).get('next', {}).get('href')
+        return data
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = Lock()
+            return self._key_locks[key]
+
+    def fetch_sensor(self, sensor, start_stamp, end_stamp):
+        cacheable = self.cache is not None and end_stamp <= time.time()
+        if not cacheable:
+            return self.fetch_pages(self.data_url(sensor, start_stamp, end_stamp))
+
+        # Concurrent requests for the same chunk wait for a single fetch
+        key = (sensor.url, start_stamp, end_stamp)
+        with self._key_lock(key):
+            data = self.cache.get(sensor, start_stamp, end_stamp)
+            if data is None:
+                data = self.fetch_pages(self.data_url(sensor, start_stamp, end_stamp))
+                self.cache.put(sensor, start_stamp, end_stamp, data)
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return data
+
+    def fetch_chunk(self, sensors, start_stamp, end_stamp):
+        # Raises FetchError if any sensor failed, after all were tried
+        def fetch(sensor):
+            try:
+                return self.fetch_sensor(sensor, start_stamp, end_stamp)
+            except (requests.RequestException, ValueError):
+                logger.exception('Failed to fetch %s from %s to %s' % (sensor, start_stamp, end_stamp))
+                return None
+        results = self.pool.map(fetch, sensors)
+        failed = sum(1 for data in results if data is None)
+        if failed:
+            raise FetchError('Failed to fetch %d of %d sensors from %s to %s' % (
+                failed, len(sensors), start_stamp, end_stamp))
+        return zip(sensors, results)
+
+    def fetch_series(self, sensors, start_stamp, end_stamp):
+        # Same interface as archive.ArchiveSource: epoch millisecond and
+        # value arrays per sensor, sorted by time
+        return [(sensor,) + to_series(data)
+                for sensor, data in self.fetch_chunk(sensors, start_stamp, end_stamp)]
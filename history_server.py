@@ -1,18 +1,26 @@
-from Queue import PriorityQueue, Empty
-from threading import Thread
-from gevent import sleep
+# Everything below runs on greenlets: replay groups, socket readers and
+# history fetches all cooperate on one event loop
+from gevent import monkey; monkey.patch_all()
 import datetime
 import json
+import os
+import urlparse
 
 from flask import Flask, request
 from flask_sockets import Sockets
-
-import chainclient
+from gevent.pool import Pool
+import gevent
+import pytz
 
 import coloredlogs
 import logging
 
-from models import get_models
+from archive import Archive, ArchiveSource
+import instrument
+from history_loader import FetchError, HistoryLoader
+from replay_hub import BinaryEncoder, ReplayHub
+from rollup import RollupSource, level_for_range
+from snapshot import load_models, replace_models
 
 app = Flask(__name__)
 sockets = Sockets(app)
@@ -21,123 +29,134 @@ logger = logging.getLogger(__name__)
 coloredlogs.install(level=logging.INFO)
 
 
-#absurd numper of time related imports that hopefully can be paired down
-import dateutil.parser; import pytz; import calendar
-
-# Time functions
-def to_unix_time(t):
-    return calendar.timegm(t.utctimetuple())
-def from_string(s):
-    return dateutil.parser.parse(s)
 def from_unix_time(u):
-    return datetime.datetime.fromtimestamp(u).replace(tzinfo=pytz.utc)
+    return datetime.datetime.utcfromtimestamp(u).replace(tzinfo=pytz.utc)
 
 
-LOOK_AHEAD_TIME = datetime.timedelta(seconds=1000)
-CHUNK_LENGTH = datetime.timedelta(seconds=2000)
+# seconds
+LOOK_AHEAD_TIME = 1000
+CHUNK_LENGTH = 2000
 SITE_URL= 'http://chain-api.media.mit.edu/sites/7'
-
-
-class Event:
-    def __init__(self, sensor, time, value):
-        self.sensor = sensor
-        self.time = time
-        self.value = value
-
-    def __repr__(self):
-        return '<event time=%s value=%s>' % (str(self.time), self.value)
-
-    def to_dict(self):
-        return {
-            'timestamp': str(self.time),
-            '_links': {
-                'self': {
-                    'href': 'http://chain-api.media.mit.edu/scalar_data/'
-                },
-                'ch:sensor': {
-                    'href': self.sensor.url
-                }
-            },
-            'value': self.value
-        }
-
-def get_data(sensor, start_time, end_time):
-    start_stamp = to_unix_time(start_time)
-    end_stamp = to_unix_time(end_time)
-    c = chainclient.get(sensor.data_url +'&timestamp__gte=%s&timestamp__lt=%s' % (start_stamp, end_stamp))
-    return c.data
-
-
-site = chainclient.get(SITE_URL)
-_, _, sensor_hash = get_models(site)
-sensors = sensor_hash.values()
+HISTORY_CACHE_DIR = 'history_cache'
+# Concurrent requests to chain-api
+HISTORY_FETCH_WORKERS = 8
+# Replay from a columnar archive built with archive.py when it exists
+ARCHIVE_DIR = 'archive'
+# Buckets per sensor of /range queries without a level, and the most raw
+# history one query may read besides rounding out to whole chunks, which the
+# rollups kept in memory cover
+RANGE_POINTS = 500
+MAX_RANGE_HOURS = 24
+
+
+def on_site_change(models, new_models):
+    replace_models(models, new_models)
+    sensors[:] = models[2].values()
+
+sensors = []
+_, _, sensor_hash = load_models(SITE_URL, on_change=on_site_change)
+sensors[:] = sensor_hash.values()
+if os.path.exists(os.path.join(ARCHIVE_DIR, 'index.json')):
+    source = ArchiveSource(Archive(ARCHIVE_DIR))
+    logger.info("Replaying from archive %s" % ARCHIVE_DIR)
+else:
+    source = HistoryLoader(cache_dir=HISTORY_CACHE_DIR, workers=HISTORY_FETCH_WORKERS,
+                           pool=Pool(HISTORY_FETCH_WORKERS))
+source = RollupSource(source, chunk_length=CHUNK_LENGTH)
+hub = ReplayHub(source, sensors, spawn=gevent.spawn, chunk_length=CHUNK_LENGTH, look_ahead=LOOK_AHEAD_TIME)
+# Sensor indices of the binary format, shared by all its clients
+binary_encoder = BinaryEncoder(sensors)
 logger.info("Initialized")
 
 
-class PseudoClock:
-    def start(self, start_time=1415491200, time_scale=1):
-        self.time_scale = time_scale
-        self.local_start_time = self.local_now()
-        self.pseudo_start_time = from_unix_time(start_time)
-
-    def local_now(self):
-        return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-
-    def pseudo_now(self):
-        pseudo_elapsed_time = (self.local_now() - self.local_start_time) * self.time_scale
-        return self.pseudo_start_time + pseudo_elapsed_time
+@app.route('/stats')
+def stats():
+    return json.dumps({
+        'instrument': instrument.snapshot(),
+        'groups': hub.stats(),
+        'profile': instrument.profiler.top() if instrument.profiler.samples else [],
+    }), 200, {'Content-Type': 'application/json'}
+
+
+@app.route('/range')
+def range_query():
+    """Rollups of sensor history between two unix times:
+        /range?start=<unix>&end=<unix>[&level=<seconds>][&points=<n>][&sensor=<url>...]
+    The level defaults to the finest giving at most `points` buckets per
+    sensor; all sensors are included unless some are given, leaving out
+    those without data in the range. The buckets may span at most
+    MAX_RANGE_HOURS."""
+    try:
+        start = float(request.args['start'])
+        end = float(request.args['end'])
+        points = int(request.args.get('points', RANGE_POINTS))
+        level = int(request.args.get('level', 0)) or level_for_range(end - start, points, source.levels)
+    except (KeyError, ValueError):
+        return 'start and end must be unix times, level and points integers', 400
+    if level not in source.levels:
+        return 'level must be one of %s' % (source.levels,), 400
+    chunk_start, chunk_end = source.chunk_span(start, end, level)
+    max_span = MAX_RANGE_HOURS * 3600 + 2 * CHUNK_LENGTH
+    if not 0 < end - start or chunk_end - chunk_start > max_span:
+        return 'range must be positive and read at most %s hours of history' % MAX_RANGE_HOURS, 400
+
+    urls = set(request.args.getlist('sensor'))
+    selected = [sensor for sensor in sensors if not urls or sensor.url in urls]
+    try:
+        rollups = source.rollups(selected, start, end, level)
+    except FetchError as err:
+        return str(err), 502
+    return json.dumps({
+        'start': start,
+        'end': end,
+        'level': level,
+        'sensors': dict((sensor.url, rollup.to_dict()) for sensor, rollup in rollups if len(rollup)),
+    }), 200, {'Content-Type': 'application/json'}
+
+
+@app.route('/stats/profile', methods=['POST'])
+def set_profiling():
+    # enabled=1 starts the sampling profiler, enabled=0 stops it
+    instrument.set_profiling(request.form.get('enabled', '1') not in ('0', 'false'))
+    return stats()
 
 
 @sockets.route('/')
 def send_socket(ws):
-    clock = PseudoClock()
-    clock.start(start_time=1415491200, time_scale=1)
-    logger.info("Connected to client for time %s" % clock.pseudo_start_time)
-
-    # shared memory
-    q = PriorityQueue()
-
-    def look_ahead_loop():
-        highest_time_checked = clock.pseudo_start_time
-        while True:
-            if clock.pseudo_now() >= clock.local_now():
+    """Replay stream. Frames are JSON lists of events, or with
+    ?format=binary the frames of replay_hub.BinaryEncoder, after its sensor
+    dictionary as text."""
+    query = urlparse.parse_qs(ws.environ.get('QUERY_STRING', ''))
+    binary = query.get('format', ['json'])[0] == 'binary'
+    subscriber = hub.subscribe(encode=binary_encoder if binary else None)
+    logger.info("Connected to %s client at time %s" % ('binary' if binary else 'json',
+                from_unix_time(subscriber.group.session.clock.pseudo_now())))
+
+    def read_commands():
+        while subscriber.active:
+            message = ws.receive()
+            if message is None:
                 break
-            if clock.pseudo_now() < highest_time_checked - LOOK_AHEAD_TIME:
-                sleep(0.1)
+            hub.command(subscriber, message)
+        hub.unsubscribe(subscriber)
+
+    reader = gevent.spawn(read_commands)
+
+    try:
+        known = 0
+        if binary:
+            known = len(binary_encoder)
+            ws.send(binary_encoder.dictionary(0, known))
+        while subscriber.active:
+            frame = subscriber.get(timeout=None)
+            if frame is None:
                 continue
-            start = highest_time_checked
-            end = highest_time_checked + CHUNK_LENGTH
-            logger.info('Queueing Chunk: %s to %s' % (start, end))
-            for sensor in sensors:
-                data = get_data(sensor, start, end)
-                for d in data:
-                    t = dateutil.parser.parse(d['timestamp'])
-                    v = d['value']
-                    q.put((t.utctimetuple(), Event(sensor, t, v)))
-            highest_time_checked = end
-
-    t = Thread(target=look_ahead_loop)
-    t.daemon = True
-    t.start()
-
-    def read_seek():
-        new_start_time = ws.receive()
-        while True:
-            try:
-                q.get(False)
-            except Empty:
-                clock.start(start_time=new_start_time, time_scale=1)
-
-    t2 = Thread(target=read_seek)
-    t2.daemon = True
-    t2.start()
-
-    while True:
-        key, event = q.get()
-        if clock.pseudo_now() < event.time:
-            q.put((key, event))
-            sleep(0.05)
-        else:
-            logger.info('Sending: %s' % json.dumps(event.to_dict()))
-            ws.send(json.dumps(event.to_dict()))
-            q.task_done()
+            if binary and len(binary_encoder) > known:
+                # Sensors added to the site since, which the frame may index
+                end = len(binary_encoder)
+                ws.send(binary_encoder.dictionary(known, end))
+                known = end
+            ws.send(frame, binary=binary)
+    finally:
+        hub.unsubscribe(subscriber)
+        reader.kill(block=False)
@@ -0,0 +1,160 @@
+from Queue import Queue, Empty
+from threading import Lock, Thread
+import json
+import logging
+import random
+import re
+import time
+
+from websocket import create_connection
+
+import instrument
+from util import parse_timestamp_seconds
+
+logger = logging.getLogger(__name__)
+
+SENSOR_HREF = re.compile(r'"ch:sensor"\s*:\s*\{[^}]*?"href"\s*:\s*"([^"]+)"')
+VALUE = re.compile(r'"value"\s*:\s*(-?[0-9.]+(?:[eE][-+]?[0-9]+)?|null)')
+TIMESTAMP = re.compile(r'"timestamp"\s*:\s*"([^"]+)"')
+
+
+def decode_document(doc, received):
+    return (doc['_links']['ch:sensor']['href'], doc['value'],
+            parse_timestamp_seconds(doc.get('timestamp', ''), received))
+
+
+def decode(message, received):
+    """List of (href, value, timestamp) in a scalar data message.
+
+    A single document is read with regular expressions instead of building
+    it; lists of documents, as batched by history_server, and unusual
+    layouts go through the json parser.
+    """
+    href = SENSOR_HREF.search(message)
+    value = VALUE.search(message)
+    if message.lstrip().startswith('[') or href is None or value is None:
+        try:
+            docs = json.loads(message)
+            if not isinstance(docs, list):
+                docs = [docs]
+            return [decode_document(doc, received) for doc in docs]
+        except (ValueError, KeyError, TypeError):
+            return []
+    timestamp = TIMESTAMP.search(message)
+    return [(href.group(1),
+             None if value.group(1) == 'null' else float(value.group(1)),
+             parse_timestamp_seconds(timestamp.group(1), received) if timestamp else received)]
+
+
+class StreamIngest(object):
+    """Single consumer of a chain-api websocket stream shared by everything
+    in the process that needs sensor updates.
+
+    A reader thread keeps the connection open, reconnecting with jittered
+    exponential backoff. A dispatch thread decodes every message waiting at
+    that point as one batch, resolves the sensors through `sensor_hash`
+    (href -> sensor) and passes subscribers a list of
+    (sensor, value, timestamp) updates.
+    """
+    def __init__(self, stream_url, sensor_hash, min_backoff=1., max_backoff=60.):
+        self.stream_url = stream_url
+        self.sensor_hash = sensor_hash
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.queue = Queue()
+        self.lock = Lock()
+        self.subscribers = []
+        self.received = 0
+        self.misses = 0
+        self.reconnects = 0
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def start(self):
+        self.threads = []
+        for target in (self.read_loop, self.dispatch_loop):
+            t = Thread(target=target)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def join(self):
+        for t in self.threads:
+            while t.is_alive():
+                t.join(1)
+
+    def read_loop(self):
+        backoff = self.min_backoff
+        while True:
+            try:
+                logger.info('Connecting to %s' % self.stream_url)
+                ws = create_connection(self.stream_url)
+                logger.info('Connected!')
+                backoff = self.min_backoff
+                while True:
+                    message = ws.recv()
+                    if not message:
+                        raise IOError('connection closed')
+                    self.queue.put((message, time.time()))
+            except Exception as err:
+                self.reconnects += 1
+                logger.warning('Lost %s (%s), reconnecting in %.1fs' % (self.stream_url, err, backoff))
+            time.sleep(backoff * (0.5 + random.random() / 2))
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def next_batch(self, timeout=None):
+        batch = [self.queue.get(timeout=timeout)]
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                return batch
+
+    def decode_batch(self, batch):
+        instrument.record('ingest.queue_wait', time.time() - batch[0][1])
+        with instrument.timer('ingest.decode'):
+            decoded = []
+            for message, received in batch:
+                documents = decode(message, received)
+                if not documents:
+                    logger.debug('Could not decode %r', message)
+                decoded.extend(documents)
+
+        updates = []
+        with instrument.timer('ingest.lookup'):
+            for href, value, timestamp in decoded:
+                sensor = self.sensor_hash.get(href)
+                if sensor is None:
+                    self.misses += 1
+                    logger.debug('Hash miss: %s', href)
+                    continue
+                updates.append((sensor, value, timestamp))
+        self.received += len(batch)
+        instrument.count('ingest.messages', len(batch))
+        instrument.count('ingest.misses', len(decoded) - len(updates))
+        return updates
+
+    def dispatch_loop(self):
+        while True:
+            updates = self.decode_batch(self.next_batch())
+            if not updates:
+                continue
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for callback in subscribers:
+                try:
+                    callback(updates)
+                except Exception:
+                    logger.exception('Subscriber %s failed' % callback)
+
+
+def apply_updates(updates):
+    """Subscriber writing updates into the models' sensor stores. Stores
+    record when a value arrived, not the timestamp of the reading, so
+    replayed history counts as fresh."""
+    now = time.time()
+    for sensor, value, _ in updates:
+        sensor.store.set_value(sensor.index, value, now)
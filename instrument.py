@@ -0,0 +1,234 @@
+from collections import Counter
+from threading import Lock, Thread, current_thread, local
+import functools
+import math
+import sys
+import time
+import weakref
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = current_thread
+
+# Timer buckets are powers of two of microseconds, up to about 1000s
+BUCKETS = 31
+
+enabled = True
+
+_lock = Lock()
+# Recorders with a weak reference to the greenlet or thread writing them,
+# and what recorders of finished ones recorded
+_threads = []
+_retired = None
+_generation = 0
+_local = local()
+
+
+class Histogram(object):
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        micros = int(seconds * 1e6)
+        self.buckets[min(micros.bit_length(), BUCKETS - 1)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, q):
+        # Upper edge of the bucket holding the q-th percentile, in seconds
+        rank = int(math.ceil(self.count * q / 100.))
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total * 1000. / self.count if self.count else 0.,
+            'p50_ms': self.percentile(50) * 1000.,
+            'p90_ms': self.percentile(90) * 1000.,
+            'p99_ms': self.percentile(99) * 1000.,
+            'max_ms': self.max * 1000.,
+        }
+
+
+class ThreadRecorder(object):
+    """Timers and counters written only by the thread or greenlet that owns
+    them, so recording takes no lock; snapshot() merges them across owners.
+    Once its owner has finished a recorder is merged into the retired
+    totals and dropped."""
+    def __init__(self, generation):
+        self.generation = generation
+        self.timers = {}
+        self.counters = Counter()
+
+    def merge(self, other):
+        for name, histogram in other.timers.items():
+            self.timers.setdefault(name, Histogram()).merge(histogram)
+        self.counters.update(dict(other.counters))
+
+
+def _finished(owner):
+    owner = owner()
+    return owner is None or getattr(owner, 'dead', False)
+
+
+def _retire():
+    # Merge the recorders of finished owners; called holding _lock
+    global _retired
+    live = []
+    for owner, recorder in _threads:
+        if _finished(owner):
+            if _retired is None:
+                _retired = ThreadRecorder(_generation)
+            _retired.merge(recorder)
+        else:
+            live.append((owner, recorder))
+    _threads[:] = live
+
+
+def _recorder():
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None or recorder.generation != _generation:
+        recorder = _local.recorder = ThreadRecorder(_generation)
+        with _lock:
+            if recorder.generation == _generation:
+                _threads.append((weakref.ref(getcurrent()), recorder))
+                if len(_threads) % 64 == 0:
+                    _retire()
+    return recorder
+
+
+def record(name, seconds):
+    if not enabled:
+        return
+    timers = _recorder().timers
+    histogram = timers.get(name)
+    if histogram is None:
+        histogram = timers[name] = Histogram()
+    histogram.add(seconds)
+
+
+def count(name, n=1):
+    if enabled:
+        _recorder().counters[name] += n
+
+
+class timer(object):
+    """Context manager recording the time spent in its block under `name`."""
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.time() - self.start)
+
+
+def timed(name):
+    """Decorator recording the time spent in every call under `name`."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """{'timers': {name: summary}, 'counters': {name: n}} over all threads."""
+    total = ThreadRecorder(_generation)
+    with _lock:
+        _retire()
+        if _retired is not None:
+            total.merge(_retired)
+        recorders = [recorder for _, recorder in _threads]
+    for recorder in recorders:
+        total.merge(recorder)
+    return {
+        'timers': dict((name, h.summary()) for name, h in total.timers.items()),
+        'counters': dict(total.counters),
+    }
+
+
+def reset():
+    # Every owner starts a new recorder on its next record or count
+    global _generation, _retired
+    with _lock:
+        _generation += 1
+        _retired = None
+        del _threads[:]
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of every other thread every `interval` seconds
+    and counts the innermost frames seen, as 'file:line function'.
+
+    Only OS threads are seen: under gevent (history_server) the sampler
+    is itself a greenlet, so it only runs while the others wait and never
+    sees their stacks. Profile greenlet code with the timers instead."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        me = self.thread.ident
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    code = frame.f_code
+                    self.samples['%s:%d %s' % (code.co_filename, frame.f_lineno, code.co_name)] += 1
+            time.sleep(self.interval)
+
+    def top(self, n=20):
+        return self.samples.most_common(n)
+
+
+profiler = SamplingProfiler()
+
+
+def set_profiling(on):
+    if on:
+        profiler.samples.clear()
+        profiler.start()
+    else:
+        profiler.stop()
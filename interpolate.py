@@ -1,11 +1,25 @@
+import hashlib
+import logging
+import os
+
 import numpy
 from scipy.spatial import Delaunay
-from scipy.interpolate import griddata
-from matplotlib import pyplot as plt
+
+from util import atomic_write
+
+logger = logging.getLogger(__name__)
 
 class Interpolator(object):
-    def __init__(self, sensors, precision, length_transform=None):
-        self.sensors = sensors
+    """Linear interpolation over a Delaunay triangulation of the sensors of
+    a store, or only of those at `indices`. `points` are their normalized
+    positions when already known."""
+    def __init__(self, store, precision, length_transform=None, indices=None, points=None):
+        self.store = store
+        self.indices = indices
+        if indices is None:
+            self.sensors = store.sensors
+        else:
+            self.sensors = [store.sensors[i] for i in indices]
         self.precision = precision
 
         if length_transform is None:
@@ -13,56 +27,154 @@ class Interpolator(object):
         else:
             self.length_transform = length_transform
 
-    def floor(self, x):
-        return round(x, self.precision)
+        # Triangulate once per sensor layout; barycentric transforms are
+        # precomputed by scipy in tri.transform
+        self.points = self.get_points() if points is None else points
+        self.tri = Delaunay(self.points)
+        self.simplex_lookup = None
+        self.cache_path = None
 
     def grid_size(self):
         return (0.1)**self.precision
 
-    def generate_cache(self, minX, maxX, minY, maxY):
-        points = numpy.array([self.length_transform([s.x, s.y]) for s in self.sensors])
-        tri = Delaunay(points)
-        minX = self.floor(minX)
-        maxX = self.floor(maxX)
-        minY = self.floor(minY)
-        maxY = self.floor(maxY)
-
-        self.simplex_lookup = {}
-        for x in numpy.mgrid[minX:maxX:self.grid_size()]:
-            for y in numpy.mgrid[minY:maxY:self.grid_size()]:
-                x = self.floor(x)
-                y = self.floor(y)
-                self.simplex_lookup[(x,y)] = tri.vertices[tri.find_simplex([x, y])]
-
-    def cache_point(self, x, y):
-        points = numpy.array([self.length_transform([s.x, s.y]) for s in self.sensors])
-        tri = Delaunay(points)
-        self.simplex_lookup[(x, y)] = tri.vertices[tri.find_simplex([x, y])]
+    def get_points(self):
+        xs, ys = self.store.x, self.store.y
+        if self.indices is not None:
+            xs, ys = xs[self.indices], ys[self.indices]
+        return numpy.column_stack(self.length_transform([xs, ys]))
+
+    def get_values(self):
+        if self.indices is not None:
+            return self.store.value[self.indices]
+        return self.store.value
+
+    def generate_cache(self, minX, maxX, minY, maxY, cache_dir=None):
+        # Dense raster of simplex indices sampled at the grid points, looked
+        # up by integer indexing. -1 marks points outside the hull.
+        step = self.grid_size()
+        shape = (int(round((maxX - minX) / step)) + 1,
+                 int(round((maxY - minY) / step)) + 1)
+        self.cache_origin = (minX, minY)
+
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, 'simplex_%s.npy' % self.cache_key(minX, maxX, minY, maxY))
+            self.cache_path = path
+            if os.path.exists(path):
+                lookup = numpy.load(path, mmap_mode='r')
+                if lookup.shape == shape and lookup.dtype == numpy.int32:
+                    self.simplex_lookup = lookup
+                    return
+                logger.warning('Ignoring simplex cache %s with shape %s' % (path, lookup.shape))
+
+        xs = minX + step * numpy.arange(shape[0])
+        ys = minY + step * numpy.arange(shape[1])
+        grid_x, grid_y = numpy.meshgrid(xs, ys, indexing='ij')
+        grid = numpy.column_stack((grid_x.ravel(), grid_y.ravel()))
+        self.simplex_lookup = self.tri.find_simplex(grid).astype(numpy.int32).reshape(shape)
+
+        if path is not None:
+            atomic_write(path, lambda f: numpy.save(f, self.simplex_lookup), mode='wb')
+
+    def cache_key(self, minX, maxX, minY, maxY):
+        # The simplex numbering depends on the qhull version as well as the
+        # points, so it is part of the key
+        digest = hashlib.sha1(numpy.ascontiguousarray(self.points).tobytes())
+        digest.update(numpy.ascontiguousarray(self.tri.simplices).tobytes())
+        digest.update(repr((minX, maxX, minY, maxY, self.grid_size(), self.tri.nsimplex)))
+        return digest.hexdigest()
 
     def get_simplex(self, x, y):
-        if (self.floor(x), self.floor(y)) not in self.simplex_lookup:
-            self.cache_point(self.floor(x), self.floor(y))
-        vs = self.simplex_lookup[(self.floor(x), self.floor(y))]
-        return [self.sensors[v] for v in vs]
+        # Sensors at the corners of the simplex containing a normalized
+        # point, or None outside the hull
+        simplex = self.find_simplices([[x, y]])[0]
+        if simplex < 0:
+            return None
+        return [self.sensors[v] for v in self.tri.simplices[simplex]]
 
-    def interpolate(self, x, y):
-        point = self.length_transform([x, y])
-        sensors = self.get_simplex(*point)
-        points = numpy.array([self.length_transform([s.x, s.y]) for s in sensors])
-        values = numpy.array([s.value for s in sensors])
-        fill_value = float('inf')
-        return griddata(points, values, [point], fill_value=fill_value)[0]
-
-    def interpolate_slow(self, eval_points):
-        points = numpy.array([self.length_transform([s.x, s.y]) for s in self.sensors])
-        values = numpy.array([s.value for s in self.sensors])
-        fill_value = float('inf')
-        return griddata(points, values, eval_points, fill_value=fill_value)
-
-    def plot_heat_map(self, minX, maxX, minY, maxY):
-        eval_points_x, eval_points_y = numpy.mgrid[minX:maxX:self.grid_size(), minY:maxY:self.grid_size()]
-
-        heatmap = self.interpolate_slow((eval_points_x, eval_points_y))
-        plt.imshow(heatmap.T, extent=(minX, maxX, minY, maxY), origin='lower')
-        plt.colorbar()
+    def lookup_simplices(self, points):
+        # Simplex of the nearest raster point, or -1 when the point is outside
+        # the raster or the raster point is outside the hull
+        step = self.grid_size()
+        ix = numpy.rint((points[:, 0] - self.cache_origin[0]) / step).astype(numpy.intp)
+        iy = numpy.rint((points[:, 1] - self.cache_origin[1]) / step).astype(numpy.intp)
+        nx, ny = self.simplex_lookup.shape
+        on_raster = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        simplices = numpy.empty(len(points), dtype=numpy.intp)
+        simplices.fill(-1)
+        simplices[on_raster] = self.simplex_lookup[ix[on_raster], iy[on_raster]]
+        return simplices
 
+    def locate(self, points):
+        """Return the simplex containing each point and the barycentric
+        weights of the points that are inside the hull."""
+        if self.simplex_lookup is None:
+            simplices = self.tri.find_simplex(points)
+            inside = simplices >= 0
+            return simplices, self.barycentric(points[inside], simplices[inside])
+
+        # The raster guess is only right away from simplex edges; a negative
+        # weight means the point is in a neighbouring simplex, so those and
+        # the raster misses are resolved exactly
+        simplices = self.lookup_simplices(points)
+        guessed = simplices >= 0
+        weights = self.barycentric(points[guessed], simplices[guessed])
+        wrong = numpy.ones(len(points), dtype=bool)
+        wrong[guessed] = (weights < -1e-9).any(axis=1)
+        if wrong.any():
+            simplices[wrong] = self.tri.find_simplex(points[wrong])
+            inside = simplices >= 0
+            weights = self.barycentric(points[inside], simplices[inside])
+        return simplices, weights
+
+    def find_simplices(self, points):
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        return self.locate(points)[0]
+
+    def barycentric(self, points, simplices):
+        # tri.transform[s] holds the inverse affine map T and offset r for
+        # simplex s, so that b = T . (p - r) gives the first two coordinates
+        transform = self.tri.transform[simplices]
+        b = numpy.einsum('ijk,ik->ij', transform[:, :2, :], points - transform[:, 2, :])
+        return numpy.column_stack((b, 1 - b.sum(axis=1)))
+
+    def interpolate_normalized(self, points, values=None, confidence=None):
+        """Interpolated values at normalized points, inf where there is none.
+
+        `confidence` optionally scales the barycentric weight of each sensor,
+        e.g. by the age of its reading, renormalized within each simplex.
+        """
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        if values is None:
+            values = self.get_values()
+
+        simplices, weights = self.locate(points)
+        inside = simplices >= 0
+        result = numpy.empty(len(points))
+        result.fill(float('inf'))
+        if not inside.any():
+            return result
+
+        vertices = self.tri.simplices[simplices[inside]]
+        vertex_values = values[vertices]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            if confidence is None:
+                inside_values = (weights * vertex_values).sum(axis=1)
+            else:
+                weights = weights * confidence[vertices]
+                # A sensor with no confidence does not count even without data
+                vertex_values = numpy.where(weights != 0, vertex_values, 0.)
+                inside_values = (weights * vertex_values).sum(axis=1) / weights.sum(axis=1)
+        # A simplex touching a sensor with no data gives no data
+        inside_values[~numpy.isfinite(inside_values)] = float('inf')
+        result[inside] = inside_values
+        return result
+
+    def interpolate_many(self, xs, ys, values=None, confidence=None):
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        points = numpy.column_stack(self.length_transform([xs.ravel(), ys.ravel()]))
+        return self.interpolate_normalized(points, values, confidence).reshape(xs.shape)
+
+    def interpolate(self, x, y):
+        return float(self.interpolate_many([x], [y])[0])
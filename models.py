@@ -1,12 +1,27 @@
+import time
+
 import numpy
 from matplotlib import pyplot as plt
+from scipy.spatial import cKDTree
 
+from heatmap import HeatField
+import instrument
 from interpolate import Interpolator
-
-def get_models(site):
-    device_hash = {}
-    sensor_hash = {}
-    sensors_by_metric = {}
+from projection import UNITY
+from stats import RunningStats
+
+# Values where interpolation gives none, outside the hull or next to a
+# sensor without data: 'idw' weights the FALLBACK_NEIGHBOURS nearest sensors
+# with data by inverse squared distance, 'nearest' takes the nearest one and
+# None leaves them inf
+FALLBACK = 'idw'
+FALLBACK_NEIGHBOURS = 4
+
+def describe_site(site):
+    """Plain description of the devices and sensors of a site, as stored in
+    a snapshot."""
+    devices = []
+    sensors = []
     for index, device_doc in enumerate(site.rels['ch:siteSummary'].devices):
         if 'geoLocation' in device_doc:
             latitude = device_doc['geoLocation']['latitude']
@@ -15,39 +30,127 @@ def get_models(site):
         else:
             latitude = longitude = elevation = None
 
-        device = Device(latitude, longitude, elevation, index)
-        device_hash[index] = device
+        devices.append({
+            'index': index,
+            'name': device_doc['name'] if 'name' in device_doc else None,
+            'latitude': latitude,
+            'longitude': longitude,
+            'elevation': elevation,
+        })
         for chain_sensor in device_doc.sensors:
-            url = chain_sensor.href
-            sensor = Sensor(url=url,
-                            metric=chain_sensor.metric,
-                            device=device)
-            sensor_hash[url] = sensor
-            if chain_sensor.metric not in sensors_by_metric:
-                sensors_by_metric[chain_sensor.metric] = []
-            sensors_by_metric[chain_sensor.metric].append(sensor)
-
-    metric_hash = {metric_name: Metric(metric_name, sensors_by_metric[metric_name]) for metric_name in sensors_by_metric}
+            sensors.append({
+                'url': chain_sensor.href,
+                'metric': chain_sensor.metric,
+                'device': index,
+            })
+
+    try:
+        stream_url = site.links['ch:websocketStream'].href
+    except KeyError:
+        stream_url = None
+
+    return {
+        'stream_url': stream_url,
+        'devices': devices,
+        'sensors': sensors,
+    }
+
+
+def merge_descriptions(descriptions):
+    """One description for several sites, given as (prefix, description)
+    pairs. Metric names get the site's prefix and device indices are offset
+    to stay unique; 'stream_urls' lists the streams of all the sites."""
+    merged = {'stream_urls': [], 'devices': [], 'sensors': []}
+    for prefix, description in descriptions:
+        offset = len(merged['devices'])
+        if description.get('stream_url'):
+            merged['stream_urls'].append(description['stream_url'])
+        for device in description['devices']:
+            device = dict(device)
+            device['index'] += offset
+            merged['devices'].append(device)
+        for sensor in description['sensors']:
+            sensor = dict(sensor)
+            sensor['metric'] = prefix + sensor['metric']
+            sensor['device'] += offset
+            merged['sensors'].append(sensor)
+    return merged
+
+
+def build_models(description, precision=0, cache_dir=None, projection=UNITY):
+    device_hash = {}
+    sensor_hash = {}
+    sensors_by_metric = {}
+    docs = description['devices']
+    xs, ys, zs = projection.project([d['latitude'] for d in docs],
+                                    [d['longitude'] for d in docs],
+                                    [d['elevation'] for d in docs])
+    for device_doc, x, y, z in zip(docs, xs, ys, zs):
+        device = Device(device_doc['latitude'], device_doc['longitude'], device_doc['elevation'], device_doc['index'],
+                        position=(float(x), float(y), float(z)))
+        device_hash[device.index] = device
+
+    for sensor_doc in description['sensors']:
+        url = sensor_doc['url']
+        sensor = Sensor(url=url,
+                        metric=sensor_doc['metric'],
+                        device=device_hash[sensor_doc['device']])
+        sensor_hash[url] = sensor
+        if sensor.metric not in sensors_by_metric:
+            sensors_by_metric[sensor.metric] = []
+        sensors_by_metric[sensor.metric].append(sensor)
+
+    metric_hash = {metric_name: Metric(metric_name, sensors_by_metric[metric_name], precision, cache_dir) for metric_name in sensors_by_metric}
 
     return metric_hash, device_hash, sensor_hash
 
+
+def get_models(site, precision=0, cache_dir=None, projection=UNITY):
+    return build_models(describe_site(site), precision, cache_dir, projection)
+
+
 class Metric(object):
-    def __init__(self, metric, sensors):
+    """The sensors of one metric across a site.
+
+    With `max_age` (seconds) set, readings older than that are left out of
+    values and aggregates, interpolating over a triangulation of the live
+    sensors that is rebuilt only when the live set changes. With
+    `half_life` (seconds) set, readings are weighted by 0.5 ** (age /
+    half_life) instead.
+
+    Positions without an interpolated value are filled in according to
+    `fallback` (see FALLBACK) from a KD-tree of the sensor positions.
+    """
+    def __init__(self, metric, sensors, precision=0, cache_dir=None, max_age=None, half_life=None,
+                 fallback=FALLBACK):
         self.metric = metric
         self.sensors = sensors
+        self.store = SensorStore(sensors)
+        self.precision = precision
+        self.max_age = max_age
+        self.half_life = half_life
+        self.fallback = fallback
+        self._tree = None
         self._norm_bounds = None
-        self.interpolator = self.generate_interpolator(sensors)
+        # Sensor positions normalized to 0-100 over the metric's bounds
+        self.normalized = numpy.column_stack(self.length_transform([self.store.x, self.store.y]))
+        self.interpolator = self.generate_interpolator(self.store, precision, cache_dir)
+        self._heat_field = None
+        self._live_mask = None
+        self._live_interpolator = None
 
     @property
     def norm_bounds(self):
         if self._norm_bounds is not None:
             return self._norm_bounds
-        points = numpy.array([[s.x, s.y] for s in self.sensors])
+        xs, ys = self.store.x, self.store.y
+        # A lone sensor, or sensors in line along an axis, have no extent
+        # along it; they normalize to 0 there instead of nan
         self._norm_bounds = (
-            min(points[:,0]),                       # origin_x
-            min(points[:,1]),                       # origin_y
-            max(points[:,0]) - min(points[:,0]),    # width
-            max(points[:,1]) - min(points[:,1])     # length
+            xs.min(),                   # origin_x
+            ys.min(),                   # origin_y
+            xs.max() - xs.min() or 1.,  # width
+            ys.max() - ys.min() or 1.   # length
         )
         return self._norm_bounds
 
@@ -57,49 +160,225 @@ class Metric(object):
     def _norm_y(self, y):
         return (y - self.norm_bounds[1]) * 100. / self.norm_bounds[3]
 
+    def length_transform(self, p):
+        # [xs, ys] in world coordinates to [xs, ys] normalized
+        return [self._norm_x(p[0]), self._norm_y(p[1])]
+
     def get_points(self, exclude_no_data=False):
+        points = numpy.column_stack((self.store.x, self.store.y))
         if exclude_no_data:
-            return numpy.array([[s.x, s.y] for s in self.sensors if s.value < float('inf')])
-        else:
-            return numpy.array([[s.x, s.y] for s in self.sensors])
+            return points[self.store.valid]
+        return points
 
     def get_values(self, exclude_no_data=False):
         if exclude_no_data:
-            return numpy.array([s.value for s in self.sensors if s.value < float('inf')])
-        else:
-            return numpy.array([s.value for s in self.sensors])
+            return self.store.value[self.store.valid]
+        return self.store.value
 
     def get_normalized_points(self, exclude_no_data=False):
-        points = self.get_points(exclude_no_data)
-        points[:,0] = self._norm_x(points[:,0])
-        points[:,1] = self._norm_y(points[:,1])
-        return points
+        if exclude_no_data:
+            return self.normalized[self.store.valid]
+        return self.normalized
 
-    def generate_interpolator(self, sensors, precision=0):
-        if len(sensors) < 4:
+    def generate_interpolator(self, store, precision=0, cache_dir=None):
+        if len(store) < 4 or store.x.min() == store.x.max() or store.y.min() == store.y.max():
             return None
-        length_transform = lambda p: [self._norm_x(p[0]), self._norm_y(p[1])]
-        interpolator = Interpolator(sensors, precision, length_transform)
-        interpolator.generate_cache(0, 100, 0, 100)
+        interpolator = Interpolator(store, precision, self.length_transform, points=self.normalized)
+        interpolator.generate_cache(0, 100, 0, 100, cache_dir)
         return interpolator
 
-    def get_value(self, x, y):
-        if not self.interpolator:
+    def set_staleness(self, max_age=None, half_life=None):
+        self.max_age = max_age
+        self.half_life = half_life
+
+    def live_interpolator(self, now=None):
+        # Interpolator over the sensors with fresh data, rebuilt only when
+        # that set changes
+        if self.max_age is None:
+            return self.interpolator
+        live = self.store.age_mask(self.max_age, now)
+        if self._live_mask is None or not numpy.array_equal(live, self._live_mask):
+            self._live_mask = live
+            indices = numpy.flatnonzero(live)
+            if len(indices) == len(self.store):
+                self._live_interpolator = self.interpolator
+            elif len(indices) < 4:
+                self._live_interpolator = None
+            else:
+                self._live_interpolator = Interpolator(self.store, self.precision, self.length_transform, indices,
+                                                       self.normalized[indices])
+        return self._live_interpolator
+
+    @property
+    def tree(self):
+        # Sensor positions only change with the site, so this is built once
+        if self._tree is None:
+            self._tree = cKDTree(numpy.column_stack((self.store.x, self.store.y)))
+        return self._tree
+
+    def get_nearest(self, xs, ys, k=1):
+        """(distances, indices) of the k nearest sensors to each position,
+        as arrays of shape (len(xs), k)."""
+        k = min(k, len(self.store))
+        points = numpy.column_stack((numpy.ravel(xs), numpy.ravel(ys))).astype(float)
+        distances, indices = self.tree.query(points, k=k)
+        return distances.reshape(len(points), k), indices.reshape(len(points), k)
+
+    def extrapolate(self, xs, ys, usable, weights=None, k=FALLBACK_NEIGHBOURS, power=2):
+        """Inverse distance weighted values of the k nearest usable sensors,
+        optionally scaled by per-sensor weights; inf if none is usable."""
+        points = numpy.column_stack((numpy.ravel(xs), numpy.ravel(ys))).astype(float)
+        result = numpy.empty(len(points))
+        result.fill(float('inf'))
+        k = min(k, int(usable.sum()))
+        if not k:
+            return result
+        # Widen the search for the points whose nearest sensors lack data
+        todo = numpy.arange(len(points))
+        query_k = k
+        while len(todo):
+            distances, indices = self.tree.query(points[todo], k=query_k)
+            distances = distances.reshape(len(todo), query_k)
+            indices = indices.reshape(len(todo), query_k)
+            ok = usable[indices]
+            done = ok.sum(axis=1) >= k
+            if query_k == len(self.store):
+                done[:] = True
+            selected = ok & (ok.cumsum(axis=1) <= k)
+            w = numpy.where(selected, 1. / numpy.maximum(distances, 1e-9) ** power, 0.)
+            if weights is not None:
+                w *= weights[indices]
+            values = numpy.where(selected, self.store.value[indices], 0.)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                filled = (w * values).sum(axis=1) / w.sum(axis=1)
+            filled[~numpy.isfinite(filled)] = float('inf')
+            result[todo[done]] = filled[done]
+            todo = todo[~done]
+            query_k = min(query_k * 2, len(self.store))
+        return result
+
+    def _interpolate(self, xs, ys):
+        now = time.time()
+        interpolator = self.live_interpolator(now)
+        confidence = None
+        if self.half_life is not None:
+            confidence = self.store.decay_weights(self.half_life, now)
+        if interpolator:
+            if confidence is not None and interpolator.indices is not None:
+                values = interpolator.interpolate_many(xs, ys, confidence=confidence[interpolator.indices])
+            else:
+                values = interpolator.interpolate_many(xs, ys, confidence=confidence)
+        elif self.fallback is None:
             raise Exception('Cannot interpolate %s' % self.metric)
-        return self.interpolator.interpolate(x, y)
+        else:
+            values = numpy.empty(numpy.shape(xs))
+            values.fill(float('inf'))
+
+        missing = ~numpy.isfinite(values)
+        if self.fallback is not None and missing.any():
+            values = numpy.array(values, dtype=float)
+            values[missing] = self._fallback(numpy.asarray(xs, dtype=float)[missing],
+                                             numpy.asarray(ys, dtype=float)[missing], now, confidence)
+        return values
+
+    def _fallback(self, xs, ys, now=None, confidence=None):
+        # Values where there is no interpolated one, according to fallback
+        usable = self.store.valid
+        if self.max_age is not None:
+            usable = self.store.age_mask(self.max_age, now)
+        if confidence is not None:
+            usable = usable & (confidence > 0)
+        k = 1 if self.fallback == 'nearest' else FALLBACK_NEIGHBOURS
+        return self.extrapolate(xs, ys, usable, confidence, k)
+
+    def _denormalize(self, points):
+        # World [xs, ys] of normalized points
+        origin_x, origin_y, width, length = self.norm_bounds
+        return [origin_x + points[:, 0] * width / 100., origin_y + points[:, 1] * length / 100.]
+
+    @instrument.timed('metric.get_value')
+    def get_value(self, x, y):
+        return float(self._interpolate([x], [y])[0])
+
+    @instrument.timed('metric.get_value_many')
+    def get_value_many(self, xs, ys):
+        return self._interpolate(xs, ys)
+
+    def _weighted_values(self):
+        # Values and weights of the readings counted at this moment, or
+        # None when every reading counts equally (the running stats apply)
+        if self.max_age is None and self.half_life is None:
+            return None
+        now = time.time()
+        weights = self.store.valid.astype(float)
+        if self.max_age is not None:
+            weights *= self.store.age_mask(self.max_age, now)
+        if self.half_life is not None:
+            weights *= self.store.decay_weights(self.half_life, now)
+        counted = weights > 0
+        return self.store.value[counted], weights[counted]
 
     def get_mean(self):
-        values = self.get_values(True)
-        return numpy.mean(values)
+        weighted = self._weighted_values()
+        if weighted is None:
+            return self.store.stats.mean
+        values, weights = weighted
+        if not len(values):
+            return float('nan')
+        return float(numpy.average(values, weights=weights))
 
     def get_std(self):
-        values = self.get_values(True)
-        return numpy.std(values)
-
-    def plot_heat_map(self):
+        weighted = self._weighted_values()
+        if weighted is None:
+            return self.store.stats.std
+        values, weights = weighted
+        if not len(values):
+            return float('nan')
+        mean = numpy.average(values, weights=weights)
+        return float(numpy.sqrt(numpy.average((values - mean) ** 2, weights=weights)))
+
+    def refresh(self):
+        # Recompute what is derived from the store after its arrays were
+        # written without set_value, e.g. by another process
+        self.store.stats.reset(self.store.value[self.store.valid])
+        if self._heat_field is not None:
+            self._heat_field.refresh()
+
+    def get_min(self):
+        return self.store.stats.min
+
+    def get_max(self):
+        return self.store.stats.max
+
+    def get_count(self):
+        return self.store.stats.count
+
+    def add_window(self, window):
+        # window is a WindowedStats or DecayedStats fed with every new value
+        self.store.windows.append(window)
+        return window
+
+    def get_heat_field(self):
+        """Heat field with the values get_value_many gives at its pixels.
+        Built on first use, then kept up to date by sensor updates; with
+        max_age or half_life set, the ages of readings change without
+        updates, so it is recomputed from the live readings on each call."""
         if not self.interpolator:
             raise Exception('Cannot interpolate %s' % self.metric)
-        self.interpolator.plot_heat_map(0, 100, 0, 100)
+        if self._heat_field is None:
+            fill = None
+            if self.fallback is not None:
+                fill = lambda points: self._fallback(*self._denormalize(points))
+            self._heat_field = HeatField(self.interpolator, 0, 100, 0, 100, self.interpolator.grid_size(), fill)
+            self.store.listeners.append(self._heat_field.update_sensor)
+        if self.max_age is not None or self.half_life is not None:
+            self._heat_field.raster[:] = self._interpolate(*self._denormalize(self._heat_field.points))
+        return self._heat_field
+
+    def plot_heat_map(self):
+        heat_field = self.get_heat_field()
+        plt.imshow(heat_field.image.T, extent=heat_field.extent, origin='lower')
+        plt.colorbar()
 
     def plot_sensors(self):
         points = self.get_normalized_points()
@@ -119,46 +398,111 @@ class Metric(object):
 
 
 class Device(object):
-    def __init__(self, latitude, longitude, elevation, index):
+    """A device and its world position (x east, y north, z up), projected
+    once; build_models projects every device in one pass and passes it in."""
+    def __init__(self, latitude, longitude, elevation, index, position=None, projection=UNITY):
         self.latitude = latitude
         self.longitude = longitude
         self.elevation = elevation
         self.index = index
+        if position is None:
+            position = projection.project_one(latitude, longitude, elevation)
+        self.x, self.y, self.z = position
 
-    # Affine Transform to match unity coordinates done in C#
-    # const float xScale = 83459.2085f;
-    # const float zScale = 109938.8055f;
-    # const float xOffset = 5890083.394f;
-    # const float zOffset = -4606524.694f;
-    # float sensorX = float.Parse(deviceJson["geoLocation"]["longitude"].ToString()) * xScale + xOffset;
-    # float sensorZ = float.Parse(deviceJson["geoLocation"]["latitude"].ToString()) * zScale + zOffset;
-    # float sensorY = (float)groundTerrain.SampleHeight(new Vector3(sensorX, 0, sensorZ)) + 0.7f;
-    @property
-    def x(self):
-        xScale = 83459.2085
-        xOffset = 5890083.394
 
-        if self.longitude is None or self.longitude == 0.0:
-            return 0.0
-        return self.longitude * xScale + xOffset
+class SensorStore(object):
+    """Columnar state for the sensors of one metric.
 
-    # Equivalent to Unity "Z" axis but we are doing 2D for now
-    @property
-    def y(self):
-        yScale = 109938.8055
-        yOffset = -4606524.694
+    Sensors are thin views holding an index into these arrays, so updates are
+    single array writes and aggregates read the arrays without copying.
+    Values without data are stored as inf and flagged in `valid`.
+    """
+    __slots__ = ('sensors', 'x', 'y', 'z', 'value', 'valid', 'timestamp', 'stats', 'windows', 'listeners')
+
+    def __init__(self, sensors):
+        size = len(sensors)
+        self.sensors = sensors
+        self.x = numpy.array([s.device.x for s in sensors], dtype=float)
+        self.y = numpy.array([s.device.y for s in sensors], dtype=float)
+        self.z = numpy.array([s.device.z for s in sensors], dtype=float)
+        self.value = numpy.empty(size, dtype=float)
+        self.value.fill(float('inf'))
+        self.valid = numpy.zeros(size, dtype=bool)
+        self.timestamp = numpy.zeros(size, dtype=float)
+
+        for index, sensor in enumerate(sensors):
+            previous = sensor.store
+            if previous is not None and previous.valid[sensor.index]:
+                self.value[index] = previous.value[sensor.index]
+                self.valid[index] = True
+                self.timestamp[index] = previous.timestamp[sensor.index]
+            sensor.store = self
+            sensor.index = index
+
+        self.stats = RunningStats(values=lambda: self.value[self.valid])
+        self.stats.reset(self.value[self.valid])
+        self.windows = []
+        # Called with the sensor index after every value change
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.sensors)
+
+    def attach(self, value, valid, timestamp):
+        # Move the state into the given arrays, e.g. views of shared memory
+        value[:] = self.value
+        valid[:] = self.valid
+        timestamp[:] = self.timestamp
+        self.value, self.valid, self.timestamp = value, valid, timestamp
+
+    def ages(self, now=None):
+        # Seconds since each sensor was last updated
+        if now is None:
+            now = time.time()
+        return now - self.timestamp
+
+    def age_mask(self, max_age, now=None):
+        return self.valid & (self.ages(now) <= max_age)
+
+    def decay_weights(self, half_life, now=None):
+        # 1 for a reading just received, halving every half_life seconds,
+        # 0 without data
+        with numpy.errstate(over='ignore'):
+            weights = numpy.exp2(-numpy.maximum(self.ages(now), 0) / half_life)
+        weights[~self.valid] = 0.
+        return weights
+
+    def set_value(self, index, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        old = self.value[index] if self.valid[index] else None
+        # Only None means no data; 0.0 is a reading
+        if value is not None:
+            self.value[index] = value
+            self.valid[index] = True
+            for window in self.windows:
+                window.add(value, timestamp)
+        else:
+            self.value[index] = float('inf')
+            self.valid[index] = False
+            value = None
+        self.timestamp[index] = timestamp
+        self.stats.replace(old, value)
+        for listener in self.listeners:
+            listener(index)
 
-        if self.latitude is None or self.latitude == 0.0:
-            return 0.0
-        return self.latitude * yScale + yOffset
-    
 
 class Sensor(object):
+    """A view of one sensor's state in the SensorStore of its metric; store
+    and index are None until a SensorStore adopts the sensor."""
+    __slots__ = ('url', 'metric', 'device', 'store', 'index')
+
     def __init__(self, url, metric, device):
         self.url = url
         self.metric = metric
         self.device = device
-        self._value = None
+        self.store = None
+        self.index = None
 
     def __hash__(self):
         return hash(self.url)
@@ -168,21 +512,22 @@ class Sensor(object):
 
     @property
     def x(self):
-        return self.device.x
+        return self.store.x[self.index]
      
     @property
     def y(self):
-        return self.device.y
+        return self.store.y[self.index]
 
     @property
     def value(self):
-        if self._value:
-            return self._value
-        else:
-            return float('inf')
+        return float(self.store.value[self.index])
     @value.setter
     def value(self, value):
-        self._value = value
+        self.store.set_value(self.index, value)
+
+    @property
+    def timestamp(self):
+        return self.store.timestamp[self.index]
 
     @property
     def data_url(self):
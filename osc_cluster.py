@@ -0,0 +1,233 @@
+"""Sharded OSC serving: metrics partitioned across worker processes.
+
+The parent builds the models of every site and moves the sensor arrays of
+each metric into shared memory before forking, so all processes see the
+same state. One ingest process is the only writer of those arrays. Each
+worker answers the requests for the metrics it owns with a RequestPipeline,
+and the parent is the OSC front end, routing every request to the worker
+that owns its metric. Replies go straight from the workers to the client;
+a batch naming metrics of several workers is split between them, so it gets
+one reply from each.
+"""
+from multiprocessing import Process, Queue, RawArray, RawValue
+from Queue import Empty
+import ctypes
+import itertools
+import logging
+import time
+
+import liblo
+import numpy
+
+from ingest import StreamIngest, apply_updates
+from osc_pipeline import OutputStage, RequestPipeline, Sender, Subscriptions, split_batch, start_pass_through
+
+logger = logging.getLogger(__name__)
+
+# Requests for the metric named by their first argument, requests any
+# worker can answer, and requests every worker answers for its own metrics
+METRIC_METHODS = [('/metric', 'sff'), ('/metric/mean', 's'), ('/metric/std', 's'), ('/metric/heat', 's'),
+                  ('/metric/nearest', 'sffi'),
+                  ('/metric/plot/heat', 's'), ('/metric/plot/scatter', 's'), ('/metric/plot/sensors', 's')]
+# Requests naming several metrics, after a tag
+BATCH_METHODS = [('/metric/batch', None), ('/metric/batch/aggregate', None)]
+ANY_METHODS = [('/device', 'i')]
+ALL_METHODS = [('/server/stats', ''), ('/stats', ''), ('/stats/profile', 'i')]
+
+
+class SharedStore(object):
+    """A SensorStore's value, valid and timestamp arrays in shared memory,
+    with a version the writer bumps after each batch of updates."""
+    def __init__(self, store):
+        size = len(store)
+        self.buffers = (RawArray(ctypes.c_double, size),
+                        RawArray(ctypes.c_bool, size),
+                        RawArray(ctypes.c_double, size))
+        self.version = RawValue(ctypes.c_ulong, 0)
+        store.attach(*[numpy.ctypeslib.as_array(b) for b in self.buffers])
+
+
+def share_models(metric_hash):
+    return dict((name, SharedStore(metric.store)) for name, metric in metric_hash.items())
+
+
+def assign_metrics(metric_hash, workers):
+    # metric -> worker, largest metrics first onto the least loaded worker
+    loads = [0] * workers
+    owners = {}
+    for name in sorted(metric_hash, key=lambda name: -len(metric_hash[name].sensors)):
+        worker = loads.index(min(loads))
+        owners[name] = worker
+        loads[worker] += len(metric_hash[name].sensors)
+    return owners
+
+
+class MethodTable(object):
+    """Stands in for a liblo.Server in RequestPipeline.add_methods, to
+    dispatch requests forwarded by the front end."""
+    def __init__(self):
+        self.handlers = {}
+
+    def add_method(self, path, types, handler):
+        self.handlers[path] = handler
+
+    def dispatch(self, path, args):
+        handler = self.handlers.get(path)
+        if handler is None:
+            logger.warning('No handler for %s', path)
+            return
+        handler(path, args)
+
+
+def drain(queue):
+    # Every request list waiting, blocking until there is one
+    requests = queue.get()
+    while True:
+        try:
+            requests.extend(queue.get_nowait())
+        except Empty:
+            return requests
+
+
+def worker_main(metric_hash, device_hash, shared, queue, address):
+    pipeline = RequestPipeline(metric_hash, device_hash, Sender(address))
+    methods = MethodTable()
+    pipeline.add_methods(methods)
+    metric_paths = set(path for path, _ in METRIC_METHODS)
+    batch_paths = set(path for path, _ in BATCH_METHODS)
+    versions = {}
+    while True:
+        requests = drain(queue)
+        # Bring the metrics about to be queried up to date with the writer
+        names = set()
+        for path, args in requests:
+            if path in metric_paths:
+                names.add(args[0])
+            elif path in batch_paths:
+                names.update(split_batch(args)[1])
+        for name in names:
+            if name in metric_hash and versions.get(name) != shared[name].version.value:
+                versions[name] = shared[name].version.value
+                metric_hash[name].refresh()
+        for path, args in requests:
+            methods.dispatch(path, args)
+        pipeline.flush()
+
+
+def ingest_main(stream_urls, sensor_hash, shared, address, output_rate, rate_limits, subscribers=()):
+    output = OutputStage(address, output_rate, rate_limits)
+
+    def mark_changed(updates):
+        for name in set(sensor.metric for sensor, _, _ in updates):
+            shared[name].version.value += 1
+
+    ingests = []
+    for stream_url in stream_urls:
+        ingest = StreamIngest(stream_url, sensor_hash)
+        ingest.subscribe(apply_updates)
+        ingest.subscribe(mark_changed)
+        ingest.subscribe(output.forward_device_data)
+        for subscriber in subscribers:
+            ingest.subscribe(subscriber)
+        ingests.append(ingest.start())
+    for ingest in ingests:
+        ingest.join()
+
+
+class ShardRouter(object):
+    """Front end handlers queueing each request for the worker owning its
+    metric; flush() hands every worker the requests of one tick at once."""
+    def __init__(self, queues, owners):
+        self.queues = queues
+        self.owners = owners
+        self.workers = itertools.cycle(range(len(queues)))
+        self.pending = [[] for _ in queues]
+
+    def route_metric(self, path, args):
+        worker = self.owners.get(args[0])
+        if worker is None:
+            logger.warning('Unknown metric %s', args[0])
+            return
+        self.pending[worker].append((path, args))
+
+    def route_batch(self, path, args):
+        tag, names, coordinates = split_batch(args)
+        by_worker = {}
+        for name in names:
+            worker = self.owners.get(name)
+            if worker is None:
+                logger.warning('Unknown metric %s', name)
+                continue
+            by_worker.setdefault(worker, []).append(name)
+        for worker, owned in by_worker.items():
+            self.pending[worker].append((path, [tag] + owned + coordinates))
+
+    def route_any(self, path, args):
+        self.pending[next(self.workers)].append((path, args))
+
+    def route_all(self, path, args):
+        for pending in self.pending:
+            pending.append((path, args))
+
+    def add_methods(self, server):
+        for methods, handler in ((METRIC_METHODS, self.route_metric),
+                                 (BATCH_METHODS, self.route_batch),
+                                 (ANY_METHODS, self.route_any),
+                                 (ALL_METHODS, self.route_all)):
+            for path, types in methods:
+                server.add_method(path, types, handler)
+
+    def flush(self):
+        for queue, requests in zip(self.queues, self.pending):
+            if requests:
+                queue.put(requests)
+        self.pending = [[] for _ in self.queues]
+
+
+def serve(models, stream_urls, workers, in_port, unity_port, address, output_rate, rate_limits,
+          subscription_threshold=0., subscribers=()):
+    """Run the sharded server; models are (metric_hash, device_hash,
+    sensor_hash) of every site, built before any thread is started.
+    `subscribers` are further StreamIngest subscribers, run by the ingest
+    process.
+    Subscriptions are answered by the front end, which sees every metric
+    through shared memory."""
+    metric_hash, device_hash, sensor_hash = models
+    shared = share_models(metric_hash)
+    owners = assign_metrics(metric_hash, workers)
+
+    processes = [Process(target=ingest_main, name='ingest',
+                         args=(stream_urls, sensor_hash, shared, address, output_rate, rate_limits,
+                               subscribers))]
+    queues = []
+    for worker in range(workers):
+        owned = dict((name, metric) for name, metric in metric_hash.items() if owners[name] == worker)
+        queue = Queue()
+        queues.append(queue)
+        processes.append(Process(target=worker_main, name='worker-%d' % worker,
+                                 args=(owned, device_hash, shared, queue, address)))
+        logger.info('Worker %d owns %s' % (worker, ', '.join(sorted(owned))))
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    output = OutputStage(address, output_rate, rate_limits)
+    versions = dict((name, store.version) for name, store in shared.items())
+    subscriptions = Subscriptions(metric_hash, output, subscription_threshold, output_rate, versions)
+    start_pass_through(unity_port, output, [subscriptions.on_pass_through])
+
+    server = liblo.Server(in_port)
+    router = ShardRouter(queues, owners)
+    router.add_methods(server)
+    subscriptions.add_methods(server)
+    checked = time.time()
+    while True:
+        server.recv(100)
+        while server.recv(0):
+            pass
+        router.flush()
+        if time.time() - checked > 1:
+            checked = time.time()
+            for process in processes:
+                if not process.is_alive():
+                    raise SystemExit('%s exited with %s' % (process.name, process.exitcode))
@@ -0,0 +1,569 @@
+from collections import OrderedDict
+from multiprocessing import Process
+from Queue import Queue
+from threading import Thread, Lock
+import logging
+import time
+
+from matplotlib import pyplot as plt
+import liblo
+import numpy
+
+import instrument
+
+logger = logging.getLogger(__name__)
+
+# instrument timer and counter of the answers to each OSC path, per tick
+HANDLER_TIMER = 'handler'
+
+
+class Sender(object):
+    """Sends OSC messages from a dedicated thread so that request handling
+    never waits on the socket."""
+    def __init__(self, address):
+        self.address = address
+        self.queue = Queue()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, path, *args):
+        self.queue.put((path, args, time.time()))
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def run(self):
+        while True:
+            path, args, queued = self.queue.get()
+            start = time.time()
+            instrument.record('osc.queue_wait', start - queued)
+            try:
+                liblo.send(self.address, path, *args)
+            except Exception:
+                logger.exception('Failed to send %s' % path)
+            instrument.record('osc.send', time.time() - start)
+
+
+class OutputStage(object):
+    """Coalescing, rate-limited OSC output for streams of updates.
+
+    Only the latest message per key is kept between ticks. Each tick the
+    pending messages that changed since they were last sent go out as OSC
+    bundles. Paths in `rate_limits` (path -> Hz) are held back until their
+    interval has passed; the stage ticks at least as fast as the highest
+    of them, so every limit can be reached. `sent` counts messages sent and `dropped` counts
+    messages overwritten or suppressed as unchanged.
+    """
+    def __init__(self, address, tick_rate=30., rate_limits=None, bundle_size=32):
+        self.address = address
+        self.interval = 1. / max([tick_rate] + (rate_limits or {}).values())
+        self.min_intervals = dict((path, 1. / hz) for path, hz in (rate_limits or {}).items())
+        self.bundle_size = bundle_size
+        self.lock = Lock()
+        self.pending = OrderedDict()
+        self.last_args = {}
+        self.last_sent = {}
+        self.sent = 0
+        self.dropped = 0
+
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, key, path, *args):
+        with self.lock:
+            if key in self.pending:
+                self.dropped += 1
+            self.pending[key] = (path, args)
+
+    def forget(self, key):
+        # Send the next message for key even if it is unchanged
+        with self.lock:
+            self.last_args.pop(key, None)
+
+    def forward_device_data(self, updates):
+        # StreamIngest subscriber sending sensor updates as /device/data
+        for sensor, value, _ in updates:
+            if value is not None:
+                self.update(('/device/data', sensor.device.index, sensor.metric),
+                            '/device/data', sensor.device.index, sensor.metric, value)
+
+    def take_due(self, now):
+        with self.lock:
+            due = []
+            held = OrderedDict()
+            for key, (path, args) in self.pending.items():
+                min_interval = self.min_intervals.get(path)
+                if min_interval is not None and now - self.last_sent.get(path, 0) < min_interval:
+                    held[key] = (path, args)
+                    continue
+                if self.last_args.get(key) == args:
+                    self.dropped += 1
+                    continue
+                self.last_args[key] = args
+                self.last_sent[path] = now
+                due.append((path, args))
+            self.pending = held
+            self.sent += len(due)
+            return due
+
+    def run(self):
+        while True:
+            start = time.time()
+            due = self.take_due(start)
+            for i in range(0, len(due), self.bundle_size):
+                messages = [liblo.Message(path, *args) for path, args in due[i:i + self.bundle_size]]
+                try:
+                    with instrument.timer('osc.send_bundle'):
+                        liblo.send(self.address, liblo.Bundle(*messages))
+                except Exception:
+                    logger.exception('Failed to send bundle')
+            time.sleep(max(self.interval - (time.time() - start), 0))
+
+
+def start_pass_through(port, output, listeners=()):
+    """Forward every OSC message received on port through output, e.g. the
+    Unity player information:
+        /player/location x y z
+        /player/angle yaw pitch roll
+        /time seconds
+    and pass them to each of `listeners` as (path, args) too.
+    """
+    def loop():
+        server = liblo.Server(port)
+
+        def pass_through(path, args):
+            logger.debug("Received data from Unity: %s : %s", path, args)
+            output.update(path, path, *args)
+            for listener in listeners:
+                listener(path, args)
+
+        server.add_method(None, None, pass_through)
+        while True:
+            server.recv(100)
+    t = Thread(target=loop)
+    t.daemon = True
+    t.start()
+    return t
+
+
+class Subscriptions(object):
+    """Pushes the values of subscribed metrics at the player's position.
+
+    A client sends /subscribe metric... [threshold] and gets
+    /subscription/data metric value through `output` whenever the value
+    moves by more than the threshold, or `threshold` without one; the
+    first value is always sent. /unsubscribe metric... stops them, all of
+    them without arguments. Values are recomputed every tick after the
+    player moved (see on_pass_through) or a subscribed metric had sensor
+    updates (see on_updates). With `versions` (metric -> shared counter,
+    see osc_cluster.SharedStore) metrics whose counter moved are refreshed
+    and recomputed instead.
+    """
+    def __init__(self, metric_hash, output, threshold=0., tick_rate=30., versions=None):
+        self.metric_hash = metric_hash
+        self.output = output
+        self.threshold = threshold
+        self.interval = 1. / tick_rate
+        self.versions = versions
+        self.seen_versions = {}
+        self.lock = Lock()
+        # metric -> threshold, and metric -> last value sent
+        self.subscribed = {}
+        self.sent = {}
+        self.position = None
+        self.moved = False
+        self.changed = set()
+
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def subscribe(self, path, args):
+        names = [arg for arg in args if isinstance(arg, basestring)]
+        thresholds = [arg for arg in args if not isinstance(arg, basestring)]
+        threshold = float(thresholds[0]) if thresholds else self.threshold
+        logger.debug("Subscribed to %s above %s", names, threshold)
+        with self.lock:
+            for name in names:
+                if name not in self.metric_hash:
+                    logger.warning("Unknown metric %s" % name)
+                    continue
+                self.subscribed[name] = threshold
+                self.sent.pop(name, None)
+                self.output.forget(('/subscription/data', name))
+                self.changed.add(name)
+
+    def unsubscribe(self, path, args):
+        with self.lock:
+            for name in args or self.subscribed.keys():
+                self.subscribed.pop(name, None)
+                self.sent.pop(name, None)
+
+    def add_methods(self, server):
+        server.add_method("/subscribe", None, self.subscribe)
+        server.add_method("/unsubscribe", None, self.unsubscribe)
+
+    def on_pass_through(self, path, args):
+        # Unity's y axis is up, so the player's z is the world y
+        if path == '/player/location' and len(args) >= 3:
+            with self.lock:
+                self.position = (float(args[0]), float(args[2]))
+                self.moved = True
+
+    def on_updates(self, updates):
+        # StreamIngest subscriber
+        with self.lock:
+            for sensor, _, _ in updates:
+                if sensor.metric in self.subscribed:
+                    self.changed.add(sensor.metric)
+
+    def take_due(self):
+        # (position, {metric: threshold}) of the metrics to recompute
+        with self.lock:
+            if self.versions is not None:
+                for name in self.subscribed:
+                    version = self.versions[name].value
+                    if self.seen_versions.get(name) != version:
+                        self.seen_versions[name] = version
+                        self.metric_hash[name].refresh()
+                        self.changed.add(name)
+            if self.moved:
+                names = self.subscribed.keys()
+            else:
+                names = [name for name in self.changed if name in self.subscribed]
+            self.moved = False
+            self.changed = set()
+            return self.position, dict((name, self.subscribed[name]) for name in names)
+
+    def push(self, position, due):
+        x, y = position
+        for name, threshold in due.items():
+            metric = self.metric_hash.get(name)
+            if metric is None:
+                continue
+            try:
+                value = float(metric.get_value(x, y))
+            except Exception:
+                logger.exception("Cannot answer %s" % name)
+                continue
+            if value == float('inf'):
+                value = float(metric.get_mean())
+            with self.lock:
+                last = self.sent.get(name)
+                if last is not None and not abs(value - last) > threshold:
+                    continue
+                self.sent[name] = value
+            self.output.update(('/subscription/data', name), '/subscription/data', name, value)
+
+    def run(self):
+        while True:
+            start = time.time()
+            position, due = self.take_due()
+            if position is not None and due:
+                with instrument.timer('subscription.push'):
+                    self.push(position, due)
+            time.sleep(max(self.interval - (time.time() - start), 0))
+
+
+def plot_metric(metric, kind):
+    plt.figure()
+    metric.plot_sensors()
+    if kind == 'heat':
+        metric.plot_heat_map()
+    elif kind == 'scatter':
+        metric.plot_scatter()
+    plt.show()
+
+
+def split_batch(args):
+    # /metric/batch arguments: tag, then metric names, then coordinates
+    metric_titles = [arg for arg in args[1:] if isinstance(arg, basestring)]
+    coordinates = [arg for arg in args[1:] if not isinstance(arg, basestring)]
+    return args[0], metric_titles, coordinates
+
+
+class RequestPipeline(object):
+    """Collects the OSC requests received during one server tick and answers
+    them together.
+
+    Duplicate /metric queries for the same metric and position are answered
+    once, and the remaining queries are interpolated as one batch per metric.
+
+    /metric/batch tag metric... x y... asks for every metric at every
+    position in one message, and is answered by one
+    /metric/batch/data tag points metric... blob, where the blob holds
+    float32 values, one row of `points` values per metric in the order
+    asked, with nan for unknown metrics. /metric/batch/aggregate tag
+    metric... is answered by /metric/batch/aggregate/data tag followed by
+    metric, mean and std for each metric known.
+    """
+    def __init__(self, metric_hash, device_hash, sender, output=None):
+        self.metric_hash = metric_hash
+        self.device_hash = device_hash
+        self.sender = sender
+        self.output = output
+        self.clear()
+
+    def clear(self):
+        self.metric_queries = OrderedDict()
+        self.aggregate_queries = OrderedDict()
+        self.device_queries = OrderedDict()
+        self.heat_queries = OrderedDict()
+        self.nearest_queries = OrderedDict()
+        self.batch_queries = OrderedDict()
+        self.batch_aggregate_queries = OrderedDict()
+
+    def pending(self):
+        return (len(self.metric_queries) + len(self.aggregate_queries) +
+                len(self.device_queries) + len(self.heat_queries) + len(self.nearest_queries) +
+                len(self.batch_queries) + len(self.batch_aggregate_queries))
+
+    # OSC handlers, called from server.recv
+    def get_metric(self, path, args):
+        metric_title, x, y = args
+        logger.debug("Received request for %s at %s, %s", metric_title, x, y)
+        self.metric_queries[(metric_title, x, y)] = None
+
+    def get_mean(self, path, args):
+        (metric_title,) = args
+        logger.debug("Received request for %s mean", metric_title)
+        self.aggregate_queries[(metric_title, 'mean')] = None
+
+    def get_std(self, path, args):
+        (metric_title,) = args
+        logger.debug("Received request for %s std", metric_title)
+        self.aggregate_queries[(metric_title, 'std')] = None
+
+    def get_device(self, path, args):
+        (index, ) = args
+        logger.debug("Recevied request for device %s", index)
+        self.device_queries[index] = None
+
+    def plot(self, kind):
+        def handler(path, args):
+            (metric_title, ) = args
+            logger.debug("Received request to plot metric %s", metric_title)
+            process = Process(target=plot_metric, args=(self.metric_hash[metric_title], kind))
+            process.daemon = True
+            process.start()
+        return handler
+
+    def get_nearest(self, path, args):
+        metric_title, x, y, k = args
+        logger.debug("Received request for %s nearest %s to %s, %s", metric_title, k, x, y)
+        self.nearest_queries[(metric_title, x, y, k)] = None
+
+    def get_batch(self, path, args):
+        tag, metric_titles, coordinates = split_batch(args)
+        if len(coordinates) % 2:
+            logger.warning("Odd number of coordinates in batch %s" % tag)
+            return
+        logger.debug("Received batch %s for %s metrics at %s positions", tag, len(metric_titles), len(coordinates) // 2)
+        self.batch_queries[(tag, tuple(metric_titles), tuple(coordinates))] = None
+
+    def get_batch_aggregate(self, path, args):
+        tag, metric_titles, _ = split_batch(args)
+        logger.debug("Received batch %s for aggregates of %s metrics", tag, len(metric_titles))
+        self.batch_aggregate_queries[(tag, tuple(metric_titles))] = None
+
+    def get_heat(self, path, args):
+        (metric_title, ) = args
+        logger.debug("Received request for %s heat map", metric_title)
+        self.heat_queries[metric_title] = None
+
+    def get_stats(self, path, args):
+        # /server/stats/data path queries mean max, from the handler timers
+        # of instrument: the mean per query and the slowest tick, in ms
+        self.sender.send('/server/queue/data', self.pending(), self.sender.depth())
+        if self.output is not None:
+            self.sender.send('/server/output/data', self.output.sent, self.output.dropped)
+        stats = instrument.snapshot()
+        for name, timer in sorted(stats['timers'].items()):
+            if name.startswith(HANDLER_TIMER):
+                queries = stats['counters'].get(name, 0)
+                mean = timer['mean_ms'] * timer['count'] / queries if queries else 0.
+                self.sender.send('/server/stats/data', name[len(HANDLER_TIMER):], queries, mean, timer['max_ms'])
+
+    def get_instrument_stats(self, path, args):
+        # /stats/timer name count mean p50 p99 max (ms), /stats/counter name n
+        stats = instrument.snapshot()
+        for name, timer in sorted(stats['timers'].items()):
+            self.sender.send('/stats/timer', name, timer['count'], timer['mean_ms'],
+                             timer['p50_ms'], timer['p99_ms'], timer['max_ms'])
+        for name, n in sorted(stats['counters'].items()):
+            self.sender.send('/stats/counter', name, n)
+
+    def set_profiling(self, path, args):
+        # /stats/profile 1 starts sampling, 0 stops it and sends the
+        # hottest lines as /stats/profile/data location samples
+        (on, ) = args
+        instrument.set_profiling(on)
+        if not on:
+            for location, samples in instrument.profiler.top():
+                self.sender.send('/stats/profile/data', location, samples)
+
+    def add_methods(self, server):
+        server.add_method("/metric", 'sff', self.get_metric)
+        server.add_method("/device", 'i', self.get_device)
+        server.add_method("/metric/plot/heat", 's', self.plot('heat'))
+        server.add_method("/metric/plot/scatter", 's', self.plot('scatter'))
+        server.add_method("/metric/plot/sensors", 's', self.plot('sensors'))
+        server.add_method("/metric/mean", 's', self.get_mean)
+        server.add_method("/metric/std", 's', self.get_std)
+        server.add_method("/metric/heat", 's', self.get_heat)
+        server.add_method("/metric/nearest", 'sffi', self.get_nearest)
+        server.add_method("/metric/batch", None, self.get_batch)
+        server.add_method("/metric/batch/aggregate", None, self.get_batch_aggregate)
+        server.add_method("/server/stats", '', self.get_stats)
+        server.add_method("/stats", '', self.get_instrument_stats)
+        server.add_method("/stats/profile", 'i', self.set_profiling)
+
+    # Batched evaluation
+    def flush(self):
+        metric_queries = self.metric_queries
+        aggregate_queries = self.aggregate_queries
+        device_queries = self.device_queries
+        heat_queries = self.heat_queries
+        nearest_queries = self.nearest_queries
+        batch_queries = self.batch_queries
+        batch_aggregate_queries = self.batch_aggregate_queries
+        self.clear()
+
+        for path, queries, answer in (
+                ('/metric', metric_queries, self.answer_metrics),
+                ('/metric/aggregate', aggregate_queries, self.answer_aggregates),
+                ('/device', device_queries, self.answer_devices),
+                ('/metric/heat', heat_queries, self.answer_heat),
+                ('/metric/nearest', nearest_queries, self.answer_nearest),
+                ('/metric/batch', batch_queries, self.answer_batches),
+                ('/metric/batch/aggregate', batch_aggregate_queries, self.answer_batch_aggregates)):
+            if queries:
+                with instrument.timer(HANDLER_TIMER + path):
+                    answer(queries.keys())
+                instrument.count(HANDLER_TIMER + path, len(queries))
+
+    def answer_metrics(self, queries):
+        by_metric = OrderedDict()
+        for metric_title, x, y in queries:
+            by_metric.setdefault(metric_title, []).append((x, y))
+
+        for metric_title, positions in by_metric.items():
+            metric = self.metric_hash.get(metric_title)
+            if metric is None:
+                logger.warning("Unknown metric %s" % metric_title)
+                continue
+            xs, ys = numpy.array(positions, dtype=float).T
+            try:
+                values = metric.get_value_many(xs, ys)
+            except Exception:
+                logger.exception("Cannot answer %s" % metric_title)
+                continue
+            for (x, y), value in zip(positions, values):
+                if value == float('inf'):
+                    value = metric.get_mean()
+                    logger.warning("No data for %s at %s, %s. Sending mean instead" % (metric_title, x, y))
+                self.sender.send('/metric/data', metric_title, float(value))
+
+    def answer_nearest(self, queries):
+        # /metric/nearest/data metric x y followed by device index, distance
+        # and value (inf without data) of each of the k nearest sensors
+        by_metric = OrderedDict()
+        for metric_title, x, y, k in queries:
+            by_metric.setdefault((metric_title, k), []).append((x, y))
+
+        for (metric_title, k), positions in by_metric.items():
+            metric = self.metric_hash.get(metric_title)
+            if metric is None:
+                logger.warning("Unknown metric %s" % metric_title)
+                continue
+            xs, ys = numpy.array(positions, dtype=float).T
+            distances, indices = metric.get_nearest(xs, ys, max(k, 1))
+            values = metric.store.value[indices]
+            for (x, y), row_distances, row_indices, row_values in zip(positions, distances, indices, values):
+                args = [metric_title, x, y]
+                for distance, index, value in zip(row_distances, row_indices, row_values):
+                    args.extend((metric.sensors[index].device.index, float(distance), float(value)))
+                self.sender.send('/metric/nearest/data', *args)
+
+    def answer_batches(self, queries):
+        # Every position asked of a metric in this tick, across all batches,
+        # is interpolated in one call
+        positions = OrderedDict()
+        for _, metric_titles, coordinates in queries:
+            for metric_title in metric_titles:
+                positions.setdefault(metric_title, []).extend(coordinates)
+
+        values = {}
+        for metric_title, coordinates in positions.items():
+            metric = self.metric_hash.get(metric_title)
+            if metric is None:
+                logger.warning("Unknown metric %s" % metric_title)
+                continue
+            xs, ys = numpy.array(coordinates, dtype=float).reshape(-1, 2).T
+            try:
+                metric_values = metric.get_value_many(xs, ys)
+            except Exception:
+                logger.exception("Cannot answer %s" % metric_title)
+                continue
+            metric_values[metric_values == float('inf')] = metric.get_mean()
+            values[metric_title] = iter(metric_values)
+
+        for tag, metric_titles, coordinates in queries:
+            points = len(coordinates) // 2
+            rows = numpy.full((len(metric_titles), points), numpy.nan, dtype='<f4')
+            for row, metric_title in zip(rows, metric_titles):
+                if metric_title in values:
+                    row[:] = [next(values[metric_title]) for _ in range(points)]
+            args = [tag, points] + list(metric_titles) + [('b', bytearray(rows.tobytes()))]
+            self.sender.send('/metric/batch/data', *args)
+
+    def answer_batch_aggregates(self, queries):
+        for tag, metric_titles in queries:
+            args = [tag]
+            for metric_title in metric_titles:
+                metric = self.metric_hash.get(metric_title)
+                if metric is None:
+                    logger.warning("Unknown metric %s" % metric_title)
+                    continue
+                args.extend((metric_title, float(metric.get_mean()), float(metric.get_std())))
+            self.sender.send('/metric/batch/aggregate/data', *args)
+
+    def answer_aggregates(self, queries):
+        for metric_title, statistic in queries:
+            metric = self.metric_hash.get(metric_title)
+            if metric is None:
+                logger.warning("Unknown metric %s" % metric_title)
+                continue
+            if statistic == 'mean':
+                self.sender.send('/metric/mean/data', metric_title, float(metric.get_mean()))
+            else:
+                self.sender.send('/metric/std/data', metric_title, float(metric.get_std()))
+
+    def answer_devices(self, indices):
+        for index in indices:
+            device = self.device_hash.get(index)
+            if device is None:
+                logger.warning("Unknown device %s" % index)
+                continue
+            self.sender.send('/device/location', device.index, device.x, device.y)
+
+    def answer_heat(self, metric_titles):
+        # /metric/heat/data metric width height min max blob, where the blob
+        # is HeatField.to_bytes()
+        for metric_title in metric_titles:
+            metric = self.metric_hash.get(metric_title)
+            if metric is None:
+                logger.warning("Unknown metric %s" % metric_title)
+                continue
+            try:
+                heat_field = metric.get_heat_field()
+            except Exception:
+                logger.exception("Cannot answer %s" % metric_title)
+                continue
+            raster = heat_field.filled()
+            low, high = heat_field.value_range(raster)
+            width, height = heat_field.shape
+            self.sender.send('/metric/heat/data', metric_title, width, height, low, high,
+                             ('b', bytearray(heat_field.to_bytes(raster))))
@@ -1,18 +1,14 @@
-from multiprocessing import Process, Pipe, Manager
-from threading import Thread
-import itertools
-import json
-
-import chainclient
-from chainclient import HALDoc
-from websocket import create_connection
-from matplotlib import pyplot as plt
+import argparse
+
 import coloredlogs
 import logging
-import numpy
 import liblo
 
-from models import get_models
+from aggregator_script import stats_subscriber
+import osc_cluster
+from snapshot import load_description, load_models, load_sites, replace_models, site_dir
+from ingest import StreamIngest, apply_updates
+from osc_pipeline import OutputStage, RequestPipeline, Sender, Subscriptions, start_pass_through
 
 logger = logging.getLogger(__name__)
 coloredlogs.install(level=logging.INFO)
@@ -20,62 +16,79 @@ coloredlogs.install(level=logging.INFO)
 
 # parameters
 SITE_URL= 'http://chain-api.media.mit.edu/sites/7'
+# Websocket stream to ingest, or None for the streams of the sites
+STREAM_URL = 'ws://localhost:8000/'
 OSC_IN_PORT = 5553
 OSC_OUT_PORT = 5555
 OSC_UNITY_PORT = 5554
+# Ticks per second of the coalesced /device/data and Unity pass-through
+# output, and the highest rate of individual paths in it; the output ticks
+# at least as fast as the highest of those
+OSC_OUTPUT_RATE = 30
+OSC_RATE_LIMITS = {'/player/location': 60, '/player/angle': 60}
+# Seconds after which a sensor's last reading is ignored, or None to keep
+# every reading; and the half-life weighting readings by age, or None
+SENSOR_MAX_AGE = None
+SENSOR_HALF_LIFE = None
+# Change in a subscribed metric's value below which it is not pushed, for
+# subscriptions that do not set their own
+SUBSCRIPTION_THRESHOLD = 0.
 
 outgoing_addr = liblo.Address(OSC_OUT_PORT)
 
 def main():
-    # Set up Chain Objects
-    site = chainclient.get(SITE_URL)
-    metric_hash, device_hash, sensor_hash = get_models(site)
-
+    parser = argparse.ArgumentParser(description='OSC interface to live sensor data')
+    parser.add_argument('--site', action='append', dest='sites',
+                        help='chain-api site to serve, repeat for several; metrics are then named <site id>/<metric>')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='processes to partition the metrics across, 0 to serve in this process')
+    parser.add_argument('--aggregate', action='store_true',
+                        help='also keep the aggregate statistics of aggregator_script, on this server\'s stream')
+    args = parser.parse_args()
+    sites = args.sites or [SITE_URL]
+
+    # Set up Chain Objects, from the local snapshot when there is one.
+    # Sharded state cannot be swapped in place, so sharded servers use the
+    # snapshots as they are
+    if len(sites) == 1 and not args.workers:
+        models = load_models(sites[0])
+        stream_urls = [load_description(sites[0])[0]['stream_url']]
+    else:
+        models, stream_urls = load_sites(sites, on_change=None if args.workers else replace_models)
+    metric_hash, device_hash, sensor_hash = models
+    for metric in metric_hash.values():
+        metric.set_staleness(SENSOR_MAX_AGE, SENSOR_HALF_LIFE)
 
     # Pass through websocket events from chainAPI
-    def get_ws_values_loop():
-        if True:
-            stream_url = 'ws://localhost:8000/'
-        else:
-            stream_url = site.links['ch:websocketStream'].href
-        logger.info('Connecting to %s' % stream_url)
-        ws = create_connection(stream_url)
-        logger.info('Connected!')
-        while True:
-            resource_data = ws.recv()
-            logger.debug(resource_data)
-            in_data = HALDoc(json.loads(resource_data))
-            try:
-                sensor = sensor_hash[in_data.links['ch:sensor'].href]
-            except KeyError:
-                logger.warning('Hash miss: %s' % in_data.links['ch:sensor'].href)
-                continue
-            logger.debug('Received value of %f from sensor %s' % (in_data.value, sensor))
-            sensor.value = in_data.value
-            liblo.send(outgoing_addr, '/device/data', sensor.device.index, sensor.metric, in_data.value)
-    t = Thread(target=get_ws_values_loop)
-    t.daemon = True
-    t.start()
-
-
-    # OSC Server to pass through Unity player information
-    # /player/location x y z
-    # /player/angle yaw pitch roll
-    # /time seconds
-    def osc_pass_through_loop():
-        server = liblo.Server(OSC_UNITY_PORT)
-
-        def pass_through(path, args):
-            logger.info("Received data from Unity: %s : %s" % (path, args))
-            liblo.send(outgoing_addr, path, *args)
-
-        server.add_method(None, None, pass_through)
-        while True:
-            server.recv(100)
-    t2 = Thread(target=osc_pass_through_loop)
-    t2.daemon = True
-    t2.start()
-
+    if STREAM_URL is not None:
+        stream_urls = [STREAM_URL]
+
+    # The aggregator as a subscriber, so the stream is consumed once
+    subscribers = []
+    if args.aggregate:
+        for site in sites:
+            description = load_description(site, site_dir(site, sites))[0]
+            subscribers.append(stats_subscriber(description)[1])
+
+    if args.workers:
+        osc_cluster.serve(models, stream_urls, args.workers, OSC_IN_PORT, OSC_UNITY_PORT,
+                          outgoing_addr, OSC_OUTPUT_RATE, OSC_RATE_LIMITS, SUBSCRIPTION_THRESHOLD, subscribers)
+        return
+
+    output = OutputStage(outgoing_addr, OSC_OUTPUT_RATE, OSC_RATE_LIMITS)
+    subscriptions = Subscriptions(metric_hash, output, SUBSCRIPTION_THRESHOLD, OSC_OUTPUT_RATE)
+    for stream_url in stream_urls:
+        ingest = StreamIngest(stream_url, sensor_hash)
+        ingest.subscribe(apply_updates)
+        ingest.subscribe(output.forward_device_data)
+        ingest.subscribe(subscriptions.on_updates)
+        for subscriber in subscribers:
+            ingest.subscribe(subscriber)
+        ingest.start()
+
+    # OSC Server to pass through Unity player information, which also
+    # moves the position subscriptions are answered at
+    start_pass_through(OSC_UNITY_PORT, output, [subscriptions.on_pass_through])
 
     # OSC Server to communicated with Music client
     try:
@@ -83,74 +96,17 @@ def main():
     except liblo.ServerError, err:
         print str(err)
 
-    def get_metric(path, args):
-        metric_title, x, y = args
-        logger.debug("Received request for %s at %s, %s" % (metric_title, x ,y))
-        metric = metric_hash[metric_title]
-        value = metric.get_value(x,y)
-        if value != float('inf'):
-            liblo.send(outgoing_addr, '/metric/data', metric_title, value)
-        else:
-            value = metric.get_mean()
-            liblo.send(outgoing_addr, '/metric/data', metric_title, value)
-            logger.warning("No data for %s at %s, %s. Sending mean instead" % (metric_title, x, y))
-
-    def get_mean(path, args):
-        (metric_title,) = args
-        logger.debug("Received request for %s mean" % (metric_title))
-        metric = metric_hash[metric_title]
-        value = metric.get_mean()
-        liblo.send(outgoing_addr, '/metric/mean/data', metric_title, value)
-
-    def get_std(path, args):
-        (metric_title,) = args
-        logger.debug("Received request for %s std" % (metric_title))
-        metric = metric_hash[metric_title]
-        value = metric.get_std()
-        liblo.send(outgoing_addr, '/metric/std/data', metric_title, value)
-    
-    def get_device(path, args):
-        (index, ) = args
-        logger.debug("Recevied request for device %s" % index)
-        device = device_hash[index]
-        liblo.send(outgoing_addr, '/device/location', device.index, device.x, device.y)
-
-    def plot_heat(path, args):
-        (metric_title, ) = args
-        logger.debug("Received request to plot metric %s" % metric_title)
-        metric = metric_hash[metric_title]
-        plt.figure()
-        metric.plot_sensors()
-        metric.plot_heat_map()
-        plt.show()
-
-    def plot_scatter(path, args):
-        (metric_title, ) = args
-        logger.debug("Received request to plot metric %s" % metric_title)
-        metric = metric_hash[metric_title]
-        plt.figure()
-        metric.plot_sensors()
-        metric.plot_scatter()
-        plt.show()
-
-    def plot_sensors(path, args):
-        (metric_title, ) = args
-        logger.debug("Received request to plot metric %s" % metric_title)
-        metric = metric_hash[metric_title]
-        plt.figure()
-        metric.plot_sensors()
-        plt.show()
-
-    server.add_method("/metric", 'sff', get_metric)
-    server.add_method("/device", 'i', get_device)
-    server.add_method("/metric/plot/heat", 's', plot_heat)
-    server.add_method("/metric/plot/scatter", 's', plot_scatter)
-    server.add_method("/metric/plot/sensors", 's', plot_sensors)
-    server.add_method("/metric/mean", 's', get_mean)
-    server.add_method("/metric/std", 's', get_std)
+    pipeline = RequestPipeline(metric_hash, device_hash, Sender(outgoing_addr), output)
+    pipeline.add_methods(server)
+    subscriptions.add_methods(server)
 
+    # Drain every pending message each tick so duplicate queries coalesce,
+    # then answer them as one batch
     while True:
         server.recv(100)
+        while server.recv(0):
+            pass
+        pipeline.flush()
 
 if __name__ == "__main__":
     main()
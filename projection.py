@@ -0,0 +1,44 @@
+import numpy
+
+
+class Projection(object):
+    """Affine transform from geographic to world coordinates, where x is
+    east, y north and z up. A latitude or longitude that is missing or 0
+    projects to 0, as devices without a location have them 0; a missing
+    elevation counts as 0."""
+    def __init__(self, x_scale, x_offset, y_scale, y_offset, z_scale=1., z_offset=0.):
+        self.x_scale = x_scale
+        self.x_offset = x_offset
+        self.y_scale = y_scale
+        self.y_offset = y_offset
+        self.z_scale = z_scale
+        self.z_offset = z_offset
+
+    def project(self, latitudes, longitudes, elevations):
+        """(xs, ys, zs) arrays of world coordinates, in one pass."""
+        def axis(values, scale, offset):
+            values = numpy.array([numpy.nan if v is None else v for v in values], dtype=float)
+            known = numpy.isfinite(values) & (values != 0)
+            return numpy.where(known, values * scale + offset, 0.)
+        zs = numpy.array([0. if v is None else v for v in elevations], dtype=float)
+        return (axis(longitudes, self.x_scale, self.x_offset),
+                axis(latitudes, self.y_scale, self.y_offset),
+                zs * self.z_scale + self.z_offset)
+
+    def project_one(self, latitude, longitude, elevation):
+        return tuple(float(c[0]) for c in self.project([latitude], [longitude], [elevation]))
+
+
+# Affine Transform to match unity coordinates done in C#, where our y is the
+# Unity Z axis and z the Unity Y axis
+# const float xScale = 83459.2085f;
+# const float zScale = 109938.8055f;
+# const float xOffset = 5890083.394f;
+# const float zOffset = -4606524.694f;
+# float sensorX = float.Parse(deviceJson["geoLocation"]["longitude"].ToString()) * xScale + xOffset;
+# float sensorZ = float.Parse(deviceJson["geoLocation"]["latitude"].ToString()) * zScale + zOffset;
+# float sensorY = (float)groundTerrain.SampleHeight(new Vector3(sensorX, 0, sensorZ)) + 0.7f;
+# Unity samples the terrain for the height; the reported elevation stands in
+UNITY = Projection(x_scale=83459.2085, x_offset=5890083.394,
+                   y_scale=109938.8055, y_offset=-4606524.694,
+                   z_scale=1., z_offset=0.7)
@@ -0,0 +1,381 @@
+from threading import Condition, RLock
+import bisect
+import datetime
+import json
+import logging
+import math
+import time
+
+import numpy
+import pytz
+
+import instrument
+from util import MILLISECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def format_timestamp(ms):
+    t = datetime.datetime.utcfromtimestamp(ms / float(MILLISECONDS)).replace(tzinfo=pytz.utc)
+    return str(t)
+
+
+class PseudoClock:
+    # Times are unix seconds; a time_scale of 0 means paused
+    def start(self, start_time=1415491200, time_scale=1):
+        self.time_scale = time_scale
+        self.local_start_time = self.local_now()
+        self.pseudo_start_time = start_time
+
+    def local_now(self):
+        return time.time()
+
+    def pseudo_now(self):
+        pseudo_elapsed_time = (self.local_now() - self.local_start_time) * self.time_scale
+        return self.pseudo_start_time + pseudo_elapsed_time
+
+    def local_delay(self, pseudo_time):
+        # Local seconds until the clock reaches pseudo_time, None if never
+        remaining = pseudo_time - self.pseudo_now()
+        if remaining <= 0:
+            return 0
+        if self.time_scale <= 0:
+            return None
+        return remaining / float(self.time_scale)
+
+
+class Event:
+    def __init__(self, sensor, time, value):
+        self.sensor = sensor
+        self.time = time
+        self.value = value
+
+    def __repr__(self):
+        return '<event time=%s value=%s>' % (format_timestamp(self.time), self.value)
+
+    def to_dict(self):
+        return {
+            'timestamp': format_timestamp(self.time),
+            '_links': {
+                'self': {
+                    'href': 'http://chain-api.media.mit.edu/scalar_data/'
+                },
+                'ch:sensor': {
+                    'href': self.sensor.url
+                }
+            },
+            'value': self.value
+        }
+
+
+class Timeline(object):
+    """The events of one chunk for all sensors, merged into time order."""
+    def __init__(self, start, series):
+        self.start = start
+        series = [s for s in series if len(s[1])]
+        if series:
+            times = numpy.concatenate([s[1] for s in series]).astype(numpy.int64)
+            values = numpy.concatenate([s[2] for s in series])
+            owners = numpy.concatenate([numpy.repeat(i, len(s[1])) for i, s in enumerate(series)])
+            # Each sensor's series is already sorted, so a stable merge sort
+            # only has to merge the k runs
+            order = numpy.argsort(times, kind='mergesort')
+            self.times, self.values, owners = times[order], values[order], owners[order]
+            self.sensors = numpy.array([s[0] for s in series], dtype=object)[owners]
+        else:
+            self.times = numpy.empty(0, dtype=numpy.int64)
+            self.values = numpy.empty(0)
+            self.sensors = numpy.empty(0, dtype=object)
+        self.position = 0
+
+    def __len__(self):
+        return len(self.times) - self.position
+
+    def rewind(self, from_ms):
+        self.position = int(numpy.searchsorted(self.times, from_ms))
+
+    def next_time(self):
+        return self.times[self.position]
+
+    def pop_until(self, end_ms):
+        start = self.position
+        self.position = max(int(numpy.searchsorted(self.times, end_ms, side='right')), start)
+        return [Event(sensor, int(t), float(v)) for sensor, t, v in zip(
+            self.sensors[start:self.position], self.times[start:self.position], self.values[start:self.position])]
+
+
+class EventScheduler(object):
+    """Emits the merged events of fetched chunks when they become due
+    according to a PseudoClock.
+
+    Chunks are kept ordered by their start time whatever order they arrive
+    in. wait_due sleeps until the next event is due, or until the schedule
+    changes, and returns every event due at that point as one batch.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.condition = Condition()
+        self.timelines = []
+        self.origin_ms = None
+
+    def add_chunk(self, start, series):
+        self.add_timeline(Timeline(start, series))
+
+    def add_timeline(self, timeline):
+        with self.condition:
+            if self.origin_ms is not None:
+                timeline.rewind(self.origin_ms)
+            if len(timeline):
+                starts = [t.start for t in self.timelines]
+                self.timelines.insert(bisect.bisect(starts, timeline.start), timeline)
+            self.condition.notify_all()
+
+    def reset(self, from_ms, timelines=()):
+        # Replay kept timelines from from_ms, dropping everything else
+        with self.condition:
+            self.origin_ms = from_ms
+            self.timelines = []
+            for timeline in sorted(timelines, key=lambda t: t.start):
+                timeline.rewind(from_ms)
+                if len(timeline):
+                    self.timelines.append(timeline)
+            self.condition.notify_all()
+
+    def clear(self):
+        self.reset(None)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def pending(self):
+        with self.condition:
+            return sum(len(t) for t in self.timelines)
+
+    def next_time(self):
+        while self.timelines and not len(self.timelines[0]):
+            self.timelines.pop(0)
+        if not self.timelines:
+            return None
+        return self.timelines[0].next_time()
+
+    def pop_due(self):
+        now_ms = self.clock.pseudo_now() * MILLISECONDS
+        events = []
+        while self.next_time() is not None and self.next_time() <= now_ms:
+            events.extend(self.timelines[0].pop_until(now_ms))
+        return events
+
+    def wait_due(self, idle_timeout=1.):
+        with self.condition:
+            while True:
+                next_time = self.next_time()
+                delay = None
+                if next_time is not None:
+                    delay = self.clock.local_delay(next_time / float(MILLISECONDS))
+                if delay is None:
+                    self.condition.wait(idle_timeout)
+                    return []
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                return self.pop_due()
+
+
+def parse_command(message):
+    """Parse a control message into (name, argument), or None if invalid."""
+    try:
+        command = json.loads(message)
+        if isinstance(command, (int, float)) and not isinstance(command, bool):
+            return 'seek', finite(command)
+        name = command['command']
+        if name == 'seek':
+            return name, finite(command['time'])
+        if name == 'speed':
+            scale = finite(command['scale'])
+            if scale <= 0:
+                raise ValueError('speed must be positive')
+            return name, scale
+        if name in ('pause', 'play'):
+            return name, None
+        logger.warning('Unknown command %r' % message)
+    except (KeyError, TypeError, ValueError):
+        logger.warning('Ignoring malformed command %r' % message)
+    return None
+
+
+def finite(number):
+    # A finite float, ValueError or TypeError otherwise
+    if isinstance(number, bool):
+        raise TypeError('%r is not a number' % (number,))
+    number = float(number)
+    if math.isnan(number) or math.isinf(number):
+        raise ValueError('%r is not finite' % (number,))
+    return number
+
+
+class ReplaySession(object):
+    """One client's replay of sensor history.
+
+    Chunks of history are prefetched CHUNK_LENGTH-aligned, far enough ahead
+    of the playhead to cover `buffer_time` local seconds at the current
+    speed. Seeking keeps the fetched chunks inside the new window and only
+    fetches the rest.
+
+    When the source serves rollups (rollup.RollupSource), fast replays are
+    fetched at the coarsest level the speed allows, one event per bucket.
+
+    Clients control the session with JSON messages over the websocket,
+    parsed by parse_command and passed to apply:
+        {"command": "seek", "time": <unix seconds>}
+        {"command": "pause"}
+        {"command": "play"}
+        {"command": "speed", "scale": <pseudo seconds per second>}
+    A bare number is treated as a seek, as sent by older clients.
+    """
+    def __init__(self, source, sensors, start_time, time_scale=1,
+                 chunk_length=2000, look_ahead=1000, buffer_time=10, retry_delay=5):
+        self.source = source
+        self.sensors = sensors
+        self.chunk_length = chunk_length
+        self.min_look_ahead = look_ahead
+        self.buffer_time = buffer_time
+        self.retry_delay = retry_delay
+
+        self.lock = RLock()
+        self.wake = Condition(self.lock)
+        self.running = True
+        self.chunks = {}
+        self.speed = time_scale
+        self.paused = False
+        self.level = self.level_for(time_scale)
+
+        self.clock = PseudoClock()
+        self.clock.start(start_time=start_time, time_scale=time_scale)
+        self.scheduler = EventScheduler(self.clock)
+        self.scheduler.reset(start_time * MILLISECONDS)
+
+    def level_for(self, time_scale):
+        level_for = getattr(self.source, 'level_for', None)
+        return level_for(time_scale) if level_for is not None else 0
+
+    def fetch(self, chunk_start, level):
+        end = chunk_start + self.chunk_length
+        if level:
+            return self.source.fetch_series(self.sensors, chunk_start, end, level=level)
+        return self.source.fetch_series(self.sensors, chunk_start, end)
+
+    def look_ahead(self):
+        return max(self.min_look_ahead, self.speed * self.buffer_time)
+
+    def window(self):
+        now = self.clock.pseudo_now()
+        start = int(now // self.chunk_length) * self.chunk_length
+        return start, now + self.look_ahead()
+
+    def missing_chunk(self):
+        # Earliest chunk in the window that is neither fetched nor in the future
+        start, end = self.window()
+        for chunk_start in range(start, int(end) + 1, self.chunk_length):
+            if chunk_start >= self.clock.local_now():
+                return None
+            if chunk_start not in self.chunks:
+                return chunk_start
+        return None
+
+    def next_fetch_delay(self):
+        # Local seconds until missing_chunk has a chunk to return: until the
+        # earliest unfetched chunk of the window begins, or else until the
+        # next chunk enters the window; None while paused
+        start, end = self.window()
+        for chunk_start in range(start, int(end) + 1, self.chunk_length):
+            if chunk_start not in self.chunks:
+                return max(chunk_start - self.clock.local_now(), 0.)
+        next_start = start + ((int(end) - start) // self.chunk_length + 1) * self.chunk_length
+        return self.clock.local_delay(next_start - self.look_ahead())
+
+    def fetch_loop(self):
+        while self.running:
+            with self.lock:
+                chunk_start = self.missing_chunk()
+                if chunk_start is None:
+                    self.drop_chunks_outside_window()
+                    self.wake.wait(self.next_fetch_delay())
+                    continue
+                generation = self.scheduler.origin_ms
+                level = self.level
+            try:
+                with instrument.timer('replay.fetch_chunk'):
+                    series = self.fetch(chunk_start, level)
+            except Exception:
+                # Leave the chunk missing and try again
+                logger.exception('Failed to fetch chunk %s' % chunk_start)
+                with self.lock:
+                    self.wake.wait(self.retry_delay)
+                continue
+            timeline = Timeline(chunk_start, series)
+            with self.lock:
+                # Discard a chunk that a seek moved out of the window while
+                # it was being fetched, or fetched at another level
+                start, end = self.window()
+                if self.scheduler.origin_ms != generation and not start <= chunk_start <= end:
+                    continue
+                if level != self.level:
+                    continue
+                self.chunks[chunk_start] = timeline
+                self.scheduler.add_timeline(timeline)
+
+    def drop_chunks_outside_window(self):
+        start, end = self.window()
+        for chunk_start in self.chunks.keys():
+            if not start <= chunk_start <= end:
+                del self.chunks[chunk_start]
+
+    def seek(self, start_time):
+        with self.lock:
+            self.clock.start(start_time=start_time, time_scale=self.clock.time_scale)
+            self.drop_chunks_outside_window()
+            self.scheduler.reset(start_time * MILLISECONDS, self.chunks.values())
+            self.wake.notify_all()
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+            self.clock.start(start_time=self.clock.pseudo_now(), time_scale=0)
+            self.scheduler.notify()
+
+    def play(self):
+        with self.lock:
+            self.paused = False
+            self.set_speed(self.speed)
+
+    def set_speed(self, time_scale):
+        with self.lock:
+            self.speed = time_scale
+            if not self.paused:
+                self.clock.start(start_time=self.clock.pseudo_now(), time_scale=time_scale)
+            level = self.level_for(time_scale)
+            if level != self.level:
+                # Refetch from the playhead at the new level
+                self.level = level
+                self.chunks.clear()
+                self.scheduler.reset(self.clock.pseudo_now() * MILLISECONDS)
+            self.scheduler.notify()
+            self.wake.notify_all()
+
+    def apply(self, name, argument):
+        # A command parsed by parse_command
+        if name == 'seek':
+            self.seek(argument)
+        elif name == 'pause':
+            self.pause()
+        elif name == 'play':
+            self.play()
+        elif name == 'speed':
+            self.set_speed(argument)
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.wake.notify_all()
+        self.scheduler.notify()
@@ -0,0 +1,300 @@
+from collections import deque
+from threading import Condition, Lock, Thread
+import json
+import logging
+import struct
+import time
+
+import numpy
+
+import instrument
+from replay import ReplaySession, parse_command
+
+logger = logging.getLogger(__name__)
+
+# What a subscriber does when its buffer is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+
+
+def start_thread(target):
+    t = Thread(target=target)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def encode_json(events):
+    return json.dumps([event.to_dict() for event in events])
+
+
+class BinaryEncoder(object):
+    """Compact encoding of replay frames, for clients that ask for it.
+
+    A client first gets dictionary() as JSON text, listing sensor urls by
+    index, and dictionary(first) with those added since whenever a frame
+    refers to them. Each
+    frame is then a little-endian int64 time of its first event (epoch ms)
+    and uint32 count, followed by one record per event of a uint32 sensor
+    index, uint32 milliseconds since the previous event and float32 value.
+    """
+    header = struct.Struct('<qI')
+    record = numpy.dtype([('sensor', '<u4'), ('delta', '<u4'), ('value', '<f4')])
+
+    def __init__(self, sensors=()):
+        self.lock = Lock()
+        self.urls = []
+        self.indices = {}
+        for sensor in sensors:
+            self.index(sensor.url)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def index(self, url):
+        index = self.indices.get(url)
+        if index is None:
+            with self.lock:
+                index = self.indices.setdefault(url, len(self.urls))
+                if index == len(self.urls):
+                    self.urls.append(url)
+        return index
+
+    def dictionary(self, first=0, end=None):
+        return json.dumps({'format': 'binary', 'first': first, 'sensors': self.urls[first:end]})
+
+    def __call__(self, events):
+        if not events:
+            return self.header.pack(0, 0)
+        times = numpy.array([event.time for event in events], dtype=numpy.int64)
+        records = numpy.empty(len(events), dtype=self.record)
+        records['sensor'] = [self.index(event.sensor.url) for event in events]
+        records['delta'] = numpy.concatenate(([0], numpy.diff(times)))
+        records['value'] = [event.value for event in events]
+        return self.header.pack(times[0], len(events)) + records.tobytes()
+
+
+class Subscriber(object):
+    """A client of the hub with a bounded buffer of frames to send.
+
+    A client that falls behind has frames dropped, oldest or newest first,
+    or with the coalesce policy the buffered frames are merged into one
+    holding the latest event of each sensor.
+    """
+    def __init__(self, buffer_size, policy, encode):
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.encode = encode
+        self.condition = Condition()
+        self.frames = deque()
+        self.group = None
+        self.active = True
+        self.dropped = 0
+
+    def push(self, events, frame):
+        with self.condition:
+            if len(self.frames) >= self.buffer_size:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += len(events)
+                    return
+                elif self.policy == COALESCE:
+                    self.coalesce(events)
+                    self.condition.notify()
+                    return
+                else:
+                    self.dropped += len(self.frames.popleft()[0])
+            self.frames.append((events, frame, time.time()))
+            self.condition.notify()
+
+    def coalesce(self, events):
+        latest = {}
+        buffered = 0
+        for pending, _, _ in self.frames:
+            buffered += len(pending)
+            for event in pending:
+                latest[event.sensor.url] = event
+        for event in events:
+            latest[event.sensor.url] = event
+        merged = sorted(latest.values(), key=lambda e: e.time)
+        self.dropped += buffered + len(events) - len(merged)
+        queued = self.frames[0][2]
+        self.frames.clear()
+        self.frames.append((merged, self.encode(merged), queued))
+
+    def get(self, timeout=1.):
+        # Next frame to send, or None on timeout or when unsubscribed
+        with self.condition:
+            if not self.frames and self.active:
+                self.condition.wait(timeout)
+            if self.frames:
+                _, frame, queued = self.frames.popleft()
+                instrument.record('replay.frame_wait', time.time() - queued)
+                return frame
+            return None
+
+    def close(self):
+        with self.condition:
+            self.active = False
+            self.condition.notify_all()
+
+
+class ReplayGroup(object):
+    """One replay session shared by every subscriber with the same start
+    time and speed. Each batch of events is encoded once per encoding in
+    use among them.
+
+    Its fetch and broadcast loops are started with `spawn`; close() kills
+    them when spawn returns greenlets, cancelling a fetch in progress, and
+    otherwise lets them run to the end of what they are doing.
+    """
+    def __init__(self, key, session, spawn=start_thread):
+        self.key = key
+        self.session = session
+        self.lock = Lock()
+        self.subscribers = set()
+        self.tasks = [spawn(session.fetch_loop), spawn(self.broadcast_loop)]
+
+    def close(self):
+        self.session.close()
+        for task in self.tasks:
+            kill = getattr(task, 'kill', None)
+            if kill is not None:
+                kill(block=False)
+
+    def broadcast_loop(self):
+        while self.session.running:
+            events = self.session.scheduler.wait_due(idle_timeout=None)
+            if not events:
+                continue
+            with self.lock:
+                subscribers = list(self.subscribers)
+            frames = {}
+            for subscriber in subscribers:
+                frame = frames.get(subscriber.encode)
+                if frame is None:
+                    frame = frames[subscriber.encode] = subscriber.encode(events)
+                subscriber.push(events, frame)
+
+
+class ReplayHub(object):
+    """Groups replay clients by (start time, speed) so that each group runs
+    a single fetch and merge pipeline however many clients it has.
+
+    Clients that subscribe without a start time share one group per speed,
+    started at `start_time`, and join it at its playhead. A client asking
+    for a start time joins a group with that start time and speed only
+    while the group is at most `join_window` local seconds into its replay,
+    so it starts where it asked. A control command from a client alone in
+    its group is applied to the group's session, keeping the chunks it
+    already fetched; otherwise the client moves to a group matching its new
+    state. Paused clients get a group of their own. Clients are sent frames
+    encoded with `encode` unless they subscribe with another. Groups run on
+    threads, or on what `spawn` starts, e.g. gevent.spawn.
+    """
+    def __init__(self, source, sensors, buffer_size=64, policy=COALESCE, encode=encode_json, spawn=start_thread,
+                 join_window=1., start_time=1415491200, **session_options):
+        self.source = source
+        self.sensors = sensors
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.encode = encode
+        self.spawn = spawn
+        self.join_window = join_window
+        self.start_time = start_time
+        self.session_options = session_options
+        self.lock = Lock()
+        self.groups = set()
+
+    def subscribe(self, start_time=None, time_scale=1, paused=False, subscriber=None, encode=None):
+        if subscriber is None:
+            subscriber = Subscriber(self.buffer_size, self.policy, encode or self.encode)
+        key = None if paused else (start_time, time_scale)
+        with self.lock:
+            group = self.find(key)
+            if group is None:
+                session = ReplaySession(self.source, self.sensors,
+                                        self.start_time if start_time is None else start_time, time_scale,
+                                        **self.session_options)
+                if paused:
+                    session.pause()
+                group = ReplayGroup(key, session, self.spawn)
+                self.groups.add(group)
+                logger.info('Started replay group %s' % (key,))
+            with group.lock:
+                group.subscribers.add(subscriber)
+        subscriber.group = group
+        return subscriber
+
+    def find(self, key):
+        # A group a new client with key may join, called holding the lock
+        if key is None:
+            return None
+        for group in self.groups:
+            if group.key == key and self.joinable(group):
+                return group
+        return None
+
+    def joinable(self, group):
+        if group.key[0] is None:
+            return True
+        clock = group.session.clock
+        return clock.local_now() - clock.local_start_time <= self.join_window
+
+    def leave(self, subscriber):
+        group = subscriber.group
+        if group is None:
+            return
+        subscriber.group = None
+        with self.lock:
+            with group.lock:
+                group.subscribers.discard(subscriber)
+                empty = not group.subscribers
+            if empty:
+                self.groups.discard(group)
+                group.close()
+                logger.info('Stopped replay group %s' % (group.key,))
+
+    def unsubscribe(self, subscriber):
+        self.leave(subscriber)
+        subscriber.close()
+
+    def command(self, subscriber, message):
+        command = parse_command(message)
+        if command is None or subscriber.group is None:
+            return
+        name, argument = command
+        group = subscriber.group
+        with self.lock:
+            with group.lock:
+                alone = group.subscribers == set([subscriber])
+            if alone:
+                group.session.apply(name, argument)
+                session = group.session
+                group.key = None if session.paused else (session.clock.pseudo_start_time, session.speed)
+                with subscriber.condition:
+                    subscriber.frames.clear()
+                return
+        session = group.session
+        start_time = session.clock.pseudo_now()
+        time_scale = session.speed
+        paused = session.paused
+        if name == 'seek':
+            start_time = argument
+        elif name == 'speed':
+            time_scale = argument
+        elif name == 'pause':
+            paused = True
+        elif name == 'play':
+            paused = False
+        self.leave(subscriber)
+        with subscriber.condition:
+            subscriber.frames.clear()
+        self.subscribe(start_time, time_scale, paused, subscriber)
+
+    def stats(self):
+        # One entry per live group, paused ones included
+        with self.lock:
+            return [{'start_time': group.session.clock.pseudo_start_time, 'time_scale': group.session.speed,
+                     'paused': group.session.paused, 'subscribers': len(group.subscribers)}
+                    for group in self.groups]
@@ -0,0 +1,189 @@
+"""Multi-resolution rollups of sensor history.
+
+Each level aggregates the samples of a sensor into fixed buckets (10s, 1min,
+10min and 1h) holding their count, min, max and mean. RollupSource builds
+them from the same chunks of raw history that replay fetches, including
+those replay fetches through it, so both share the source's cache. Buckets
+spanning two chunks are merged when rollups are read.
+"""
+from collections import OrderedDict
+from threading import Lock
+import logging
+import math
+import time
+
+import numpy
+
+import instrument
+from util import MILLISECONDS
+
+logger = logging.getLogger(__name__)
+
+# Bucket lengths in seconds; 0 stands for the raw samples
+LEVELS = (10, 60, 600, 3600)
+# Seconds of raw history per fetch, replay's chunk length
+ROLLUP_CHUNK = 2000
+# Local seconds between updates of a sensor that a replay client can use
+REPLAY_RESOLUTION = 0.1
+
+
+class Rollup(object):
+    """Buckets of one sensor at one level, sorted by start time (epoch ms);
+    buckets without samples are left out."""
+    __slots__ = ('times', 'count', 'min', 'max', 'mean')
+
+    def __init__(self, times, count, min, max, mean):
+        self.times = times
+        self.count = count
+        self.min = min
+        self.max = max
+        self.mean = mean
+
+    def __len__(self):
+        return len(self.times)
+
+    def slice(self, start_ms, end_ms):
+        lo, hi = numpy.searchsorted(self.times, [start_ms, end_ms])
+        return Rollup(self.times[lo:hi], self.count[lo:hi], self.min[lo:hi], self.max[lo:hi], self.mean[lo:hi])
+
+    def to_dict(self):
+        # float32 to the shortest floats that round trip, not 17 digits
+        compact = lambda values: [float('%.7g' % v) for v in values]
+        return {
+            'time': self.times.tolist(),
+            'count': self.count.tolist(),
+            'min': compact(self.min),
+            'max': compact(self.max),
+            'mean': compact(self.mean),
+        }
+
+    @classmethod
+    def empty(cls):
+        return cls(numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64),
+                   numpy.empty(0, dtype=numpy.float32), numpy.empty(0, dtype=numpy.float32),
+                   numpy.empty(0, dtype=numpy.float32))
+
+    @classmethod
+    def concatenate(cls, rollups):
+        """Rollups of consecutive periods as one, merging the buckets that
+        span the end of one period and the start of the next."""
+        rollups = [r for r in rollups if len(r)]
+        if not rollups:
+            return cls.empty()
+        times, count, low, high, mean = [numpy.concatenate([getattr(r, name) for r in rollups])
+                                         for name in cls.__slots__]
+        first = numpy.concatenate(([0], numpy.flatnonzero(times[1:] != times[:-1]) + 1))
+        if len(first) == len(times):
+            return cls(times, count, low, high, mean)
+        total = numpy.add.reduceat(count, first)
+        return cls(times[first], total,
+                   numpy.minimum.reduceat(low, first), numpy.maximum.reduceat(high, first),
+                   (numpy.add.reduceat(mean * count, first) / total).astype(numpy.float32))
+
+
+def aggregate(times, values, bucket_seconds):
+    """Rollup of samples sorted by time into buckets of bucket_seconds."""
+    times = numpy.asarray(times, dtype=numpy.int64)
+    if not len(times):
+        return Rollup.empty()
+    values = numpy.asarray(values, dtype=float)
+    bucket_ms = bucket_seconds * MILLISECONDS
+    buckets = times // bucket_ms * bucket_ms
+    first = numpy.concatenate(([0], numpy.flatnonzero(buckets[1:] != buckets[:-1]) + 1))
+    count = numpy.diff(numpy.append(first, len(times)))
+    return Rollup(buckets[first], count,
+                  numpy.minimum.reduceat(values, first).astype(numpy.float32),
+                  numpy.maximum.reduceat(values, first).astype(numpy.float32),
+                  (numpy.add.reduceat(values, first) / count).astype(numpy.float32))
+
+
+def level_for_speed(time_scale, levels=LEVELS, resolution=REPLAY_RESOLUTION):
+    # Coarsest level whose buckets are no longer than what a client sees in
+    # `resolution` local seconds, or 0 for raw samples
+    span = abs(time_scale) * resolution
+    eligible = [level for level in levels if level <= span]
+    return max(eligible) if eligible else 0
+
+
+def level_for_range(seconds, points, levels=LEVELS):
+    # Finest level giving at most `points` buckets over `seconds`
+    for level in sorted(levels):
+        if seconds / float(level) <= points:
+            return level
+    return max(levels)
+
+
+class RollupSource(object):
+    """History source serving rollups next to the raw series of `source`.
+
+    fetch_series(..., level=0) is passed through to the source, and the
+    rollups of the chunks it returns are kept. At a rollup level it returns
+    the bucket start times and means, so replaying it emits one event per
+    bucket. Rollups are built from chunks of `chunk_length` seconds, the
+    windows replay fetches; those of the most recently used `max_chunks`
+    chunks are kept in memory, except for chunks that have not ended yet.
+    """
+    def __init__(self, source, levels=LEVELS, chunk_length=ROLLUP_CHUNK, max_chunks=48):
+        self.source = source
+        self.levels = levels
+        self.chunk_length = chunk_length
+        self.max_chunks = max_chunks
+        self.lock = Lock()
+        # chunk start -> {sensor url: {level: Rollup}}
+        self.chunks = OrderedDict()
+
+    def level_for(self, time_scale):
+        return level_for_speed(time_scale, self.levels)
+
+    def _keep(self, chunk_start, series):
+        # Rollups of the raw series of a chunk, kept if the chunk has ended
+        built = dict((sensor.url, dict((level, aggregate(times, values, level)) for level in self.levels))
+                     for sensor, times, values in series)
+        if chunk_start + self.chunk_length <= time.time():
+            with self.lock:
+                self.chunks.setdefault(chunk_start, {}).update(built)
+                self.chunks[chunk_start] = self.chunks.pop(chunk_start)
+                while len(self.chunks) > self.max_chunks:
+                    self.chunks.popitem(last=False)
+        return built
+
+    def _chunk(self, sensors, chunk_start):
+        with self.lock:
+            rollups = dict(self.chunks.get(chunk_start, {}))
+            if chunk_start in self.chunks:
+                self.chunks[chunk_start] = self.chunks.pop(chunk_start)
+        missing = [sensor for sensor in sensors if sensor.url not in rollups]
+        if missing:
+            with instrument.timer('rollup.build'):
+                series = self.source.fetch_series(missing, chunk_start, chunk_start + self.chunk_length)
+                rollups.update(self._keep(chunk_start, series))
+        return rollups
+
+    def chunk_span(self, start_stamp, end_stamp, level):
+        # First chunk start and the end of the chunks holding every bucket
+        # that starts in [start, end)
+        first = int(start_stamp // level) * level
+        last = int(math.ceil(end_stamp / float(level))) * level
+        return (first // self.chunk_length * self.chunk_length,
+                int(math.ceil(last / float(self.chunk_length))) * self.chunk_length)
+
+    def rollups(self, sensors, start_stamp, end_stamp, level):
+        """[(sensor, Rollup)] of the buckets starting in [start, end)."""
+        parts = dict((sensor.url, []) for sensor in sensors)
+        chunk_start, chunk_end = self.chunk_span(start_stamp, end_stamp, level)
+        while chunk_start < chunk_end:
+            rollups = self._chunk(sensors, chunk_start)
+            for sensor in sensors:
+                parts[sensor.url].append(rollups[sensor.url][level])
+            chunk_start += self.chunk_length
+        start_ms, end_ms = start_stamp * MILLISECONDS, end_stamp * MILLISECONDS
+        return [(sensor, Rollup.concatenate(parts[sensor.url]).slice(start_ms, end_ms)) for sensor in sensors]
+
+    def fetch_series(self, sensors, start_stamp, end_stamp, level=0):
+        if not level:
+            series = self.source.fetch_series(sensors, start_stamp, end_stamp)
+            if start_stamp % self.chunk_length == 0 and end_stamp - start_stamp == self.chunk_length:
+                self._keep(start_stamp, series)
+            return series
+        return [(sensor, rollup.times, rollup.mean)
+                for sensor, rollup in self.rollups(sensors, start_stamp, end_stamp, level)]
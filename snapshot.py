@@ -0,0 +1,201 @@
+"""Versioned local snapshot of a site model for fast startup.
+
+The snapshot directory holds site.json, the description from
+models.describe_site, and simplex/, the lookup rasters of every metric,
+which are memory-mapped on load; rasters left unused for RASTER_MAX_AGE
+are deleted. Services start from the snapshot and revalidate it against
+chain-api in the background.
+"""
+from threading import Thread
+import json
+import logging
+import os
+import time
+
+import chainclient
+
+from models import build_models, describe_site, merge_descriptions
+from projection import UNITY
+from util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DIR = 'snapshot'
+# Seconds a simplex raster may go unused by the models built here before it
+# is deleted, e.g. after the site's layout changed
+RASTER_MAX_AGE = 24 * 3600
+
+
+def snapshot_path(snapshot_dir):
+    return os.path.join(snapshot_dir, 'site.json')
+
+
+def load_snapshot(snapshot_dir, site_url):
+    try:
+        with open(snapshot_path(snapshot_dir)) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('site_url') != site_url:
+        logger.warning('Ignoring snapshot in %s for %s version %s' % (
+            snapshot_dir, snapshot.get('site_url'), snapshot.get('version')))
+        return None
+    return snapshot['description']
+
+
+def save_snapshot(snapshot_dir, site_url, description):
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'site_url': site_url,
+        'description': description,
+    }
+    atomic_write(snapshot_path(snapshot_dir), lambda f: json.dump(snapshot, f))
+
+
+def fetch_description(site_url):
+    return describe_site(chainclient.get(site_url))
+
+
+def load_description(site_url, snapshot_dir=SNAPSHOT_DIR):
+    """(description, from_snapshot) for a site, fetching it from chain-api
+    only when there is no usable snapshot."""
+    description = load_snapshot(snapshot_dir, site_url)
+    if description is not None:
+        return description, True
+    logger.info('No snapshot for %s, fetching site' % site_url)
+    description = fetch_description(site_url)
+    save_snapshot(snapshot_dir, site_url, description)
+    return description, False
+
+
+def revalidate(site_url, snapshot_dir, description, on_change):
+    """Check the snapshot against chain-api in a background thread, saving
+    and passing on_change the new description if the site has changed."""
+    def run():
+        try:
+            current = fetch_description(site_url)
+        except Exception:
+            logger.warning('Could not revalidate snapshot of %s, using it as is' % site_url)
+            return
+        # Round trip through JSON so both sides compare as loaded
+        current = json.loads(json.dumps(current))
+        if current == description:
+            logger.info('Snapshot of %s is up to date' % site_url)
+            return
+        logger.warning('Site %s changed since the snapshot, updating it' % site_url)
+        save_snapshot(snapshot_dir, site_url, current)
+        on_change(current)
+
+    t = Thread(target=run)
+    t.daemon = True
+    t.start()
+
+
+def replace_models(models, new_models):
+    """Swap the contents of the model dicts in place, so every holder of
+    them sees the new site, keeping the values of sensors in both and the
+    staleness settings of metrics in both."""
+    for name, metric in new_models[0].items():
+        previous = models[0].get(name)
+        if previous is not None:
+            metric.set_staleness(previous.max_age, previous.half_life)
+    old_sensors = models[2]
+    for url, sensor in new_models[2].items():
+        previous = old_sensors.get(url)
+        if previous is not None and previous.store.valid[previous.index]:
+            sensor.store.set_value(sensor.index, previous.value, previous.timestamp)
+    for old, new in zip(models, new_models):
+        old.clear()
+        old.update(new)
+
+
+def prune_rasters(cache_dir, metrics, max_age=RASTER_MAX_AGE):
+    """Mark the simplex rasters of metrics as used, and delete the others in
+    cache_dir that have not been used for max_age seconds."""
+    used = set(metric.interpolator.cache_path for metric in metrics
+               if metric.interpolator is not None and metric.interpolator.cache_path is not None)
+    now = time.time()
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        if not (name.startswith('simplex_') and name.endswith('.npy')):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            if path in used:
+                os.utime(path, None)
+            elif now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                logger.info('Deleted unused simplex raster %s' % path)
+        except OSError:
+            # Removed meanwhile by another service sharing the snapshot
+            pass
+
+
+def build_cached_models(description, precision, cache_dir, projection):
+    models = build_models(description, precision, cache_dir, projection)
+    prune_rasters(cache_dir, models[0].values())
+    return models
+
+
+def load_models(site_url, snapshot_dir=SNAPSHOT_DIR, precision=0, on_change=replace_models, projection=UNITY):
+    """(metric_hash, device_hash, sensor_hash) for a site, built from the
+    snapshot. If revalidation finds the site changed, on_change is called
+    with these models and ones built from the new description."""
+    cache_dir = os.path.join(snapshot_dir, 'simplex')
+    description, from_snapshot = load_description(site_url, snapshot_dir)
+    models = build_cached_models(description, precision, cache_dir, projection)
+
+    def rebuild(new_description):
+        on_change(models, build_cached_models(new_description, precision, cache_dir, projection))
+
+    if from_snapshot:
+        revalidate(site_url, snapshot_dir, description, rebuild)
+    return models
+
+
+def site_key(site_url):
+    # 'http://chain-api.media.mit.edu/sites/7' -> '7'
+    return site_url.rstrip('/').split('/')[-1]
+
+
+def site_dir(site_url, site_urls, snapshot_dir=SNAPSHOT_DIR):
+    # Snapshot directory of one of the sites load_sites loads together
+    if len(site_urls) > 1:
+        return os.path.join(snapshot_dir, site_key(site_url))
+    return snapshot_dir
+
+
+def load_sites(site_urls, snapshot_dir=SNAPSHOT_DIR, precision=0, on_change=replace_models, projection=UNITY):
+    """Models of several sites merged into one set, with metric names
+    prefixed '<site key>/' (see models.merge_descriptions). Each site is
+    snapshotted in its own subdirectory and revalidated separately; a change
+    in any of them calls on_change with models of the updated set. With
+    on_change None the snapshots are used without revalidating them. A
+    single site keeps its metric names and snapshot directory, as with
+    load_models."""
+    cache_dir = os.path.join(snapshot_dir, 'simplex')
+    several = len(site_urls) > 1
+    descriptions = []
+    stale = []
+    for site_url in site_urls:
+        directory = site_dir(site_url, site_urls, snapshot_dir)
+        description, from_snapshot = load_description(site_url, directory)
+        descriptions.append((site_key(site_url) + '/' if several else '', description))
+        if from_snapshot and on_change is not None:
+            stale.append((site_url, directory, description, len(descriptions) - 1))
+
+    merged = merge_descriptions(descriptions)
+    models = build_cached_models(merged, precision, cache_dir, projection)
+
+    # Revalidate only once there are models for rebuild to replace
+    for site_url, directory, description, position in stale:
+        def rebuild(new_description, position=position):
+            descriptions[position] = (descriptions[position][0], new_description)
+            on_change(models, build_cached_models(merge_descriptions(descriptions), precision, cache_dir,
+                                                  projection))
+        revalidate(site_url, directory, description, rebuild)
+    return models, merged['stream_urls']
@@ -0,0 +1,231 @@
+from collections import deque
+import math
+import time
+
+
+class RunningStats(object):
+    """Aggregates over a set of values that are added, removed or replaced.
+
+    Count, mean and std are O(1) per update using sums shifted by the first
+    value seen, which keeps the sum of squares well conditioned. Min and max
+    are O(1) unless the current extreme is removed, in which case they are
+    recomputed from `values` (a callable returning the live values) on the
+    next read.
+    """
+    def __init__(self, values=None):
+        self.values = values
+        self.reset([])
+
+    def reset(self, values):
+        self.count = 0
+        self._shift = None
+        self._sum = 0.
+        self._sumsq = 0.
+        self._min = float('inf')
+        self._max = float('-inf')
+        self._stale_extremes = False
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        if self._shift is None:
+            self._shift = value
+        delta = value - self._shift
+        self.count += 1
+        self._sum += delta
+        self._sumsq += delta * delta
+        if value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+
+    def remove(self, value):
+        delta = value - self._shift
+        self.count -= 1
+        self._sum -= delta
+        self._sumsq -= delta * delta
+        if self.count == 0:
+            self.reset([])
+        elif value <= self._min or value >= self._max:
+            self._stale_extremes = True
+
+    def replace(self, old, new):
+        # None stands for "no value" on either side
+        if old is not None:
+            self.remove(old)
+        if new is not None:
+            self.add(new)
+
+    def _refresh_extremes(self):
+        self._stale_extremes = False
+        self._min = float('inf')
+        self._max = float('-inf')
+        if self.values is None or self.count == 0:
+            return
+        values = self.values()
+        if len(values):
+            self._min = float(min(values))
+            self._max = float(max(values))
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return float('nan')
+        return self._shift + self._sum / self.count
+
+    @property
+    def variance(self):
+        if self.count == 0:
+            return float('nan')
+        shifted_mean = self._sum / self.count
+        return max(self._sumsq / self.count - shifted_mean * shifted_mean, 0.)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def min(self):
+        if self._stale_extremes:
+            self._refresh_extremes()
+        return self._min
+
+    @property
+    def max(self):
+        if self._stale_extremes:
+            self._refresh_extremes()
+        return self._max
+
+
+class WindowedStats(object):
+    """Aggregates over the updates received in the last `window` seconds.
+
+    Each update is pushed and expired exactly once, and min/max are kept in
+    monotonic queues, so every operation is amortized O(1). Reading expires
+    the updates that left the window by `clock`, which timestamps must
+    follow.
+    """
+    def __init__(self, window, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self._events = deque()
+        self._mins = deque()
+        self._maxs = deque()
+        self._sum = 0.
+        self._sumsq = 0.
+        self._shift = None
+
+    def add(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        if self._shift is None:
+            self._shift = value
+        delta = value - self._shift
+        self._events.append((timestamp, value))
+        self._sum += delta
+        self._sumsq += delta * delta
+
+        while self._mins and self._mins[-1][1] >= value:
+            self._mins.pop()
+        self._mins.append((timestamp, value))
+        while self._maxs and self._maxs[-1][1] <= value:
+            self._maxs.pop()
+        self._maxs.append((timestamp, value))
+        self.expire(timestamp)
+
+    def expire(self, now=None):
+        if now is None:
+            now = self.clock()
+        cutoff = now - self.window
+        while self._events and self._events[0][0] < cutoff:
+            _, value = self._events.popleft()
+            delta = value - self._shift
+            self._sum -= delta
+            self._sumsq -= delta * delta
+        while self._mins and self._mins[0][0] < cutoff:
+            self._mins.popleft()
+        while self._maxs and self._maxs[0][0] < cutoff:
+            self._maxs.popleft()
+        if not self._events:
+            self._sum = self._sumsq = 0.
+            self._shift = None
+
+    @property
+    def count(self):
+        self.expire()
+        return len(self._events)
+
+    @property
+    def mean(self):
+        self.expire()
+        if not self._events:
+            return float('nan')
+        return self._shift + self._sum / len(self._events)
+
+    @property
+    def variance(self):
+        self.expire()
+        if not self._events:
+            return float('nan')
+        shifted_mean = self._sum / len(self._events)
+        return max(self._sumsq / len(self._events) - shifted_mean * shifted_mean, 0.)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def min(self):
+        self.expire()
+        return self._mins[0][1] if self._mins else float('inf')
+
+    @property
+    def max(self):
+        self.expire()
+        return self._maxs[0][1] if self._maxs else float('-inf')
+
+
+class DecayedStats(object):
+    """Exponentially decayed mean and std of the updates received.
+
+    An update `half_life` seconds old carries half the weight of a new one.
+    """
+    def __init__(self, half_life):
+        self.half_life = half_life
+        self._weight = 0.
+        self._sum = 0.
+        self._sumsq = 0.
+        self._shift = None
+        self._last = None
+        self.count = 0
+
+    def add(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if self._shift is None:
+            self._shift = value
+            self._last = timestamp
+        decay = 0.5 ** (max(timestamp - self._last, 0.) / self.half_life)
+        delta = value - self._shift
+        self._weight = self._weight * decay + 1.
+        self._sum = self._sum * decay + delta
+        self._sumsq = self._sumsq * decay + delta * delta
+        self._last = max(timestamp, self._last)
+        self.count += 1
+
+    @property
+    def mean(self):
+        if not self._weight:
+            return float('nan')
+        return self._shift + self._sum / self._weight
+
+    @property
+    def variance(self):
+        if not self._weight:
+            return float('nan')
+        shifted_mean = self._sum / self._weight
+        return max(self._sumsq / self._weight - shifted_mean * shifted_mean, 0.)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
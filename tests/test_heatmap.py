@@ -0,0 +1,90 @@
+import time
+
+import numpy
+from numpy.testing import assert_allclose, assert_array_equal
+
+from heatmap import HeatField
+from interpolate import Interpolator
+from models import build_models
+
+
+class Store(object):
+    def __init__(self, n, seed=0):
+        random = numpy.random.RandomState(seed)
+        self.sensors = ['sensor%d' % i for i in range(n)]
+        self.x = random.uniform(10, 90, n)
+        self.y = random.uniform(10, 90, n)
+        self.value = random.uniform(-10, 10, n)
+
+    def __len__(self):
+        return len(self.sensors)
+
+
+def description(n, seed=0):
+    random = numpy.random.RandomState(seed)
+    devices = [{'index': i, 'name': None, 'latitude': 41.9 + random.rand() * 0.01,
+                'longitude': -70.6 + random.rand() * 0.01, 'elevation': 0.} for i in range(n)]
+    sensors = [{'url': 'http://localhost/sensors/%d' % i, 'metric': 'temp', 'device': i} for i in range(n)]
+    return {'stream_url': None, 'devices': devices, 'sensors': sensors}
+
+
+def test_update_sensor_matches_refresh():
+    store = Store(30)
+    interpolator = Interpolator(store, precision=0)
+    field = HeatField(interpolator, 0, 100, 0, 100, 1.)
+    expected = interpolator.interpolate_many(field.points[:, 0], field.points[:, 1])
+    assert_allclose(field.raster, expected, atol=1e-9)
+
+    random = numpy.random.RandomState(1)
+    for index in random.randint(len(store), size=10):
+        store.value[index] = random.uniform(-10, 10)
+        field.update_sensor(index)
+    store.value[3] = float('inf')
+    field.update_sensor(3)
+
+    incremental = field.raster.copy()
+    field.refresh()
+    assert_array_equal(incremental, field.raster)
+    assert_allclose(incremental, interpolator.interpolate_many(field.points[:, 0], field.points[:, 1]), atol=1e-9)
+
+
+def test_fill_covers_missing_pixels():
+    store = Store(30)
+    field = HeatField(Interpolator(store, precision=0), 0, 100, 0, 100, 1., fill=lambda points: -1.)
+    missing = ~numpy.isfinite(field.raster)
+    assert missing.any()
+    filled = field.filled()
+    assert (filled[missing] == -1.).all()
+    assert_array_equal(filled[~missing], field.raster[~missing])
+    unfilled = HeatField(Interpolator(store, precision=0), 0, 100, 0, 100, 1.)
+    assert unfilled.filled() is unfilled.raster
+
+
+class TestMetricHeatField(object):
+    def setup(self):
+        metric_hash, _, _ = build_models(description(30))
+        self.metric = metric_hash['temp']
+        now = time.time()
+        random = numpy.random.RandomState(2)
+        # Some sensors without data, the rest of various ages
+        for index in range(3, len(self.metric.store)):
+            self.metric.store.set_value(index, random.uniform(0, 30), now - index * 10)
+
+    def check(self):
+        field = self.metric.get_heat_field()
+        expected = self.metric.get_value_many(*self.metric._denormalize(field.points))
+        assert_allclose(field.filled(), expected, atol=1e-9)
+
+    def test_matches_get_value_many(self):
+        self.check()
+        # Kept up to date by later readings
+        self.metric.store.set_value(5, 100., time.time())
+        self.metric.store.set_value(6, None)
+        self.check()
+
+    def test_matches_get_value_many_with_staleness(self):
+        self.metric.get_heat_field()
+        self.metric.set_staleness(max_age=150)
+        self.check()
+        self.metric.set_staleness(half_life=60)
+        self.check()
@@ -0,0 +1,77 @@
+import shutil
+import tempfile
+import threading
+
+import numpy
+from nose.tools import assert_raises
+from numpy.testing import assert_array_equal
+
+from bench import StubHandler, StubServer
+from history_loader import FetchError, HistoryLoader
+
+START = 1415491200
+CHUNK = 2000
+
+
+class Sensor(object):
+    def __init__(self, url):
+        self.url = url
+
+
+class SmallPages(StubHandler):
+    page_size = 7
+
+
+class TestHistoryLoader(object):
+    def setup(self):
+        self.server = StubServer(('127.0.0.1', 0), SmallPages)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.sensors = [Sensor('http://chain/sensors/%d/' % i) for i in range(4)]
+
+    def teardown(self):
+        self.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def loader(self, cache_dir=None):
+        return HistoryLoader('http://%s:%d' % self.server.server_address, cache_dir=cache_dir, workers=4, timeout=5)
+
+    def check(self, series, start_stamp, end_stamp):
+        expected = numpy.arange(start_stamp, end_stamp, 10, dtype=numpy.int64)
+        assert [sensor for sensor, _, _ in series] == self.sensors
+        for _, times, values in series:
+            assert_array_equal(times, expected * 1000)
+            assert_array_equal(values, (expected % 97).astype(numpy.float32))
+
+    def test_follows_every_page(self):
+        series = self.loader().fetch_series(self.sensors, START, START + CHUNK)
+        self.check(series, START, START + CHUNK)
+
+    def test_empty_range(self):
+        series = self.loader().fetch_series(self.sensors, START, START)
+        assert all(len(times) == 0 for _, times, _ in series)
+
+    def test_cached_chunks_need_no_server(self):
+        loader = self.loader(self.cache_dir)
+        loader.fetch_series(self.sensors, START, START + CHUNK)
+        self.stop()
+        self.check(loader.fetch_series(self.sensors, START, START + CHUNK), START, START + CHUNK)
+        # Another loader sharing the cache directory reads it too
+        other = HistoryLoader('http://127.0.0.1:1', cache_dir=self.cache_dir, timeout=5)
+        self.check(other.fetch_series(self.sensors, START, START + CHUNK), START, START + CHUNK)
+
+    def test_failed_fetch_raises(self):
+        loader = self.loader(self.cache_dir)
+        self.stop()
+        with assert_raises(FetchError):
+            loader.fetch_series(self.sensors, START, START + CHUNK)
+        # and nothing was cached
+        assert loader.cache.get(self.sensors[0], START, START + CHUNK) is None
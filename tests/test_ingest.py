@@ -0,0 +1,45 @@
+import json
+
+from ingest import decode
+
+HREF = 'http://localhost/sensors/7'
+RECEIVED = 1415491300.5
+
+
+def document(value, timestamp='2014-11-09T00:00:00.250000+00:00', href=HREF):
+    doc = {'_links': {'ch:sensor': {'href': href}}, 'value': value}
+    if timestamp is not None:
+        doc['timestamp'] = timestamp
+    return doc
+
+
+def test_single_document():
+    message = json.dumps(document(21.5))
+    assert decode(message, RECEIVED) == [(HREF, 21.5, 1415491200.25)]
+    assert decode(json.dumps(document(-1e-3)), RECEIVED)[0][1] == -1e-3
+
+
+def test_null_value():
+    assert decode(json.dumps(document(None)), RECEIVED) == [(HREF, None, 1415491200.25)]
+
+
+def test_missing_timestamp_is_received_time():
+    assert decode(json.dumps(document(3., None)), RECEIVED) == [(HREF, 3., RECEIVED)]
+    assert decode(json.dumps(document(3., 'yesterday')), RECEIVED) == [(HREF, 3., RECEIVED)]
+
+
+def test_list_of_documents():
+    docs = [document(1.), document(None, href=HREF + '0'), document(2., None)]
+    assert decode(json.dumps(docs), RECEIVED) == [
+        (HREF, 1., 1415491200.25), (HREF + '0', None, 1415491200.25), (HREF, 2., RECEIVED)]
+
+
+def test_unusual_layout():
+    # The href after the value, with no space after the colons
+    reordered = '{"value":6,"timestamp":"2014-11-09 00:00:00","_links":{"ch:sensor":{"href":"%s"}}}' % HREF
+    assert decode(reordered, RECEIVED) == [(HREF, 6., 1415491200.)]
+
+
+def test_malformed_messages():
+    for message in ('', 'not json', '{"value": 1}', '[{"value": 1}]', '{"_links": {}, "value": 1}', '[1, 2]'):
+        assert decode(message, RECEIVED) == [], message
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+from numpy.testing import assert_allclose, assert_array_equal
+from scipy.interpolate import griddata
+
+from interpolate import Interpolator
+
+
+class Store(object):
+    def __init__(self, n, seed=0):
+        random = numpy.random.RandomState(seed)
+        self.sensors = ['sensor%d' % i for i in range(n)]
+        self.x = random.uniform(0.1, 0.9, n)
+        self.y = random.uniform(0.1, 0.9, n)
+        self.value = random.uniform(-10, 10, n)
+
+
+def expected(interpolator, xs, ys):
+    return griddata(interpolator.points, interpolator.get_values(), (xs, ys), fill_value=float('inf'))
+
+
+def query_points(interpolator, n=2000, seed=1):
+    # Random points over and beyond the hull, plus the sensors themselves
+    # and the midpoints of every simplex edge, where the raster guess is
+    # most likely to land in a neighbouring simplex
+    random = numpy.random.RandomState(seed)
+    xs = [random.uniform(-0.2, 1.2, n), interpolator.points[:, 0]]
+    ys = [random.uniform(-0.2, 1.2, n), interpolator.points[:, 1]]
+    for a, b in ((0, 1), (1, 2), (2, 0)):
+        corners = interpolator.points[interpolator.tri.simplices]
+        middle = (corners[:, a] + corners[:, b]) / 2
+        xs.append(middle[:, 0])
+        ys.append(middle[:, 1])
+    return numpy.concatenate(xs), numpy.concatenate(ys)
+
+
+def test_interpolate_many_matches_griddata():
+    interpolator = Interpolator(Store(40), precision=2)
+    xs, ys = query_points(interpolator)
+    assert_allclose(interpolator.interpolate_many(xs, ys), expected(interpolator, xs, ys), atol=1e-9)
+
+
+def test_interpolate_many_with_raster_matches_griddata():
+    interpolator = Interpolator(Store(40), precision=2)
+    # A raster covering only part of the queries, so some miss it
+    interpolator.generate_cache(0.2, 0.8, 0., 1.)
+    xs, ys = query_points(interpolator)
+    misses = interpolator.lookup_simplices(numpy.column_stack((xs, ys))) < 0
+    assert misses.any() and not misses.all()
+    assert_allclose(interpolator.interpolate_many(xs, ys), expected(interpolator, xs, ys), atol=1e-9)
+
+
+def test_interpolate_many_keeps_shape():
+    interpolator = Interpolator(Store(20), precision=2)
+    xs, ys = numpy.mgrid[0:1:0.1, 0:1:0.05]
+    result = interpolator.interpolate_many(xs, ys)
+    assert result.shape == xs.shape
+    assert_allclose(result, expected(interpolator, xs, ys), atol=1e-9)
+
+
+def test_outside_hull_is_inf():
+    interpolator = Interpolator(Store(20), precision=2)
+    assert interpolator.interpolate(-1., -1.) == float('inf')
+    assert interpolator.get_simplex(-1., -1.) is None
+
+
+def test_sensor_without_data_gives_inf():
+    store = Store(20)
+    interpolator = Interpolator(store, precision=2)
+    values = store.value.copy()
+    values[0] = float('nan')
+    xs, ys = query_points(interpolator)
+    result = interpolator.interpolate_many(xs, ys, values)
+    simplices = interpolator.find_simplices(numpy.column_stack((xs, ys)))
+    touching = (interpolator.tri.simplices[simplices] == 0).any(axis=1) & (simplices >= 0)
+    assert_array_equal(numpy.isinf(result), touching | (simplices < 0))
+
+
+class TestRasterCache(object):
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_raster_is_saved_and_reloaded(self):
+        store = Store(40)
+        first = Interpolator(store, precision=2)
+        first.generate_cache(0., 1., 0., 1., self.cache_dir)
+        assert os.path.exists(first.cache_path)
+        second = Interpolator(store, precision=2)
+        second.generate_cache(0., 1., 0., 1., self.cache_dir)
+        assert second.cache_path == first.cache_path
+        assert isinstance(second.simplex_lookup, numpy.memmap)
+        assert_array_equal(second.simplex_lookup, first.simplex_lookup)
+        xs, ys = query_points(second)
+        assert_allclose(second.interpolate_many(xs, ys), first.interpolate_many(xs, ys))
+
+    def test_key_depends_on_layout_and_simplices(self):
+        interpolator = Interpolator(Store(40), precision=2)
+        key = interpolator.cache_key(0., 1., 0., 1.)
+        assert interpolator.cache_key(0., 1., 0., 2.) != key
+        assert Interpolator(Store(40, seed=1), precision=2).cache_key(0., 1., 0., 1.) != key
+
+        # The same points numbered differently, as another qhull might
+        class Triangulation(object):
+            simplices = interpolator.tri.simplices[::-1]
+            nsimplex = interpolator.tri.nsimplex
+        interpolator.tri = Triangulation()
+        assert interpolator.cache_key(0., 1., 0., 1.) != key
+
+    def test_raster_with_wrong_shape_is_ignored(self):
+        interpolator = Interpolator(Store(40), precision=2)
+        path = os.path.join(self.cache_dir, 'simplex_%s.npy' % interpolator.cache_key(0., 1., 0., 1.))
+        numpy.save(path, numpy.zeros((3, 3), dtype=numpy.int32))
+        interpolator.generate_cache(0., 1., 0., 1., self.cache_dir)
+        assert interpolator.simplex_lookup.shape == (101, 101)
+        assert numpy.load(path).shape == (101, 101)
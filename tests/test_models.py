@@ -0,0 +1,150 @@
+import time
+
+import numpy
+from numpy.testing import assert_allclose, assert_array_equal
+
+from models import Device, Metric, Sensor, SensorStore
+
+
+def make_sensors(n, seed=0):
+    random = numpy.random.RandomState(seed)
+    sensors = []
+    for index in range(n):
+        device = Device(None, None, None, index, position=(random.rand(), random.rand(), 0.))
+        sensors.append(Sensor('http://localhost/sensors/%d' % index, 'temp', device))
+    return sensors
+
+
+def test_sensor_has_no_store_until_adopted():
+    sensor = make_sensors(1)[0]
+    assert sensor.store is None and sensor.index is None
+    store = SensorStore([sensor])
+    assert sensor.store is store and sensor.index == 0
+    assert sensor.x == sensor.device.x
+    assert sensor.value == float('inf')
+
+
+def test_set_value_updates_store():
+    sensors = make_sensors(3)
+    store = SensorStore(sensors)
+    changed = []
+    store.listeners.append(changed.append)
+
+    class Window(object):
+        def __init__(self):
+            self.added = []
+
+        def add(self, value, timestamp):
+            self.added.append((value, timestamp))
+    window = Window()
+    store.windows.append(window)
+
+    store.set_value(1, 5., 100.)
+    sensors[2].value = 0.
+    assert_array_equal(store.valid, [False, True, True])
+    assert sensors[1].value == 5. and sensors[1].timestamp == 100.
+    assert store.stats.count == 2 and store.stats.mean == 2.5
+    assert changed == [1, 2]
+    assert window.added[0] == (5., 100.)
+
+    sensors[1].value = None
+    assert not store.valid[1]
+    assert sensors[1].value == float('inf')
+    assert store.stats.count == 1 and store.stats.mean == 0.
+    assert changed == [1, 2, 1]
+
+
+def test_adoption_keeps_values():
+    sensors = make_sensors(4)
+    old = SensorStore(sensors)
+    old.set_value(0, 1., 10.)
+    old.set_value(3, 4., 40.)
+    # A new layout with the sensors in another order, plus a new one
+    added = make_sensors(5, seed=1)[4]
+    store = SensorStore([sensors[3], added, sensors[0], sensors[2]])
+    assert [s.index for s in (sensors[3], added, sensors[0], sensors[2])] == [0, 1, 2, 3]
+    assert_array_equal(store.valid, [True, False, True, False])
+    assert_array_equal(store.value[store.valid], [4., 1.])
+    assert_array_equal(store.timestamp[store.valid], [40., 10.])
+    assert_allclose(store.stats.mean, 2.5)
+
+
+def aged_metric(n=30, seed=0):
+    # Sensor i read i * 10 seconds ago, but the first three have no data
+    metric = Metric('temp', make_sensors(n, seed))
+    now = time.time()
+    random = numpy.random.RandomState(seed)
+    for index in range(3, n):
+        metric.store.set_value(index, random.uniform(0, 30), now - index * 10)
+    return metric, now
+
+
+def test_age_mask():
+    metric, now = aged_metric()
+    assert_array_equal(numpy.flatnonzero(metric.store.age_mask(105, now)), range(3, 11))
+    weights = metric.store.decay_weights(20, now)
+    assert_allclose(weights[3:], 0.5 ** (numpy.arange(3, 30) / 2.))
+    assert (weights[:3] == 0).all()
+
+
+def test_staleness_aggregates():
+    metric, now = aged_metric()
+    values = metric.store.value
+    assert_allclose(metric.get_mean(), values[3:].mean())
+
+    metric.set_staleness(max_age=105)
+    assert_allclose(metric.get_mean(), values[3:11].mean(), rtol=1e-9)
+    assert_allclose(metric.get_std(), values[3:11].std(), rtol=1e-9)
+
+    metric.set_staleness(half_life=20)
+    weights = 0.5 ** (numpy.arange(3, 30) / 2.)
+    mean = numpy.average(values[3:], weights=weights)
+    assert_allclose(metric.get_mean(), mean, rtol=1e-3)
+    assert_allclose(metric.get_std(), numpy.sqrt(numpy.average((values[3:] - mean) ** 2, weights=weights)),
+                    rtol=1e-3)
+
+    metric.set_staleness(max_age=-1)
+    assert numpy.isnan(metric.get_mean())
+
+
+def test_live_interpolator_rebuilt_only_when_live_set_changes():
+    metric, now = aged_metric()
+    assert metric.live_interpolator(now) is metric.interpolator
+
+    metric.set_staleness(max_age=155)
+    live = metric.live_interpolator(now)
+    assert_array_equal(live.indices, range(3, 16))
+    assert metric.live_interpolator(now + 1) is live
+    # A stale sensor with a new reading joins the live set
+    metric.store.set_value(20, 5., now)
+    rebuilt = metric.live_interpolator(now)
+    assert rebuilt is not live
+    assert 20 in rebuilt.indices
+
+    for index in range(len(metric.store)):
+        metric.store.set_value(index, 1., now)
+    assert metric.live_interpolator(now) is metric.interpolator
+    assert metric.live_interpolator(now + 1000) is None
+
+
+def test_fallback_outside_hull():
+    sensors = make_sensors(20)
+    metric = Metric('temp', sensors)
+    now = time.time()
+    for index in range(2, len(sensors)):
+        metric.store.set_value(index, float(index), now)
+    xs, ys = numpy.array([1.5, -0.5, 0.5]), numpy.array([1.5, 0.5, -2.])
+    # Positions of the sensors with data
+    points = numpy.column_stack((metric.store.x, metric.store.y))[2:]
+    distances = numpy.sqrt((points[:, 0][None] - xs[:, None]) ** 2 + (points[:, 1][None] - ys[:, None]) ** 2)
+    order = numpy.argsort(distances, axis=1)
+    values = numpy.arange(2, 20, dtype=float)
+
+    nearest = values[order[:, 0]]
+    weights = 1. / numpy.sort(distances, axis=1)[:, :4] ** 2
+    idw = (weights * values[order[:, :4]]).sum(axis=1) / weights.sum(axis=1)
+    assert_allclose(metric.get_value_many(xs, ys), idw)
+    metric.fallback = 'nearest'
+    assert_allclose(metric.get_value_many(xs, ys), nearest)
+    metric.fallback = None
+    assert numpy.isinf(metric.get_value_many(xs, ys)).all()
@@ -0,0 +1,87 @@
+import numpy
+from numpy.testing import assert_array_equal
+
+from models import Device, Sensor, SensorStore
+from osc_cluster import MethodTable, SharedStore, ShardRouter, assign_metrics
+
+
+class Metric(object):
+    def __init__(self, size):
+        self.sensors = range(size)
+
+
+class Queue(object):
+    def __init__(self):
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
+
+
+def test_shared_store_writes_through():
+    sensors = [Sensor('http://localhost/sensors/%d' % i, 'temp', Device(None, None, None, i, position=(i, i, 0.)))
+               for i in range(4)]
+    store = SensorStore(sensors)
+    store.set_value(1, 5., 100.)
+    shared = SharedStore(store)
+    value, valid, timestamp = [numpy.ctypeslib.as_array(buffer) for buffer in shared.buffers]
+    # State from before sharing is kept
+    assert valid[1] and value[1] == 5. and timestamp[1] == 100.
+
+    store.set_value(2, 7., 200.)
+    assert_array_equal(valid, [False, True, True, False])
+    assert value[2] == 7. and timestamp[2] == 200.
+    # As the ingest process writes them, seen by the store
+    value[3], valid[3], timestamp[3] = 9., True, 300.
+    assert sensors[3].value == 9. and sensors[3].timestamp == 300.
+    assert shared.version.value == 0
+
+
+def test_assign_metrics_balances_sensors():
+    metric_hash = {'a': Metric(10), 'b': Metric(6), 'c': Metric(5), 'd': Metric(4), 'e': Metric(1)}
+    owners = assign_metrics(metric_hash, 2)
+    assert sorted(owners) == sorted(metric_hash)
+    loads = [sum(len(metric_hash[name].sensors) for name in owners if owners[name] == worker) for worker in (0, 1)]
+    # Largest first onto the least loaded worker: 10 + 4 and 6 + 5 + 1
+    assert sorted(loads) == [12, 14]
+    assert set(assign_metrics(metric_hash, 8).values()) == set(range(5))
+
+
+class TestShardRouter(object):
+    def setup(self):
+        self.queues = [Queue(), Queue()]
+        self.router = ShardRouter(self.queues, {'temp': 0, 'light': 1, 'humidity': 1})
+
+    def test_routes_by_metric(self):
+        self.router.route_metric('/metric', ['light', 1., 2.])
+        self.router.route_metric('/metric', ['temp', 3., 4.])
+        self.router.route_metric('/metric', ['unknown', 3., 4.])
+        assert self.router.pending == [[('/metric', ['temp', 3., 4.])], [('/metric', ['light', 1., 2.])]]
+
+    def test_splits_batches(self):
+        self.router.route_batch('/metric/batch', [7, 'temp', 'light', 'unknown', 'humidity', 1., 2., 3., 4.])
+        assert self.router.pending == [[('/metric/batch', [7, 'temp', 1., 2., 3., 4.])],
+                                       [('/metric/batch', [7, 'light', 'humidity', 1., 2., 3., 4.])]]
+
+    def test_any_and_all(self):
+        for index in range(3):
+            self.router.route_any('/device', [index])
+        self.router.route_all('/server/stats', [])
+        assert self.router.pending == [[('/device', [0]), ('/device', [2]), ('/server/stats', [])],
+                                       [('/device', [1]), ('/server/stats', [])]]
+
+    def test_flush_puts_one_list_per_worker(self):
+        self.router.route_metric('/metric', ['temp', 1., 2.])
+        self.router.route_metric('/metric', ['temp', 3., 4.])
+        self.router.flush()
+        assert self.queues[0].items == [[('/metric', ['temp', 1., 2.]), ('/metric', ['temp', 3., 4.])]]
+        assert self.queues[1].items == []
+        assert self.router.pending == [[], []]
+
+    def test_method_table_dispatches_routed_requests(self):
+        table = MethodTable()
+        self.router.add_methods(table)
+        table.dispatch('/metric/batch', [1, 'temp', 0., 0.])
+        table.dispatch('/stats', [])
+        table.dispatch('/unknown', [])
+        assert self.router.pending == [[('/metric/batch', [1, 'temp', 0., 0.]), ('/stats', [])], [('/stats', [])]]
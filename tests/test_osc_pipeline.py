@@ -0,0 +1,248 @@
+import time
+
+import mock
+import numpy
+from numpy.testing import assert_allclose
+
+from models import build_models
+from osc_pipeline import OutputStage, RequestPipeline, Subscriptions, split_batch
+
+
+def output_stage(**options):
+    # Without its sending thread, so that ticks are driven by the test
+    with mock.patch('osc_pipeline.Thread'):
+        return OutputStage(('127.0.0.1', 9000), **options)
+
+
+def test_coalesces_updates_between_ticks():
+    output = output_stage()
+    for value in (1., 2., 3.):
+        output.update('temp', '/device/data', 0, 'temp', value)
+    output.update('light', '/device/data', 0, 'light', 7.)
+    assert output.take_due(0.) == [('/device/data', (0, 'temp', 3.)), ('/device/data', (0, 'light', 7.))]
+    assert (output.sent, output.dropped) == (2, 2)
+    assert output.take_due(1.) == []
+
+
+def test_suppresses_unchanged_messages():
+    output = output_stage()
+    output.update('temp', '/device/data', 0, 'temp', 1.)
+    output.take_due(0.)
+    output.update('temp', '/device/data', 0, 'temp', 1.)
+    assert output.take_due(1.) == []
+    assert output.dropped == 1
+    output.update('temp', '/device/data', 0, 'temp', 2.)
+    assert output.take_due(2.) == [('/device/data', (0, 'temp', 2.))]
+
+
+def test_forget_resends_unchanged_message():
+    output = output_stage()
+    output.update('temp', '/device/data', 0, 'temp', 1.)
+    output.take_due(0.)
+    output.forget('temp')
+    output.update('temp', '/device/data', 0, 'temp', 1.)
+    assert output.take_due(1.) == [('/device/data', (0, 'temp', 1.))]
+
+
+def test_rate_limits_hold_back_latest_message():
+    output = output_stage(rate_limits={'/player/location': 10.})
+    output.update('/player/location', '/player/location', 0., 0., 0.)
+    assert output.take_due(100.) == [('/player/location', (0., 0., 0.))]
+
+    output.update('/player/location', '/player/location', 1., 0., 0.)
+    output.update('/time', '/time', 5.)
+    # Paths without a limit still go out every tick
+    assert output.take_due(100.05) == [('/time', (5.,))]
+    output.update('/player/location', '/player/location', 2., 0., 0.)
+    assert output.take_due(100.08) == []
+    assert output.take_due(100.11) == [('/player/location', (2., 0., 0.))]
+    assert output.dropped == 1
+
+
+def test_ticks_as_fast_as_highest_rate_limit():
+    assert output_stage(tick_rate=30.).interval == 1. / 30
+    assert output_stage(tick_rate=30., rate_limits={'/a': 10., '/b': 60.}).interval == 1. / 60
+
+
+class FakeSender(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, path, *args):
+        self.sent.append((path, args))
+
+    def depth(self):
+        return 0
+
+
+def description(n, metrics=('temp', 'light'), seed=0):
+    random = numpy.random.RandomState(seed)
+    devices = [{'index': i, 'name': None, 'latitude': random.rand(), 'longitude': random.rand(), 'elevation': 0.}
+               for i in range(n)]
+    sensors = [{'url': 'http://localhost/sensors/%s/%d' % (metric, i), 'metric': metric, 'device': i}
+               for metric in metrics for i in range(n)]
+    return {'stream_url': None, 'devices': devices, 'sensors': sensors}
+
+
+class TestBatch(object):
+    def setup(self):
+        self.metric_hash, device_hash, _ = build_models(description(20))
+        now = time.time()
+        random = numpy.random.RandomState(1)
+        for metric in self.metric_hash.values():
+            for index in range(len(metric.store)):
+                metric.store.set_value(index, random.uniform(0, 30), now)
+        self.sender = FakeSender()
+        self.pipeline = RequestPipeline(self.metric_hash, device_hash, self.sender)
+
+    def replies(self):
+        # (tag, metrics, rows) of each /metric/batch/data sent
+        replies = []
+        for path, args in self.sender.sent:
+            assert path == '/metric/batch/data'
+            tag, points = args[:2]
+            kind, blob = args[-1]
+            assert kind == 'b'
+            rows = numpy.frombuffer(bytes(blob), dtype='<f4').reshape(-1, points)
+            replies.append((tag, list(args[2:-1]), rows))
+        return replies
+
+    def test_batch_matches_get_value_many(self):
+        store = self.metric_hash['temp'].store
+        random = numpy.random.RandomState(2)
+        xs = random.uniform(store.x.min(), store.x.max(), 5)
+        ys = random.uniform(store.y.min(), store.y.max(), 5)
+        coordinates = list(numpy.column_stack((xs, ys)).ravel())
+        self.pipeline.get_batch('/metric/batch', [7, 'light', 'unknown', 'temp'] + coordinates)
+        self.pipeline.get_batch('/metric/batch', [8, 'temp'] + coordinates[:4])
+        self.pipeline.flush()
+        (tag, metrics, rows), (other_tag, other_metrics, other_rows) = self.replies()
+        assert (tag, metrics) == (7, ['light', 'unknown', 'temp'])
+        assert_allclose(rows[0], self.metric_hash['light'].get_value_many(xs, ys), rtol=1e-6)
+        assert numpy.isnan(rows[1]).all()
+        assert_allclose(rows[2], self.metric_hash['temp'].get_value_many(xs, ys), rtol=1e-6)
+        assert (other_tag, other_metrics) == (8, ['temp'])
+        assert_allclose(other_rows[0], rows[2][:2])
+
+    def test_positions_without_value_get_mean(self):
+        metric = self.metric_hash['temp']
+        metric.fallback = None
+        self.pipeline.get_batch('/metric/batch', [1, 'temp', 0., 0.])
+        self.pipeline.flush()
+        rows = self.replies()[0][2]
+        assert_allclose(rows[0], [metric.get_mean()], rtol=1e-6)
+
+    def test_odd_coordinates_are_ignored(self):
+        self.pipeline.get_batch('/metric/batch', [1, 'temp', 0.5])
+        assert self.pipeline.pending() == 0
+
+
+def test_split_batch():
+    assert split_batch([3, 'temp', 'light', 1., 2.]) == (3, ['temp', 'light'], [1., 2.])
+    assert split_batch(['tag', 'temp']) == ('tag', ['temp'], [])
+
+
+class FakeOutput(object):
+    def __init__(self):
+        self.updates = []
+        self.forgotten = []
+
+    def update(self, key, path, *args):
+        self.updates.append((path, args))
+
+    def forget(self, key):
+        self.forgotten.append(key)
+
+
+class FixedMetric(object):
+    # The same value everywhere
+    def __init__(self, value):
+        self.value = value
+        self.refreshed = 0
+
+    def get_value(self, x, y):
+        return self.value
+
+    def get_mean(self):
+        return -1.
+
+    def refresh(self):
+        self.refreshed += 1
+
+
+class Sensor(object):
+    def __init__(self, metric):
+        self.metric = metric
+
+
+class Version(object):
+    def __init__(self):
+        self.value = 0
+
+
+class TestSubscriptions(object):
+    def setup(self):
+        self.metric_hash = {'temp': FixedMetric(20.), 'light': FixedMetric(float('inf'))}
+        self.output = FakeOutput()
+        with mock.patch('osc_pipeline.Thread'):
+            self.subscriptions = Subscriptions(self.metric_hash, self.output, threshold=0.5)
+        self.subscriptions.on_pass_through('/player/location', [1., 2., 3.])
+
+    def tick(self):
+        self.subscriptions.push(*self.subscriptions.take_due())
+        updates, self.output.updates = self.output.updates, []
+        return updates
+
+    def test_first_value_always_sent(self):
+        self.subscriptions.subscribe('/subscribe', ['temp', 'light', 'unknown'])
+        assert sorted(self.tick()) == [('/subscription/data', ('light', -1.)), ('/subscription/data', ('temp', 20.))]
+        assert sorted(self.output.forgotten) == [('/subscription/data', 'light'), ('/subscription/data', 'temp')]
+        assert self.subscriptions.position == (1., 3.)
+
+    def test_threshold_suppresses_small_changes(self):
+        self.subscriptions.subscribe('/subscribe', ['temp', 2.])
+        self.tick()
+        self.metric_hash['temp'].value = 21.5
+        self.subscriptions.on_updates([(Sensor('temp'), 21.5, 0.)])
+        assert self.tick() == []
+        self.metric_hash['temp'].value = 22.5
+        self.subscriptions.on_updates([(Sensor('temp'), 22.5, 0.)])
+        assert self.tick() == [('/subscription/data', ('temp', 22.5))]
+
+    def test_resubscribing_resends(self):
+        self.subscriptions.subscribe('/subscribe', ['temp'])
+        self.tick()
+        self.subscriptions.subscribe('/subscribe', ['temp'])
+        assert self.tick() == [('/subscription/data', ('temp', 20.))]
+
+    def test_due_on_movement_or_updates(self):
+        self.subscriptions.subscribe('/subscribe', ['temp', 'light', 0.])
+        self.tick()
+        assert self.subscriptions.take_due()[1] == {}
+        self.subscriptions.on_updates([(Sensor('light'), 1., 0.), (Sensor('humidity'), 1., 0.)])
+        assert self.subscriptions.take_due() == ((1., 3.), {'light': 0.})
+        self.subscriptions.on_pass_through('/player/location', [4., 5., 6.])
+        self.subscriptions.on_pass_through('/time', [7.])
+        assert self.subscriptions.take_due() == ((4., 6.), {'temp': 0., 'light': 0.})
+
+    def test_due_on_shared_version(self):
+        versions = {'temp': Version(), 'light': Version()}
+        self.subscriptions.versions = versions
+        self.subscriptions.subscribe('/subscribe', ['temp'])
+        self.tick()
+        assert self.subscriptions.take_due()[1] == {}
+        versions['temp'].value += 1
+        assert self.subscriptions.take_due()[1] == {'temp': 0.5}
+        assert self.metric_hash['temp'].refreshed == 2
+
+    def test_unsubscribe(self):
+        self.subscriptions.subscribe('/subscribe', ['temp', 'light'])
+        self.tick()
+        self.subscriptions.unsubscribe('/unsubscribe', ['light'])
+        self.subscriptions.on_pass_through('/player/location', [4., 5., 6.])
+        assert [args[0] for _, args in self.tick()] == []
+        self.metric_hash['temp'].value = 30.
+        self.subscriptions.on_pass_through('/player/location', [4., 5., 6.])
+        assert [args[0] for _, args in self.tick()] == ['temp']
+        self.subscriptions.unsubscribe('/unsubscribe', [])
+        assert self.subscriptions.subscribed == {}
@@ -0,0 +1,28 @@
+from numpy.testing import assert_allclose
+
+from projection import UNITY, Projection
+
+
+def test_affine_transform():
+    projection = Projection(2., 1., 3., -1., 4., 0.5)
+    xs, ys, zs = projection.project([10., 20.], [-5., 5.], [1., 2.])
+    assert_allclose(xs, [-9., 11.])
+    assert_allclose(ys, [29., 59.])
+    assert_allclose(zs, [4.5, 8.5])
+
+
+def test_missing_coordinates_project_to_0():
+    projection = Projection(2., 1., 3., -1., 4., 0.5)
+    xs, ys, zs = projection.project([None, 0., 10.], [5., None, 0], [None, 1., None])
+    assert_allclose(xs, [11., 0., 0.])
+    assert_allclose(ys, [0., 0., 29.])
+    assert_allclose(zs, [0.5, 4.5, 0.5])
+
+
+def test_unity_project_one():
+    x, y, z = UNITY.project_one(42.36, -71.09, 3.)
+    assert_allclose(x, -71.09 * 83459.2085 + 5890083.394)
+    assert_allclose(y, 42.36 * 109938.8055 - 4606524.694)
+    assert_allclose(z, 3.7)
+    assert all(isinstance(c, float) for c in (x, y, z))
+    assert UNITY.project_one(None, None, None) == (0., 0., 0.7)
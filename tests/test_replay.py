@@ -0,0 +1,113 @@
+import numpy
+
+from replay import EventScheduler, PseudoClock, Timeline, parse_command
+
+
+class Sensor(object):
+    def __init__(self, url):
+        self.url = url
+
+
+class ManualClock(PseudoClock):
+    def __init__(self, start_time, time_scale=1):
+        self.now = 0.
+        self.start(start_time, time_scale)
+
+    def local_now(self):
+        return self.now
+
+
+def series(sensor, times):
+    times = numpy.array(times, dtype=numpy.int64)
+    return (sensor, times, times.astype(numpy.float32) / 1000)
+
+
+def event_times(events):
+    return [event.time for event in events]
+
+
+a, b, c = Sensor('a'), Sensor('b'), Sensor('c')
+
+
+def test_timeline_merges_sensors_in_time_order():
+    timeline = Timeline(0, [series(a, [0, 3000, 6000]), series(b, []), series(c, [1000, 3000, 5000])])
+    assert len(timeline) == 6
+    events = timeline.pop_until(3000)
+    assert event_times(events) == [0, 1000, 3000, 3000]
+    # Equal times keep the order of the series
+    assert [event.sensor for event in events] == [a, c, a, c]
+    assert [event.value for event in events] == [0., 1., 3., 3.]
+    assert len(timeline) == 2
+    assert event_times(timeline.pop_until(10000)) == [5000, 6000]
+    assert len(timeline) == 0
+
+
+def test_timeline_rewind():
+    timeline = Timeline(0, [series(a, [0, 1000, 2000, 3000])])
+    timeline.pop_until(3000)
+    timeline.rewind(1500)
+    assert event_times(timeline.pop_until(3000)) == [2000, 3000]
+
+
+def test_scheduler_emits_chunks_in_order_whatever_order_they_arrive():
+    clock = ManualClock(0)
+    scheduler = EventScheduler(clock)
+    scheduler.add_chunk(2, [series(a, [2000, 3000])])
+    scheduler.add_chunk(0, [series(a, [0, 1000]), series(b, [500])])
+    scheduler.add_chunk(4, [series(b, [4000])])
+    assert scheduler.pending() == 6
+    clock.now = 10
+    assert event_times(scheduler.pop_due()) == [0, 500, 1000, 2000, 3000, 4000]
+    assert scheduler.pending() == 0
+
+
+def test_scheduler_only_pops_due_events():
+    clock = ManualClock(0, time_scale=2)
+    scheduler = EventScheduler(clock)
+    scheduler.add_chunk(0, [series(a, [0, 1000, 2000, 3000])])
+    assert event_times(scheduler.pop_due()) == [0]
+    clock.now = 0.5
+    assert event_times(scheduler.pop_due()) == [1000]
+    assert scheduler.pop_due() == []
+    assert clock.local_delay(scheduler.next_time() / 1000.) == 0.5
+    clock.now = 1.5
+    assert event_times(scheduler.wait_due()) == [2000, 3000]
+
+
+def test_scheduler_seek():
+    clock = ManualClock(0)
+    scheduler = EventScheduler(clock)
+    first = Timeline(0, [series(a, [0, 1000, 2000])])
+    second = Timeline(3, [series(a, [3000, 4000])])
+    scheduler.add_timeline(first)
+    scheduler.add_timeline(second)
+    clock.now = 2
+    assert event_times(scheduler.pop_due()) == [0, 1000, 2000]
+
+    # Seeking back replays kept timelines from the new time on, and chunks
+    # arriving afterwards start from it too
+    clock.start(1)
+    scheduler.reset(1000, [second, first])
+    scheduler.add_chunk(5, [series(b, [500, 5000])])
+    clock.now = 10
+    assert event_times(scheduler.pop_due()) == [1000, 2000, 3000, 4000, 5000]
+
+
+def test_scheduler_clear():
+    clock = ManualClock(0)
+    scheduler = EventScheduler(clock)
+    scheduler.add_chunk(0, [series(a, [0, 1000])])
+    scheduler.clear()
+    assert scheduler.pending() == 0
+    assert scheduler.next_time() is None
+
+
+def test_parse_command():
+    assert parse_command('{"command": "seek", "time": 1415491200}') == ('seek', 1415491200)
+    assert parse_command('1415491200.5') == ('seek', 1415491200.5)
+    assert parse_command('{"command": "speed", "scale": 2.5}') == ('speed', 2.5)
+    assert parse_command('{"command": "pause"}') == ('pause', None)
+    for message in ('not json', '{"command": "rewind"}', '{"command": "speed", "scale": 0}',
+                    '{"command": "seek", "time": true}', '{"command": "seek", "time": NaN}',
+                    '{"command": "seek", "time": "Infinity"}'):
+        assert parse_command(message) is None, message
@@ -0,0 +1,123 @@
+import json
+
+import numpy
+
+from replay import Event
+from replay_hub import COALESCE, BinaryEncoder, ReplayHub, Subscriber, encode_json
+
+START = 1415491200
+
+
+class Sensor(object):
+    def __init__(self, url):
+        self.url = url
+
+
+def decode(frame, urls):
+    start, count = BinaryEncoder.header.unpack_from(frame)
+    records = numpy.frombuffer(frame, dtype=BinaryEncoder.record, offset=BinaryEncoder.header.size)
+    assert len(records) == count
+    times = start + numpy.cumsum(records['delta'].astype(numpy.int64))
+    return [(urls[sensor], int(t), float(value))
+            for sensor, t, value in zip(records['sensor'], times, records['value'])]
+
+
+def test_binary_round_trip():
+    sensors = [Sensor('http://chain/sensors/%d' % i) for i in range(5)]
+    encoder = BinaryEncoder(sensors)
+    dictionary = json.loads(encoder.dictionary())
+    assert dictionary['first'] == 0
+    urls = dictionary['sensors']
+    assert urls == [sensor.url for sensor in sensors]
+
+    events = [Event(sensors[i % 5], 1415491200000 + 250 * i, 0.5 * i - 3) for i in range(40)]
+    decoded = decode(encoder(events), urls)
+    assert decoded == [(event.sensor.url, event.time, event.value) for event in events]
+
+
+def test_binary_new_sensors_extend_dictionary():
+    known = Sensor('http://chain/sensors/0')
+    encoder = BinaryEncoder([known])
+    urls = json.loads(encoder.dictionary())['sensors']
+    new = Sensor('http://chain/sensors/7')
+    events = [Event(new, 1000, 1.), Event(known, 3000, 2.)]
+    frame = encoder(events)
+    update = json.loads(encoder.dictionary(len(urls)))
+    assert update['first'] == 1 and update['sensors'] == [new.url]
+    assert decode(frame, urls + update['sensors']) == [(new.url, 1000, 1.), (known.url, 3000, 2.)]
+
+
+def test_binary_empty_frame():
+    encoder = BinaryEncoder()
+    assert decode(encoder([]), []) == []
+
+
+def make_hub():
+    # Groups are created without running their loops
+    return ReplayHub(None, [], spawn=lambda target: None, join_window=1., start_time=START)
+
+
+def age(subscriber, seconds):
+    # Move the subscriber's group seconds into its replay
+    subscriber.group.session.clock.local_start_time -= seconds
+
+
+def test_default_clients_share_a_group():
+    hub = make_hub()
+    first = hub.subscribe()
+    age(first, 60)
+    second = hub.subscribe()
+    assert second.group is first.group
+    assert first.group.session.clock.pseudo_start_time == START
+    assert hub.subscribe(time_scale=2).group is not first.group
+
+
+def test_late_clients_with_start_time_get_a_new_group():
+    hub = make_hub()
+    first = hub.subscribe(START + 600)
+    assert hub.subscribe(START + 600).group is first.group
+    age(first, 5)
+    late = hub.subscribe(START + 600)
+    assert late.group is not first.group
+    stats = sorted(hub.stats(), key=lambda group: group['subscribers'])
+    assert [(group['start_time'], group['subscribers']) for group in stats] == [(START + 600, 1), (START + 600, 2)]
+
+
+def test_lone_client_command_applies_in_place():
+    hub = make_hub()
+    subscriber = hub.subscribe(START)
+    group = subscriber.group
+    hub.command(subscriber, '{"command": "speed", "scale": 4}')
+    assert subscriber.group is group
+    # The playhead carries on from where it was
+    assert group.session.speed == 4 and group.key[1] == 4
+    assert START <= group.key[0] < START + 1
+
+    hub.command(subscriber, '{"command": "pause"}')
+    assert subscriber.group is group and group.key is None
+    assert hub.stats()[0]['paused']
+
+
+def test_shared_client_command_moves_it():
+    hub = make_hub()
+    subscriber = hub.subscribe(START)
+    other = hub.subscribe(START)
+    hub.command(subscriber, '{"command": "pause"}')
+    assert subscriber.group is not other.group
+    assert not other.group.session.paused
+    stats = sorted(hub.stats(), key=lambda group: group['paused'])
+    assert [(group['paused'], group['subscribers']) for group in stats] == [(False, 1), (True, 1)]
+
+    hub.unsubscribe(subscriber)
+    assert len(hub.stats()) == 1 and not subscriber.active
+
+
+def test_coalesce_keeps_latest_event_per_sensor():
+    a, b = Sensor('a'), Sensor('b')
+    subscriber = Subscriber(2, COALESCE, encode_json)
+    for events in ([Event(a, 0, 1.)], [Event(b, 1000, 2.)], [Event(a, 2000, 3.)]):
+        subscriber.push(events, encode_json(events))
+    frame = json.loads(subscriber.get(timeout=0))
+    assert [(e['_links']['ch:sensor']['href'], e['value']) for e in frame] == [('b', 2.), ('a', 3.)]
+    assert subscriber.dropped == 1
+    assert subscriber.get(timeout=0) is None
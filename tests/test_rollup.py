@@ -0,0 +1,97 @@
+import numpy
+from numpy.testing import assert_allclose, assert_array_equal
+
+from rollup import LEVELS, RollupSource, aggregate, level_for_range, level_for_speed
+from util import MILLISECONDS
+
+# On a chunk boundary
+START = 1415490000
+END = START + 20000
+
+
+class Sensor(object):
+    def __init__(self, url):
+        self.url = url
+
+
+class Source(object):
+    """Irregular samples of every sensor over [START, END), recording the
+    fetches made."""
+    def __init__(self, sensors, seed=0):
+        random = numpy.random.RandomState(seed)
+        self.series = {}
+        for sensor in sensors:
+            times = numpy.sort(random.randint(START * MILLISECONDS, END * MILLISECONDS, 5000)).astype(numpy.int64)
+            self.series[sensor.url] = (times, random.uniform(-20, 40, len(times)))
+        self.fetches = []
+
+    def fetch_series(self, sensors, start_stamp, end_stamp):
+        self.fetches.append(([sensor.url for sensor in sensors], start_stamp, end_stamp))
+        result = []
+        for sensor in sensors:
+            times, values = self.series[sensor.url]
+            lo, hi = numpy.searchsorted(times, [start_stamp * MILLISECONDS, end_stamp * MILLISECONDS])
+            result.append((sensor, times[lo:hi], values[lo:hi]))
+        return result
+
+
+def test_rollups_match_aggregate():
+    sensors = [Sensor('a'), Sensor('b')]
+    source = Source(sensors)
+    rollups = RollupSource(source)
+    # Bounds off the bucket and chunk boundaries, and hour buckets that
+    # span two chunks
+    start, end = START + 1234, START + 15321
+    for level in LEVELS:
+        for sensor, rollup in rollups.rollups(sensors, start, end, level):
+            times, values = source.series[sensor.url]
+            expected = aggregate(times, values, level).slice(start * MILLISECONDS, end * MILLISECONDS)
+            assert_array_equal(rollup.times, expected.times)
+            assert_array_equal(rollup.count, expected.count)
+            assert_array_equal(rollup.min, expected.min)
+            assert_array_equal(rollup.max, expected.max)
+            assert_allclose(rollup.mean, expected.mean, rtol=1e-5)
+
+
+def test_chunks_are_fetched_once():
+    sensors = [Sensor('a'), Sensor('b')]
+    source = Source(sensors)
+    rollups = RollupSource(source, chunk_length=2000)
+    # A raw chunk fetched by replay is rolled up and kept
+    raw = rollups.fetch_series(sensors, START + 2000, START + 4000)
+    assert [len(times) for _, times, _ in raw] == [len(times) for _, times, _ in source.fetch_series(
+        sensors, START + 2000, START + 4000)]
+    source.fetches = []
+
+    times, means = rollups.fetch_series(sensors[:1], START + 2000, START + 4000, level=10)[0][1:]
+    assert source.fetches == []
+    assert len(times) == len(means)
+    assert times[0] >= (START + 2000) * MILLISECONDS and times[-1] < (START + 4000) * MILLISECONDS
+    rollups.fetch_series(sensors, START + 2000, START + 6000, level=10)
+    assert source.fetches == [(['a', 'b'], START + 4000, START + 6000)]
+    rollups.fetch_series(sensors, START + 3000, START + 5000, level=10)
+    assert len(source.fetches) == 1
+
+
+def test_chunks_are_evicted():
+    sensors = [Sensor('a')]
+    source = Source(sensors)
+    rollups = RollupSource(source, chunk_length=2000, max_chunks=2)
+    rollups.rollups(sensors, START, START + 6000, 10)
+    assert list(rollups.chunks) == [START + 2000, START + 4000]
+
+
+def test_chunk_span():
+    rollups = RollupSource(None, chunk_length=2000)
+    assert rollups.chunk_span(START, START + 2000, 10) == (START, START + 2000)
+    # With the chunk holding the start of the hour bucket the range is in
+    assert rollups.chunk_span(START + 3700, START + 3800, 3600) == (START, START + 6000)
+
+
+def test_levels():
+    assert level_for_range(3600, 360) == 10
+    assert level_for_range(3600, 359) == 60
+    assert level_for_range(10 ** 9, 10) == max(LEVELS)
+    assert level_for_speed(1) == 0
+    assert level_for_speed(600) == 60
+    assert level_for_speed(-6000) == 600
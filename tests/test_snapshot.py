@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+import snapshot
+
+SITE = 'http://localhost/sites/1'
+
+
+def description(names):
+    return {
+        'stream_url': 'ws://localhost/',
+        'devices': [{'index': i, 'name': name, 'latitude': 41.9, 'longitude': -70.6, 'elevation': 0.}
+                    for i, name in enumerate(names)],
+        'sensors': [{'url': 'http://localhost/sensors/%d' % i, 'metric': 'temp', 'device': i}
+                    for i in range(len(names))],
+    }
+
+
+class SyncThread(object):
+    # Runs the target in start(), so revalidate finishes before returning
+    def __init__(self, target):
+        self.target = target
+        self.daemon = False
+
+    def start(self):
+        self.target()
+
+
+class Interpolator(object):
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+
+
+class Metric(object):
+    def __init__(self, cache_path):
+        self.interpolator = Interpolator(cache_path)
+
+
+class TestSnapshot(object):
+    def setup(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_round_trip(self):
+        assert snapshot.load_snapshot(self.snapshot_dir, SITE) is None
+        snapshot.save_snapshot(self.snapshot_dir, SITE, description(['a', 'b']))
+        assert snapshot.load_snapshot(self.snapshot_dir, SITE) == description(['a', 'b'])
+
+    def test_other_site_or_version_is_ignored(self):
+        snapshot.save_snapshot(self.snapshot_dir, SITE, description(['a']))
+        assert snapshot.load_snapshot(self.snapshot_dir, SITE + '0') is None
+        with open(snapshot.snapshot_path(self.snapshot_dir)) as f:
+            saved = json.load(f)
+        saved['version'] = snapshot.SNAPSHOT_VERSION + 1
+        with open(snapshot.snapshot_path(self.snapshot_dir), 'w') as f:
+            json.dump(saved, f)
+        assert snapshot.load_snapshot(self.snapshot_dir, SITE) is None
+
+    def test_load_description_fetches_once(self):
+        with mock.patch('snapshot.fetch_description', return_value=description(['a'])) as fetch:
+            assert snapshot.load_description(SITE, self.snapshot_dir) == (description(['a']), False)
+            assert snapshot.load_description(SITE, self.snapshot_dir) == (description(['a']), True)
+        assert fetch.call_count == 1
+
+    def test_revalidate_calls_on_change_only_on_change(self):
+        snapshot.save_snapshot(self.snapshot_dir, SITE, description(['a']))
+        changes = []
+        with mock.patch('snapshot.Thread', SyncThread):
+            with mock.patch('snapshot.fetch_description', return_value=description(['a'])):
+                snapshot.revalidate(SITE, self.snapshot_dir, description(['a']), changes.append)
+            assert changes == []
+
+            with mock.patch('snapshot.fetch_description', side_effect=IOError):
+                snapshot.revalidate(SITE, self.snapshot_dir, description(['a']), changes.append)
+            assert changes == []
+
+            with mock.patch('snapshot.fetch_description', return_value=description(['a', 'b'])):
+                snapshot.revalidate(SITE, self.snapshot_dir, description(['a']), changes.append)
+        assert changes == [description(['a', 'b'])]
+        assert snapshot.load_snapshot(self.snapshot_dir, SITE) == description(['a', 'b'])
+
+    def test_prune_rasters(self):
+        paths = {}
+        for name in ('used', 'recent', 'old'):
+            paths[name] = os.path.join(self.snapshot_dir, 'simplex_%s.npy' % name)
+            open(paths[name], 'w').close()
+        other = os.path.join(self.snapshot_dir, 'other.npy')
+        open(other, 'w').close()
+        old = time.time() - snapshot.RASTER_MAX_AGE - 60
+        for path in (paths['used'], paths['old'], other):
+            os.utime(path, (old, old))
+
+        snapshot.prune_rasters(self.snapshot_dir, [Metric(paths['used']), Metric(None)])
+        assert sorted(os.listdir(self.snapshot_dir)) == ['other.npy', 'simplex_recent.npy', 'simplex_used.npy']
+        # Marked as used
+        assert time.time() - os.path.getmtime(paths['used']) < 60
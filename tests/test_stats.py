@@ -0,0 +1,101 @@
+import numpy
+from numpy.testing import assert_allclose
+
+from stats import DecayedStats, RunningStats, WindowedStats
+
+
+def check(stats, values):
+    assert_allclose(stats.mean, numpy.mean(values), rtol=1e-9)
+    assert_allclose(stats.std, numpy.std(values), rtol=1e-6, atol=1e-9)
+    assert stats.min == numpy.min(values)
+    assert stats.max == numpy.max(values)
+
+
+def test_running_stats_add_remove_replace():
+    random = numpy.random.RandomState(0)
+    # A large offset, where naive sums of squares lose the variance
+    values = list(1e6 + random.normal(0, 1, 200))
+    live = list(values)
+    stats = RunningStats(values=lambda: live)
+    stats.reset(values)
+    check(stats, live)
+    for i in range(150):
+        old = live.pop(random.randint(len(live)))
+        new = None if i % 3 == 0 else 1e6 + random.normal(0, 5)
+        if new is not None:
+            live.append(new)
+        stats.replace(old, new)
+        assert stats.count == len(live)
+        check(stats, live)
+
+
+def test_running_stats_removing_extremes():
+    live = [3., 1., 4., 1., 5., 9., 2., 6.]
+    stats = RunningStats(values=lambda: live)
+    stats.reset(live)
+    for value in (9., 1., 6.):
+        live.remove(value)
+        stats.remove(value)
+        check(stats, live)
+
+
+def test_running_stats_empty():
+    stats = RunningStats()
+    stats.add(2.)
+    stats.remove(2.)
+    assert stats.count == 0
+    assert numpy.isnan(stats.mean)
+    assert stats.min == float('inf') and stats.max == float('-inf')
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_windowed_stats():
+    random = numpy.random.RandomState(1)
+    clock = Clock()
+    stats = WindowedStats(10., clock=clock)
+    updates = []
+    for _ in range(500):
+        clock.now += random.uniform(0, 1)
+        value = random.normal(20, 3)
+        updates.append((clock.now, value))
+        stats.add(value)
+        window = [v for t, v in updates if t >= clock.now - 10.]
+        assert stats.count == len(window)
+        check(stats, window)
+
+
+def test_windowed_stats_expire_on_read():
+    clock = Clock()
+    stats = WindowedStats(10., clock=clock)
+    stats.add(1.)
+    clock.now = 5.
+    stats.add(3.)
+    clock.now = 12.
+    assert stats.count == 1
+    check(stats, [3.])
+    clock.now = 20.
+    assert stats.count == 0
+    assert numpy.isnan(stats.mean)
+    assert stats.min == float('inf')
+
+
+def test_decayed_stats():
+    random = numpy.random.RandomState(2)
+    stats = DecayedStats(half_life=30.)
+    times = numpy.cumsum(random.uniform(0, 5, 300))
+    values = random.normal(100, 10, 300)
+    for t, value in zip(times, values):
+        stats.add(value, t)
+    weights = 0.5 ** ((times[-1] - times) / 30.)
+    mean = numpy.average(values, weights=weights)
+    variance = numpy.average((values - mean) ** 2, weights=weights)
+    assert stats.count == len(values)
+    assert_allclose(stats.mean, mean, rtol=1e-9)
+    assert_allclose(stats.variance, variance, rtol=1e-6)
@@ -0,0 +1,48 @@
+"""Time and file helpers shared by the history, archive and ingest modules."""
+import calendar
+import errno
+import os
+import re
+import tempfile
+
+import dateutil.parser
+
+MILLISECONDS = 1000
+
+ISO_TIMESTAMP = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?(Z|[+-]00:?00)?$')
+
+
+def parse_timestamp_seconds(timestamp, default):
+    # Unix seconds of a UTC ISO 8601 timestamp, as sent by chain-api; a fast
+    # path for the stream, giving default for anything else
+    match = ISO_TIMESTAMP.match(timestamp)
+    if match is None:
+        return default
+    fields = [int(f) for f in match.groups()[:6]]
+    fraction = float(match.group(7)) if match.group(7) else 0.
+    return calendar.timegm(fields) + fraction
+
+
+def parse_timestamp_ms(timestamp):
+    # Epoch milliseconds of any ISO 8601 timestamp, naive ones taken as UTC
+    t = dateutil.parser.parse(timestamp)
+    return calendar.timegm(t.utctimetuple()) * MILLISECONDS + t.microsecond // 1000
+
+
+def ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def atomic_write(path, write, mode='w'):
+    """Calls write(f) on a temporary file next to path, then renames it over
+    path, so readers never see a partial file."""
+    directory = os.path.dirname(path) or '.'
+    ensure_dir(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, mode) as f:
+        write(f)
+    os.rename(tmp_path, path)